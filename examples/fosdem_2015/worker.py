@@ -21,6 +21,6 @@ class PowerWorker(ResourceWorker):
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     medium = ZeroMQMedium(loop, UdpDiscoveryMedium)
-    worker = PowerWorker('PowerWorker', medium)
+    worker = PowerWorker('PowerWorker', medium, concurrency=10)
     loop.run_until_complete(worker.start())
     loop.run_forever()
@@ -18,6 +18,7 @@ with open('requirements.txt') as requirements_file:
     requirements = requirements_file.read().splitlines()
 
 test_requirements = [
+    'mongomock',
 ]
 
 setup(
@@ -37,6 +38,7 @@ setup(
                  'zeroservices'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={'msgpack': ['msgpack']},
     license="MIT",
     zip_safe=False,
     keywords='zeroservices',
@@ -284,6 +284,168 @@ class _BaseCollectionTestCase(TestCase):
         self.assertItemsEqual(result,
                               expected)
 
+    @_async_test
+    def test_list_pagination(self):
+        docs = [({'field1': i % 3, 'field2': i}, 'UUID-%02d' % i) for i in
+                range(10)]
+        for doc in docs:
+            yield from self._create(*doc)
+
+        # Ordered by resource_id without sort
+        message = {'action': 'list', 'limit': 4}
+        page = yield from self.collection.on_message(**message)
+        self.assertEqual([resource['resource_id'] for resource in
+                          page['resources']],
+                         ['UUID-00', 'UUID-01', 'UUID-02', 'UUID-03'])
+
+        # Walk every page sorted by field1 desc then field2
+        sort = ['-field1', 'field2']
+        resource_ids = []
+        after = None
+        while True:
+            message = {'action': 'list', 'limit': 4, 'sort': sort,
+                       'after': after, 'where': {'field2': {'$gt': 0}}}
+            page = yield from self.collection.on_message(**message)
+            self.assertLessEqual(len(page['resources']), 4)
+            resource_ids.extend(resource['resource_id'] for resource in
+                                page['resources'])
+            after = page['cursor']
+            if after is None:
+                break
+
+        expected = sorted((doc for doc in docs if doc[0]['field2'] > 0),
+                          key=lambda doc: (-doc[0]['field1'],
+                                           doc[0]['field2']))
+        self.assertEqual(resource_ids, [doc[1] for doc in expected])
+
+        with self.assertRaises(ValueError):
+            yield from self.collection.on_message(action='list', limit=0)
+
+        # Sort without limit returns a list
+        message = {'action': 'list', 'sort': '-field2'}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual([resource['resource_id'] for resource in result],
+                         [doc[1] for doc in reversed(docs)])
+
+    @_async_test
+    def test_projection(self):
+        resource_data = {'field1': 1, 'field2': {'sub1': 1, 'sub2': 2},
+                         'field3': 3}
+        yield from self._create(resource_data, self.resource_id)
+
+        message = {'action': 'get', 'resource_id': self.resource_id,
+                   'fields': ['field1', 'field2.sub2']}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result['resource_data'],
+                         {'field1': 1, 'field2': {'sub2': 2}})
+
+        message = {'action': 'list', 'fields': ['-field2']}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result, [{'resource_id': self.resource_id,
+                                   'resource_data': {'field1': 1,
+                                                     'field3': 3}}])
+
+        # The sort field is still used for the page cursor
+        yield from self._create({'field1': 0, 'field3': 0}, 'UUID-0')
+        message = {'action': 'list', 'fields': ['field3'], 'sort': 'field1',
+                   'limit': 1}
+        page = yield from self.collection.on_message(**message)
+        self.assertEqual(page['resources'],
+                         [{'resource_id': 'UUID-0',
+                           'resource_data': {'field3': 0}}])
+        self.assertEqual(page['cursor'], [0, 'UUID-0'])
+
+        # The stored resource is left untouched
+        message = {'action': 'get', 'resource_id': self.resource_id}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result['resource_data'], resource_data)
+
+    @_async_test
+    def test_bulk(self):
+        resources = [{'resource_id': 'UUID-%d' % i,
+                      'resource_data': {'field1': i}} for i in range(3)]
+        message = {'action': 'bulk_create', 'resources': resources}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result, [{'resource_id': 'UUID-%d' % i,
+                                   'success': True} for i in range(3)])
+
+        # One event per resource
+        self.assertEqual(self.service2.on_event_mock.call_count, 3)
+        expected_payload = {'resource_id': 'UUID-1',
+                            'resource_name': self.resource_name,
+                            'action': 'create',
+                            'resource_data': {'field1': 1}}
+        self.service2.on_event_mock.assert_any_call(
+            '%s.create.UUID-1' % self.resource_name, **expected_payload)
+        self.service2.on_event_mock.reset_mock()
+
+        patches = [{'resource_id': 'UUID-0', 'patch': {'$set': {'field1': 5}}},
+                   {'resource_id': 'UUID-9', 'patch': {'$set': {'field1': 5}}}]
+        message = {'action': 'bulk_patch', 'patches': patches}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual([item['success'] for item in result], [True, False])
+        self.assertEqual(result[1]['resource_id'], 'UUID-9')
+
+        self.service2.on_event_mock.assert_called_once_with(
+            '%s.patch.UUID-0' % self.resource_name,
+            resource_id='UUID-0', resource_name=self.resource_name,
+            action='patch', patch=patches[0]['patch'])
+        self.service2.on_event_mock.reset_mock()
+
+        message = {'action': 'bulk_delete',
+                   'resource_ids': ['UUID-9', 'UUID-1']}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual([item['success'] for item in result], [False, True])
+
+        self.service2.on_event_mock.assert_called_once_with(
+            '%s.delete.UUID-1' % self.resource_name,
+            resource_id='UUID-1', resource_name=self.resource_name,
+            action='delete')
+
+        message = {'action': 'list', 'sort': 'resource_id'}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result,
+                         [{'resource_id': 'UUID-0',
+                           'resource_data': {'field1': 5}},
+                          {'resource_id': 'UUID-2',
+                           'resource_data': {'field1': 2}}])
+
+    @_async_test
+    def test_bulk_invalid_items(self):
+        resources = [{'resource_id': 'UUID-0', 'resource_data': {'field1': 0}},
+                     {'resource_id': 'UUID-1'},
+                     {'resource_id': 'UUID-2', 'resource_data': {'field1': 2}}]
+        message = {'action': 'bulk_create', 'resources': resources}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual([item['success'] for item in result],
+                         [True, False, True])
+        self.assertEqual(result[1]['resource_id'], 'UUID-1')
+
+        # The valid resources are still published
+        self.assertEqual(self.service2.on_event_mock.call_count, 2)
+        self.service2.on_event_mock.reset_mock()
+
+        patches = [{'resource_id': 'UUID-0', 'patch': {'$set': {'field1': 5}}},
+                   {'resource_id': 'UUID-2', 'patch': {'field1': 5}},
+                   {'resource_id': 'UUID-2'}]
+        message = {'action': 'bulk_patch', 'patches': patches}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual([item['success'] for item in result],
+                         [True, False, False])
+
+        self.service2.on_event_mock.assert_called_once_with(
+            '%s.patch.UUID-0' % self.resource_name,
+            resource_id='UUID-0', resource_name=self.resource_name,
+            action='patch', patch=patches[0]['patch'])
+
+        message = {'action': 'list', 'sort': 'resource_id'}
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result,
+                         [{'resource_id': 'UUID-0',
+                           'resource_data': {'field1': 5}},
+                          {'resource_id': 'UUID-2',
+                           'resource_data': {'field1': 2}}])
+
     @_async_test
     def test_bad_action(self):
         message = {'action': 'unknown', 'resource_id': self.resource_id,
@@ -1,7 +1,7 @@
 import unittest
 
 from zeroservices.memory import MemoryCollection
-from ..utils import test_medium
+from ..utils import test_medium, _async_test
 from . import _BaseCollectionTestCase
 
 try:
@@ -16,3 +16,207 @@ class MemoryCollectionTestCase(_BaseCollectionTestCase):
         super(MemoryCollectionTestCase, self).setUp()
         self.collection = MemoryCollection(self.resource_name)
         self.collection.service = self.service
+
+    def _list(self, where):
+        result = yield from self.collection.on_message(action='list',
+                                                       where=where)
+        return sorted(resource['resource_id'] for resource in result)
+
+    @_async_test
+    def test_list_filter_range(self):
+        for i in range(10):
+            yield from self._create({'field1': i, 'field2': 'v%d' % i},
+                                    'UUID-%d' % i)
+        yield from self._create({'field1': None, 'field2': 'v'}, 'UUID-none')
+
+        result = yield from self._list({'field1': {'$gte': 7}})
+        self.assertEqual(result, ['UUID-7', 'UUID-8', 'UUID-9'])
+
+        result = yield from self._list({'field1': {'$gt': 2, '$lte': 4}})
+        self.assertEqual(result, ['UUID-3', 'UUID-4'])
+
+        result = yield from self._list({'field1': {'$lt': 0}})
+        self.assertEqual(result, [])
+
+        result = yield from self._list({'field1': {'$gt': 2, '$lt': 6},
+                                        'field2': 'v4'})
+        self.assertEqual(result, ['UUID-4'])
+
+        result = yield from self._list({'field2': {'$gte': 'v8'}})
+        self.assertEqual(result, ['UUID-8', 'UUID-9'])
+
+        result = yield from self._list({'field1': None})
+        self.assertEqual(result, ['UUID-none'])
+
+    @_async_test
+    def test_list_filter_dotted_path(self):
+        yield from self._create({'field1': {'sub': 1}}, 'UUID-1')
+        yield from self._create({'field1': {'sub': 2}}, 'UUID-2')
+        yield from self._create({'field1': 3}, 'UUID-3')
+
+        result = yield from self._list({'field1.sub': 2})
+        self.assertEqual(result, ['UUID-2'])
+
+        result = yield from self._list({'field1.sub': {'$lte': 2}})
+        self.assertEqual(result, ['UUID-1', 'UUID-2'])
+
+    @_async_test
+    def test_list_filter_after_changes(self):
+        for i in range(3):
+            yield from self._create({'field1': i, 'field2': i}, 'UUID-%d' % i)
+
+        yield from self.collection.on_message(
+            action='patch', resource_id='UUID-0',
+            patch={'$set': {'field1': 5, 'field2': 5}})
+        yield from self.collection.on_message(action='delete',
+                                              resource_id='UUID-1')
+        yield from self.collection.on_message(
+            action='add_link', resource_id='UUID-2', relation='relation',
+            target_id=['collection', 'target'], title='title')
+        # Create again over an existing resource
+        yield from self._create({'field1': 1, 'field2': 1}, 'UUID-2')
+
+        result = yield from self._list({'field1': 0})
+        self.assertEqual(result, [])
+        result = yield from self._list({'field1': 5, 'field2': {'$gt': 4}})
+        self.assertEqual(result, ['UUID-0'])
+        result = yield from self._list({'field2': {'$lt': 5}})
+        self.assertEqual(result, ['UUID-2'])
+        result = yield from self._list({'field1': 1})
+        self.assertEqual(result, ['UUID-2'])
+        result = yield from self._list(
+            {'_links.latest.collection': ['collection', 'target']})
+        self.assertEqual(result, [])
+
+    @_async_test
+    def test_list_filter_operators(self):
+        yield from self._create({'field1': 1, 'field2': 'a'}, 'UUID-1')
+        yield from self._create({'field1': [1, 2], 'field2': ['a', 'b']},
+                                'UUID-2')
+        yield from self._create({'field1': 3}, 'UUID-3')
+
+        result = yield from self._list({'field1': 1})
+        self.assertEqual(result, ['UUID-1', 'UUID-2'])
+
+        result = yield from self._list({'field2': {'$in': ['b', 'c']}})
+        self.assertEqual(result, ['UUID-2'])
+
+        result = yield from self._list({'field2': {'$exists': False}})
+        self.assertEqual(result, ['UUID-3'])
+
+        result = yield from self._list({'field1': {'$elemMatch': {'$gt': 1}}})
+        self.assertEqual(result, ['UUID-2'])
+
+        result = yield from self._list({'$or': [{'field1': 3},
+                                                {'field2': 'a'}]})
+        self.assertEqual(result, ['UUID-1', 'UUID-2', 'UUID-3'])
+
+    @_async_test
+    def test_list_since(self):
+        for i in range(5):
+            yield from self._create({'field1': i}, 'UUID-%d' % i)
+
+        message = {'action': 'list', 'since': 0,
+                   'where': {'field1': {'$gte': 1}}}
+        changes = yield from self.collection.on_message(**message)
+        self.assertTrue(changes['resync'])
+        self.assertEqual([resource['resource_id'] for resource in
+                          changes['resources']],
+                         ['UUID-1', 'UUID-2', 'UUID-3', 'UUID-4'])
+
+        # Nothing changed
+        message.update(since=changes['seq'], epoch=changes['epoch'])
+        result = yield from self.collection.on_message(**message)
+        self.assertFalse(result['resync'])
+        self.assertEqual(result['resources'], [])
+        self.assertEqual(result['seq'], changes['seq'])
+
+        yield from self.collection.on_message(
+            action='patch', resource_id='UUID-3',
+            patch={'$set': {'field1': 30}})
+        yield from self.collection.on_message(action='delete',
+                                              resource_id='UUID-2')
+        yield from self.collection.on_message(
+            action='patch', resource_id='UUID-0',
+            patch={'$set': {'field1': 0}})
+
+        result = yield from self.collection.on_message(**message)
+        self.assertEqual(result['resources'],
+                         [{'resource_id': 'UUID-3',
+                           'resource_data': {'field1': 30}}])
+        self.assertEqual(result['deleted'], ['UUID-2'])
+
+        # Another epoch gets everything back
+        message['epoch'] = 'other'
+        result = yield from self.collection.on_message(**message)
+        self.assertTrue(result['resync'])
+        self.assertEqual(len(result['resources']), 3)
+
+    @_async_test
+    def test_list_since_forgotten_tombstones(self):
+        self.collection.max_tombstones = 4
+        for i in range(10):
+            yield from self._create({'field1': i}, 'UUID-%d' % i)
+
+        changes = yield from self.collection.on_message(action='list',
+                                                        since=0)
+        message = {'action': 'list', 'since': changes['seq'],
+                   'epoch': changes['epoch']}
+
+        for i in range(5):
+            yield from self.collection.on_message(action='delete',
+                                                  resource_id='UUID-%d' % i)
+        self.assertLessEqual(self.collection.tombstones, 4)
+
+        # Some deletions were forgotten
+        result = yield from self.collection.on_message(**message)
+        self.assertTrue(result['resync'])
+        self.assertEqual(len(result['resources']), 5)
+
+
+class IndexedMemoryCollectionTestCase(MemoryCollectionTestCase):
+
+    def setUp(self):
+        super(IndexedMemoryCollectionTestCase, self).setUp()
+        self.collection = MemoryCollection(
+            self.resource_name, indexes={'field1': 'sorted',
+                                         'field2': 'hash',
+                                         'field1.sub': 'sorted',
+                                         '_links.latest.collection': 'hash'})
+        self.collection.service = self.service
+
+    @_async_test
+    def test_list_indexed_order(self):
+        resource_ids = ['UUID-%d' % i for i in (7, 2, 9, 0, 5, 3)]
+        for resource_id in resource_ids:
+            yield from self._create({'field2': 'a'}, resource_id)
+        yield from self.collection.on_message(action='delete',
+                                              resource_id='UUID-2')
+        yield from self._create({'field2': 'a'}, 'UUID-2')
+        yield from self.collection.on_message(
+            action='patch', resource_id='UUID-7',
+            patch={'$set': {'field2': 'a'}})
+
+        # Listed in insertion order, like the unindexed resources
+        result = yield from self.collection.on_message(
+            action='list', where={'field2': 'a'})
+        self.assertEqual([resource['resource_id'] for resource in result],
+                         ['UUID-7', 'UUID-9', 'UUID-0', 'UUID-5', 'UUID-3',
+                          'UUID-2'])
+
+    def test_unknown_index_kind(self):
+        with self.assertRaises(ValueError):
+            MemoryCollection(self.resource_name, indexes={'field1': 'foo'})
+
+    @_async_test
+    def test_create_index(self):
+        for i in range(10):
+            yield from self._create({'field1': i, 'field3': i % 2},
+                                    'UUID-%d' % i)
+
+        self.assertIsNone(self.collection._candidates({'field3': 1}))
+
+        self.collection.create_index('field3')
+        self.assertEqual(self.collection._candidates({'field3': 1,
+                                                      'field1': {'$lt': 4}}),
+                         {'UUID-1', 'UUID-3'})
@@ -1,6 +1,9 @@
 import asyncio
+import mongomock
 
-from zeroservices.backend.mongodb import MongoDBCollection
+from concurrent.futures import ThreadPoolExecutor
+from zeroservices.backend.mongodb import (MongoDBCollection,
+                                          AsyncMongoDBCollection)
 from . import _BaseCollectionTestCase
 
 from ..utils import TestCase, _create_test_resource_service, _async_test
@@ -25,6 +28,49 @@ class MongoDBCollectionTestCase(_BaseCollectionTestCase):
         self.collection.collection.drop()
 
 
+class MongomockCollectionTestCase(_BaseCollectionTestCase):
+
+    def setUp(self):
+        super(MongomockCollectionTestCase, self).setUp()
+        self.collection = MongoDBCollection(self.resource_name, 'test',
+                                            client=mongomock.MongoClient())
+        self.collection.service = self.service
+
+
+class AsyncMongoDBCollectionTestCase(_BaseCollectionTestCase):
+
+    def setUp(self):
+        super(AsyncMongoDBCollectionTestCase, self).setUp()
+        self.executor = ThreadPoolExecutor(4)
+        self.collection = AsyncMongoDBCollection(
+            self.resource_name, 'test', client=mongomock.MongoClient(),
+            max_concurrency=2, executor=self.executor)
+        self.collection.service = self.service
+
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+
+    @_async_test
+    def test_concurrency_limit(self):
+        for i in range(10):
+            yield from self._create({'field1': i}, 'UUID-%d' % i)
+
+        requests = [self.collection.on_message(action='get',
+                                               resource_id='UUID-%d' % i)
+                    for i in range(10)]
+        results = yield from asyncio.gather(*requests, loop=self.loop)
+        self.assertEqual([result['resource_data'] for result in results],
+                         [{'field1': i} for i in range(10)])
+
+        stats = self.collection.stats()
+        self.assertEqual(stats['calls'], 20)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['queued'], 0)
+        # Two gets run while the others wait
+        self.assertEqual(stats['max_queued'], 8)
+
+
 class MongoDBTestCase(TestCase):
 
     def setUp(self):
@@ -15,6 +15,7 @@ except ImportError:
 
 from zeroservices.medium.zeromq import ZeroMQMedium
 from zeroservices.discovery import MemoryDiscoveryMedium
+from zeroservices.exceptions import RequestTimeout
 from .utils import generate_zeromq_medium
 from ..utils import TestCase, _async_test
 
@@ -75,6 +76,21 @@ class _BaseMediumTestCase(TestCase):
         self.assertEqual(on_message.call_count, 1)
         on_message.assert_called_with(message_type=message_type, **message)
 
+    @_async_test
+    def test_leave(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        service_2 = self.medium_2.service
+        service_2.on_peer_leave = Mock()
+        node_info = service_2.get_directory()[self.medium_1.node_id]
+        yield from self.medium_1.send_leave()
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        # Called with the info the node registered with
+        service_2.on_peer_leave.assert_called_once_with(node_info)
+        self.assertEqual(self.medium_2.get_directory(), {})
+        self.assertEqual(service_2.get_directory(), {})
+
     @_async_test
     def test_send_response(self):
         yield from asyncio.sleep(0.1, loop=self.loop)
@@ -90,6 +106,95 @@ class _BaseMediumTestCase(TestCase):
 
         self.assertEqual(result, return_value)
 
+    @_async_test
+    def test_send_timeout(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        @asyncio.coroutine
+        def on_message(message_type, delay):
+            yield from asyncio.sleep(delay, loop=self.loop)
+            return {'delay': delay}
+
+        self.medium_2.on_message_callback = on_message
+
+        with self.assertRaises(RequestTimeout):
+            yield from self.medium_1.send(self.medium_2.node_id,
+                                          {'delay': 0.5}, timeout=0.05)
+
+        result = yield from self.medium_1.send(self.medium_2.node_id,
+                                               {'delay': 0}, timeout=0.5)
+        self.assertEqual(result, {'delay': 0})
+
+    @_async_test
+    def test_codec_negotiation(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        codec = self.medium_1.get_codec(self.medium_2.node_id)
+        self.assertEqual(codec.name, self.medium_1.codecs[0])
+        self.assertEqual(self.medium_1.get_publish_codec().name,
+                         self.medium_1.codecs[0])
+
+    @_async_test
+    def test_codec_fallback(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        # Peer which doesn't advertise any codec
+        del self.medium_1.directory[self.medium_2.node_id]['codecs']
+        self.medium_1.peer_codecs = {}
+        self.medium_1._publish_codec = None
+
+        self.assertEqual(self.medium_1.get_codec(self.medium_2.node_id).name,
+                         'json')
+        self.assertEqual(self.medium_1.get_publish_codec().name, 'json')
+
+        return_value = {'data': 'ReturnValue'}
+        self.medium_2.service.on_message_mock.return_value = return_value
+
+        result = yield from self.medium_1.send(self.medium_2.node_id,
+                                               {'foo': 'bar'})
+        self.assertEqual(result, return_value)
+
+    @_async_test
+    def test_send_binary_frames(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        attachment = b'\x00\x01' * 100000
+        return_value = {'data': 'ReturnValue'}
+        on_message = self.medium_2.service.on_message_mock
+        on_message.return_value = return_value
+
+        message = {'attachments': [{'name': 'big', 'content': attachment},
+                                   {'name': 'small', 'content': b'abc'}]}
+        result = yield from self.medium_1.send(self.medium_2.node_id, message)
+        self.assertEqual(result, return_value)
+
+        received = on_message.call_args[1]['attachments']
+        self.assertIsInstance(received[0]['content'], memoryview)
+        self.assertEqual(received[0]['content'], attachment)
+        self.assertEqual(received[1]['content'], b'abc')
+
+        # The original message is left untouched
+        self.assertIs(message['attachments'][0]['content'], attachment)
+
+    @_async_test
+    def test_send_binary_frames_placeholder_data(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        attachment = b'\x00\x01' * 100000
+        on_message = self.medium_2.service.on_message_mock
+        on_message.return_value = {'data': 'ReturnValue'}
+
+        # Data looking like the placeholder of a frame is sent as it is
+        message = {'content': attachment, 'meta': {'$frame': 0},
+                   'other': [{'$frame': 3}, {'$escaped': {'$frame': 0}}]}
+        yield from self.medium_1.send(self.medium_2.node_id, message)
+
+        received = on_message.call_args[1]
+        self.assertEqual(received['content'], attachment)
+        self.assertEqual(received['meta'], {'$frame': 0})
+        self.assertEqual(received['other'],
+                         [{'$frame': 3}, {'$escaped': {'$frame': 0}}])
+
     @_async_test
     def test_pub_sub(self):
         yield from asyncio.sleep(0.1, loop=self.loop)
@@ -104,6 +209,31 @@ class _BaseMediumTestCase(TestCase):
         self.assertEqual(on_event.call_count, 1)
         on_event.assert_called_with(event_type, **event_data)
 
+    @_async_test
+    def test_pub_sub_topic_filter(self):
+        self.medium_2.subscribe('collection')
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        event_data = {'data': 'foo'}
+        for event_type in ('collection.create.1', 'other.create.1',
+                           'collectionbis.create.1', 'collection'):
+            yield from self.medium_1.publish(event_type, event_data)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        on_event = self.medium_2.service.on_event_mock
+        self.assertEqual(on_event.call_args_list,
+                         [call('collection.create.1', **event_data),
+                          call('collection', **event_data)])
+
+        # Unsubscribing from the last topic receives everything again
+        on_event.reset_mock()
+        self.medium_2.unsubscribe('collection')
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        yield from self.medium_1.publish('other.create.1', event_data)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+        self.assertEqual(on_event.call_count, 1)
+
     @_async_test
     def test_pub_sub_custom_event_listener(self):
         yield from asyncio.sleep(0.1, loop=self.loop)
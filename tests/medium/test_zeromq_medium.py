@@ -3,6 +3,7 @@ import json
 import time
 import socket
 import asyncio
+import unittest
 
 from datetime import timedelta
 from time import sleep, time
@@ -14,6 +15,7 @@ except ImportError:
 
 from zeroservices.medium.zeromq import ZeroMQMedium
 from zeroservices.discovery import MemoryDiscoveryMedium
+from zeroservices.exceptions import RequestTimeout
 from .utils import generate_zeromq_medium
 from ..utils import TestCase, _async_test, TestService
 
@@ -29,6 +31,308 @@ class ZeroMQMediumTestCase(_BaseMediumTestCase):
         yield from medium.start()
         return medium
 
+    @_async_test
+    def test_send_reuse_connection(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        return_value = {'data': 'ReturnValue'}
+        self.medium_2.service.on_message_mock.return_value = return_value
+
+        for _ in range(3):
+            result = yield from self.medium_1.send(self.medium_2.node_id,
+                                                   {'foo': 'bar'})
+            self.assertEqual(result, return_value)
+
+        # The registration answer opened the connection, requests reuse it
+        self.assertEqual(self.medium_1.pool.stats(),
+                         {'size': 1, 'pending': 0, 'hits': 3, 'misses': 1,
+                          'evictions': 0})
+
+    @_async_test
+    def test_binary_frames_response_and_event(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        attachment = bytearray(b'\xff' * 100000)
+        return_value = {'content': attachment}
+        self.medium_2.service.on_message_mock.return_value = return_value
+
+        result = yield from self.medium_1.send(self.medium_2.node_id,
+                                               {'foo': 'bar'})
+        self.assertIsInstance(result['content'], memoryview)
+        self.assertEqual(result['content'], attachment)
+        # A view on the received libzmq buffer, not on a copy
+        self.assertIsInstance(result['content'].obj, zmq.Frame)
+
+        yield from self.medium_1.publish('EVENT_TYPE',
+                                         {'content': memoryview(attachment)})
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        on_event = self.medium_2.service.on_event_mock
+        self.assertEqual(on_event.call_args[1]['content'], attachment)
+        self.assertIsInstance(on_event.call_args[1]['content'].obj,
+                              zmq.Frame)
+
+    @_async_test
+    def test_publisher_side_filtering(self):
+        self.medium_2.subscribe('collection')
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        self.assertEqual(self.medium_2.sub.subscriptions(), {b'collection'})
+        self.assertEqual(self.medium_1.pub_t.subscriptions, {b'collection'})
+
+        # Events without subscriber are not sent
+        yield from self.medium_1.publish('other.create.1', {'data': 'foo'})
+        self.assertEqual(self.medium_1.skipped_events, 1)
+
+        yield from self.medium_1.publish('collection.create.1', {})
+        self.assertEqual(self.medium_1.skipped_events, 1)
+
+    @_async_test
+    def test_publish_many(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        events = [('collection.create.%d' % i, {'index': i})
+                  for i in range(10)]
+        yield from self.medium_1.publish_many(events)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        # Sent as one batch even without batch window
+        self.assertEqual(self.medium_1.batches, 1)
+
+        on_event = self.medium_2.service.on_event_mock
+        self.assertEqual(on_event.call_args_list,
+                         [call(event_type, **event_data) for
+                          event_type, event_data in events])
+
+    @_async_test
+    def test_send_concurrent_out_of_order(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        @asyncio.coroutine
+        def on_message(message_type, delay, value):
+            yield from asyncio.sleep(delay, loop=self.loop)
+            return {'value': value}
+
+        self.medium_2.on_message_callback = on_message
+
+        # First requests are answered last
+        requests = [self.medium_1.send(self.medium_2.node_id,
+                                       {'delay': 0.05 * (5 - i), 'value': i})
+                    for i in range(5)]
+        results = yield from asyncio.gather(*requests, loop=self.loop)
+
+        self.assertEqual(results, [{'value': i} for i in range(5)])
+        self.assertEqual(self.medium_1.pool.size, 1)
+        self.assertEqual(self.medium_1.pool.pending, 0)
+
+    @_async_test
+    def test_send_timeout_discard_connection(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        @asyncio.coroutine
+        def on_message(message_type, delay):
+            yield from asyncio.sleep(delay, loop=self.loop)
+            return {'delay': delay}
+
+        self.medium_2.on_message_callback = on_message
+
+        slow = asyncio.async(self.medium_1.send(self.medium_2.node_id,
+                                                {'delay': 0.2}),
+                             loop=self.loop)
+        with self.assertRaises(RequestTimeout):
+            yield from self.medium_1.send(self.medium_2.node_id,
+                                          {'delay': 0.1}, timeout=0.05)
+
+        # Another request still waits on the connection
+        self.assertEqual(self.medium_1.pool.size, 1)
+        self.assertEqual(self.medium_1.pool.pending, 1)
+
+        result = yield from slow
+        self.assertEqual(result, {'delay': 0.2})
+
+        with self.assertRaises(RequestTimeout):
+            yield from self.medium_1.send(self.medium_2.node_id,
+                                          {'delay': 0.1}, timeout=0.05)
+
+        self.assertEqual(self.medium_1.pool.size, 0)
+        self.assertEqual(self.medium_1.pool.pending, 0)
+
+    @_async_test
+    def test_pool_evict_idle_connections(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        self.medium_2.service.on_message_mock.return_value = {}
+        yield from self.medium_1.send(self.medium_2.node_id, {'foo': 'bar'})
+        self.assertEqual(self.medium_1.pool.size, 1)
+
+        self.medium_1.pool.max_idle_time = 0
+        self.medium_1.pool.evict()
+
+        self.assertEqual(self.medium_1.pool.size, 0)
+        self.assertEqual(self.medium_1.pool.evictions, 1)
+
+        # A new connection is opened on next send
+        yield from self.medium_1.send(self.medium_2.node_id, {'foo': 'bar'})
+        self.assertEqual(self.medium_1.pool.misses, 2)
+
+    @_async_test
+    def test_colocated_transport(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        self.medium_2.service.on_message_mock.return_value = {}
+        yield from self.medium_1.send(self.medium_2.node_id, {'foo': 'bar'})
+
+        # Both mediums live in this process
+        self.assertEqual(list(self.medium_1.pool.connections),
+                         [self.medium_2.endpoints['inproc']['server']])
+
+
+class ZeroMQIpcMediumTestCase(ZeroMQMediumTestCase):
+
+    @asyncio.coroutine
+    def get_medium(self, loop):
+        medium = ZeroMQMedium(loop=loop, discovery_class=MemoryDiscoveryMedium,
+                              transports=('ipc',))
+        medium.set_service(TestService('test_service', medium))
+        yield from medium.start()
+        return medium
+
+    @_async_test
+    def test_colocated_transport(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        self.medium_2.service.on_message_mock.return_value = {}
+        yield from self.medium_1.send(self.medium_2.node_id, {'foo': 'bar'})
+
+        self.assertEqual(list(self.medium_1.pool.connections),
+                         [self.medium_2.endpoints['ipc']['server']])
+
+
+class ZeroMQTcpMediumTestCase(ZeroMQMediumTestCase):
+
+    @asyncio.coroutine
+    def get_medium(self, loop):
+        medium = ZeroMQMedium(loop=loop, discovery_class=MemoryDiscoveryMedium,
+                              transports=('tcp',))
+        medium.set_service(TestService('test_service', medium))
+        yield from medium.start()
+        return medium
+
+    @_async_test
+    def test_colocated_transport(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        self.medium_2.service.on_message_mock.return_value = {}
+        yield from self.medium_1.send(self.medium_2.node_id, {'foo': 'bar'})
+
+        server_port = self.medium_2.get_node_info()['server_port']
+        self.assertEqual(list(self.medium_1.pool.connections),
+                         ['tcp://127.0.0.1:%d' % server_port])
+        self.assertEqual(self.medium_2.endpoints, {})
+
+
+class ZeroMQBatchingMediumTestCase(ZeroMQMediumTestCase):
+
+    @asyncio.coroutine
+    def get_medium(self, loop):
+        medium = ZeroMQMedium(loop=loop, discovery_class=MemoryDiscoveryMedium,
+                              batch_window=0.01, batch_size=50)
+        medium.set_service(TestService('test_service', medium))
+        yield from medium.start()
+        return medium
+
+    @_async_test
+    def test_batch_keep_order(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        events = [('collection.create.%d' % i, {'index': i})
+                  for i in range(120)]
+        for event_type, event_data in events:
+            yield from self.medium_1.publish(event_type, event_data)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        # Two full batches then the rest after the window
+        self.assertEqual(self.medium_1.batches, 3)
+
+        on_event = self.medium_2.service.on_event_mock
+        self.assertEqual(on_event.call_args_list,
+                         [call(event_type, **event_data) for
+                          event_type, event_data in events])
+
+    @_async_test
+    def test_batch_split_on_subscriptions(self):
+        self.medium_2.subscribe('collection.create')
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        events = [('collection.create.1', {'index': 1}),
+                  ('collection.create.2', {'index': 2}),
+                  ('collection.patch.1', {'index': 3}),
+                  ('collection.create.3', {'index': 4})]
+        for event_type, event_data in events:
+            yield from self.medium_1.publish(event_type, event_data)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        # The patch event has no subscriber
+        self.assertEqual(self.medium_1.skipped_events, 1)
+
+        on_event = self.medium_2.service.on_event_mock
+        self.assertEqual(on_event.call_args_list,
+                         [call('collection.create.1', index=1),
+                          call('collection.create.2', index=2),
+                          call('collection.create.3', index=4)])
+
+
+class ZeroMQHighWaterMarkTestCase(ZeroMQMediumTestCase):
+
+    hwm_policy = 'block'
+
+    @asyncio.coroutine
+    def get_medium(self, loop):
+        socket_options = {'*': {'linger': 0},
+                          'pub': {'sndhwm': 10, 'sndbuf': 4096},
+                          'sub': {'rcvhwm': 10, 'rcvbuf': 4096}}
+        medium = ZeroMQMedium(loop=loop, discovery_class=MemoryDiscoveryMedium,
+                              socket_options=socket_options,
+                              hwm_policy=self.hwm_policy)
+        medium.set_service(TestService('test_service', medium))
+        yield from medium.start()
+        return medium
+
+    def test_socket_options(self):
+        self.assertEqual(self.medium_1.pub.getsockopt(zmq.SNDHWM), 10)
+        self.assertEqual(self.medium_1.pub.getsockopt(zmq.LINGER), 0)
+        self.assertEqual(self.medium_1.sub.getsockopt(zmq.RCVHWM), 10)
+        self.assertEqual(self.medium_1.server.getsockopt(zmq.SNDHWM), 1000)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ZeroMQMedium(self.loop, MemoryDiscoveryMedium, hwm_policy='foo')
+
+    @_async_test
+    def test_publish_burst(self):
+        yield from asyncio.sleep(0.1, loop=self.loop)
+
+        event_data = {'content': b'x' * 100000}
+        for i in range(200):
+            yield from self.medium_1.publish('EVENT_TYPE', event_data)
+
+        for _ in range(20):
+            yield from asyncio.sleep(0.05, loop=self.loop)
+
+        on_event = self.medium_2.service.on_event_mock
+        stats = self.medium_1.stats()
+        self.assertEqual(on_event.call_count + stats['dropped_events'], 200)
+
+        if self.hwm_policy == 'block':
+            self.assertEqual(stats['dropped_events'], 0)
+        else:
+            self.assertGreater(stats['dropped_events'], 0)
+
+
+class ZeroMQDropHighWaterMarkTestCase(ZeroMQHighWaterMarkTestCase):
+
+    hwm_policy = 'drop'
+
 
 if __name__ == '__main__':
     unittest.main()
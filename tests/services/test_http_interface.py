@@ -156,6 +156,18 @@ class HttpInterfaceCollectionTestCase(HttpInterfaceTestCase):
         response = yield from result.json()
         self.assertEqual(response, [self.resource])
 
+    @_async_test
+    def test_list_bad_arguments(self):
+        for query in ('?limit=abc', '?limit=0', '?after=notjson',
+                      '?after=1'):
+            result = yield from self.get(self.url + query)
+
+            self.assertEqual(result.status, 400)
+            self.assertEqual(result.headers["Content-Type"],
+                             "application/json")
+            response = yield from result.json()
+            self.assertIn('error', response)
+
     @_async_test
     def test_list_on_unknown_collection(self):
         result = yield from self.get(self.collection_bad_url)
@@ -0,0 +1,87 @@
+from zeroservices.cache import ResourceCache
+from .utils import TestCase
+
+
+def _resource(resource_id, value=None):
+    return {'resource_id': resource_id, 'resource_data': {'value': value}}
+
+
+class ResourceCacheTestCase(TestCase):
+
+    def test_get_put(self):
+        cache = ResourceCache()
+        key = ('collection', 'id1')
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, _resource('id1'))
+        self.assertEqual(cache.get(key), _resource('id1'))
+
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_values_are_copied(self):
+        cache = ResourceCache()
+        key = ('collection', 'id1')
+
+        value = _resource('id1', 1)
+        cache.put(key, value)
+        value['resource_data']['value'] = 2
+
+        result = cache.get(key)
+        result['resource_data']['value'] = 3
+        self.assertEqual(cache.get(key), _resource('id1', 1))
+
+    def test_lru_eviction(self):
+        cache = ResourceCache(max_entries=2)
+        cache.put(('c', 'id1'), _resource('id1'))
+        cache.put(('c', 'id2'), _resource('id2'))
+
+        # id1 becomes the most recently used
+        cache.get(('c', 'id1'))
+        cache.put(('c', 'id3'), _resource('id3'))
+
+        self.assertIn(('c', 'id1'), cache)
+        self.assertNotIn(('c', 'id2'), cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        cache = ResourceCache(max_bytes=200)
+        for i in range(10):
+            cache.put(('c', 'id%d' % i), _resource('id%d' % i, 'x' * 20))
+            self.assertLessEqual(cache.size, 200)
+        self.assertIn(('c', 'id9'), cache)
+        self.assertLess(len(cache), 10)
+
+        # Too large to ever fit
+        cache.put(('c', 'big'), _resource('big', 'x' * 500))
+        self.assertNotIn(('c', 'big'), cache)
+
+    def test_invalidate(self):
+        cache = ResourceCache()
+        cache.put(('c', 'id1'), _resource('id1'))
+        cache.put(('other', 'id1'), _resource('id1'))
+
+        cache.invalidate(('c', 'id1'))
+        self.assertNotIn(('c', 'id1'), cache)
+
+        cache.update(('c', 'id1'), _resource('id1', 1))
+        self.assertNotIn(('c', 'id1'), cache)
+        cache.update(('other', 'id1'), _resource('id1', 1))
+        self.assertEqual(cache.get(('other', 'id1')), _resource('id1', 1))
+
+        cache.invalidate_collection('other')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_invalidated_during_fetch(self):
+        cache = ResourceCache()
+        key = ('c', 'id1')
+
+        cache.fetch_started(key)
+        cache.invalidate(key)
+        cache.put(key, _resource('id1'))
+        self.assertNotIn(key, cache)
+
+        cache.fetch_started(key)
+        cache.put(key, _resource('id1'))
+        self.assertIn(key, cache)
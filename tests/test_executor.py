@@ -0,0 +1,110 @@
+import asyncio
+
+from zeroservices.executor import RuleExecutor
+from zeroservices.resources import Rule
+from .utils import TestCase, _async_test
+
+
+class RuleExecutorTestCase(TestCase):
+
+    def setUp(self):
+        asyncio.set_event_loop(None)
+        self.loop = asyncio.new_event_loop()
+        self.calls = []
+        self.running = []
+        self.max_running = 0
+
+    def tearDown(self):
+        self.loop.stop()
+        self.loop.close()
+
+    def make_rule(self, concurrency=None):
+        @asyncio.coroutine
+        def callback(key, value, delay=0.01):
+            self.running.append(key)
+            self.max_running = max(self.max_running, len(self.running))
+            yield from asyncio.sleep(delay, loop=self.loop)
+            self.running.remove(key)
+            self.calls.append((key, value))
+        return Rule(callback, {}, concurrency)
+
+    @_async_test
+    def test_concurrency(self):
+        executor = RuleExecutor(3, loop=self.loop)
+        rule = self.make_rule()
+
+        for i in range(10):
+            yield from executor.submit(i, rule, i, 'value')
+        self.assertEqual(executor.stats()['in_flight'], 3)
+        self.assertEqual(executor.stats()['queued'], 7)
+
+        yield from executor.join()
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual(len(self.calls), 10)
+        self.assertEqual(executor.stats(), {'queued': 0, 'in_flight': 0,
+                                            'rules_in_flight': {}})
+
+    @_async_test
+    def test_per_key_order(self):
+        executor = RuleExecutor(10, loop=self.loop)
+        rule = self.make_rule()
+
+        # The first job of key 'a' is the slowest
+        yield from executor.submit('a', rule, 'a', 1, 0.03)
+        yield from executor.submit('b', rule, 'b', 1)
+        yield from executor.submit('a', rule, 'a', 2, 0)
+        yield from executor.submit('a', rule, 'a', 3, 0)
+        yield from executor.join()
+
+        self.assertEqual([value for key, value in self.calls if key == 'a'],
+                         [1, 2, 3])
+        # Key b didn't wait for key a
+        self.assertEqual(self.calls[0], ('b', 1))
+
+    @_async_test
+    def test_rule_concurrency(self):
+        executor = RuleExecutor(10, loop=self.loop)
+        slow_rule = self.make_rule(concurrency=1)
+        rule = self.make_rule()
+
+        for i in range(3):
+            yield from executor.submit(('slow', i), slow_rule, 'slow', i)
+        for i in range(3):
+            yield from executor.submit(('other', i), rule, 'other', i)
+        self.assertEqual(executor.stats()['in_flight'], 4)
+
+        yield from executor.join()
+        self.assertEqual(len(self.calls), 6)
+
+    @_async_test
+    def test_max_queue(self):
+        executor = RuleExecutor(1, max_queue=2, loop=self.loop)
+        rule = self.make_rule()
+
+        for i in range(3):
+            yield from executor.submit(i, rule, i, 'value')
+
+        # The queue is full, submit waits for a job to start
+        submit = asyncio.async(executor.submit(3, rule, 3, 'value'),
+                               loop=self.loop)
+        yield from asyncio.sleep(0, loop=self.loop)
+        self.assertFalse(submit.done())
+        self.assertEqual(executor.stats()['queued'], 2)
+
+        yield from submit
+        yield from executor.join()
+        self.assertEqual([key for key, _ in self.calls], [0, 1, 2, 3])
+
+    @_async_test
+    def test_failing_rule(self):
+        executor = RuleExecutor(2, loop=self.loop)
+
+        @asyncio.coroutine
+        def fail(*args):
+            raise ValueError()
+
+        yield from executor.submit('a', Rule(fail, {}), 'a')
+        yield from executor.submit('a', self.make_rule(), 'a', 1)
+        yield from executor.join()
+
+        self.assertEqual(self.calls, [('a', 1)])
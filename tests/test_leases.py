@@ -0,0 +1,58 @@
+from zeroservices.leases import Leases
+from .utils import TestCase
+
+
+class LeasesTestCase(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.leases = Leases(clock=lambda: self.now)
+
+    def test_claim(self):
+        lease = self.leases.claim('id1', 'worker1', 10)
+        self.assertTrue(lease['claimed'])
+        self.assertEqual(self.leases.get('id1'), 'worker1')
+
+        self.assertEqual(self.leases.claim('id1', 'worker2', 10),
+                         {'claimed': False, 'owner': 'worker1'})
+
+        # The owner renews its lease
+        renewed = self.leases.claim('id1', 'worker1', 10)
+        self.assertTrue(renewed['claimed'])
+        self.assertNotEqual(renewed['token'], lease['token'])
+
+        self.assertEqual(self.leases.stats(),
+                         {'leases': 1, 'claims': 1, 'renewals': 1,
+                          'conflicts': 1, 'releases': 0, 'expirations': 0})
+
+    def test_expiration(self):
+        self.leases.claim('id1', 'worker1', 10)
+
+        self.now = 10
+        self.assertIsNone(self.leases.get('id1'))
+        self.assertTrue(self.leases.claim('id1', 'worker2', 10)['claimed'])
+        self.assertEqual(self.leases.stats()['expirations'], 1)
+
+    def test_release(self):
+        lease = self.leases.claim('id1', 'worker1', 10)
+        renewed = self.leases.claim('id1', 'worker1', 10)
+
+        # Only the latest claim releases the lease
+        self.assertFalse(self.leases.release('id1', 'worker1',
+                                             lease['token']))
+        self.assertFalse(self.leases.release('id1', 'worker2',
+                                             renewed['token']))
+        self.assertTrue(self.leases.release('id1', 'worker1',
+                                            renewed['token']))
+        self.assertIsNone(self.leases.get('id1'))
+
+    def test_purge(self):
+        self.leases.purge_interval = 5
+        self.leases.purge()
+        for i in range(4):
+            self.leases.claim('id%d' % i, 'worker1', 1)
+
+        self.now = 2
+        self.leases.claim('other', 'worker1', 1)
+        self.assertEqual(len(self.leases), 1)
+        self.assertEqual(self.leases.stats()['expirations'], 4)
@@ -0,0 +1,209 @@
+from zeroservices import query
+from zeroservices.query import (match, compile_query, canonical, paginate,
+                                SortValue, project, extend_projection)
+from .utils import TestCase
+
+
+class MatchTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = {
+            'name': 'foo', 'size': 42, 'tags': ['a', 'b'], 'empty': None,
+            'nested': {'level': 1, 'deep': {'value': 'x'}},
+            '_links': {'owner': [{'target_id': ['user', 'u1'],
+                                  'title': 'first'},
+                                 {'target_id': ['user', 'u2'],
+                                  'title': 'second'}]},
+        }
+
+    def assertMatch(self, where):
+        self.assertTrue(match(where, self.resource), where)
+
+    def assertNotMatch(self, where):
+        self.assertFalse(match(where, self.resource), where)
+
+    def test_equality(self):
+        self.assertMatch({})
+        self.assertMatch({'name': 'foo', 'size': 42})
+        self.assertNotMatch({'name': 'foo', 'size': 41})
+        self.assertMatch({'empty': None})
+        self.assertMatch({'missing': None})
+        self.assertMatch({'nested': {'level': 1, 'deep': {'value': 'x'}}})
+        self.assertNotMatch({'nested': {'level': 1}})
+
+    def test_arrays(self):
+        self.assertMatch({'tags': 'a'})
+        self.assertMatch({'tags': ['a', 'b']})
+        self.assertMatch({'tags': ('a', 'b')})
+        self.assertNotMatch({'tags': ['b', 'a']})
+        self.assertNotMatch({'tags': 'c'})
+
+    def test_dotted_path(self):
+        self.assertMatch({'nested.level': 1})
+        self.assertMatch({'nested.deep.value': 'x'})
+        self.assertNotMatch({'nested.deep.other': 'x'})
+        self.assertNotMatch({'name.first': 'foo'})
+
+    def test_comparison(self):
+        self.assertMatch({'size': {'$gt': 41, '$lte': 42}})
+        self.assertNotMatch({'size': {'$gt': 42}})
+        self.assertMatch({'size': {'$gte': 42, '$lt': 43}})
+        self.assertNotMatch({'size': {'$lt': 'a'}})
+        self.assertNotMatch({'missing': {'$gt': 0}})
+        self.assertMatch({'size': {'$eq': 42}})
+
+    def test_ne_in(self):
+        self.assertMatch({'size': {'$ne': 41}})
+        self.assertNotMatch({'size': {'$ne': 42}})
+        self.assertNotMatch({'tags': {'$ne': 'a'}})
+        self.assertMatch({'size': {'$in': [1, 42]}})
+        self.assertMatch({'tags': {'$in': ['c', 'b']}})
+        self.assertNotMatch({'size': {'$in': []}})
+        self.assertMatch({'size': {'$nin': [1, 2]}})
+        self.assertNotMatch({'name': {'$nin': ['foo']}})
+
+    def test_exists(self):
+        self.assertMatch({'empty': {'$exists': True}})
+        self.assertMatch({'missing': {'$exists': False}})
+        self.assertNotMatch({'missing': {'$exists': True}})
+        self.assertMatch({'nested.deep': {'$exists': True}})
+
+    def test_elem_match(self):
+        # The query built by query_incoming
+        self.assertMatch({'_links.owner': {'$elemMatch': {
+            'target_id': ('user', 'u2')}}})
+        self.assertNotMatch({'_links.owner': {'$elemMatch': {
+            'target_id': ('user', 'u3')}}})
+        self.assertMatch({'_links.owner': {'$elemMatch': {
+            'target_id': ('user', 'u1'), 'title': 'first'}}})
+        self.assertNotMatch({'_links.owner': {'$elemMatch': {
+            'target_id': ('user', 'u1'), 'title': 'second'}}})
+        self.assertMatch({'tags': {'$elemMatch': {'$gt': 'a'}}})
+        self.assertNotMatch({'name': {'$elemMatch': {'$gt': 'a'}}})
+
+    def test_and_or(self):
+        self.assertMatch({'$or': [{'size': 1}, {'name': 'foo'}]})
+        self.assertNotMatch({'$or': [{'size': 1}, {'name': 'bar'}]})
+        self.assertMatch({'$and': [{'size': {'$gt': 1}},
+                                   {'$or': [{'tags': 'z'}, {'tags': 'b'}]}]})
+        self.assertNotMatch({'$and': [{'size': 42}, {'name': 'bar'}]})
+
+    def test_unknown_operator(self):
+        with self.assertRaises(ValueError):
+            compile_query({'size': {'$foo': 1}})
+
+
+class CompileQueryTestCase(TestCase):
+
+    def test_canonical(self):
+        self.assertEqual(canonical({'a': 1, 'b': {'c': [1, 2]}}),
+                         canonical({'b': {'c': (1, 2)}, 'a': 1}))
+        self.assertNotEqual(canonical({'a': 1}), canonical({'a': True}))
+        self.assertNotEqual(canonical({'a': 1}), canonical({'a': '1'}))
+
+    def test_cache(self):
+        matcher = compile_query({'a': 1, 'b': 2})
+        self.assertIs(compile_query({'b': 2, 'a': 1}), matcher)
+        self.assertIsNot(compile_query({'a': 1}), matcher)
+
+    def test_cache_query_changed(self):
+        where = {'tags': ['a']}
+        matcher = compile_query(where)
+
+        where['tags'].append('b')
+        self.assertIsNot(compile_query(where), matcher)
+        self.assertTrue(matcher({'tags': ['a']}))
+
+    def test_cache_size(self):
+        query._query_cache.clear()
+        for i in range(query.QUERY_CACHE_SIZE + 10):
+            compile_query({'index': i})
+        self.assertEqual(len(query._query_cache), query.QUERY_CACHE_SIZE)
+
+
+class PaginateTestCase(TestCase):
+
+    def setUp(self):
+        values = [3, None, 'b', 1, 'a', [1], 2.5, {'a': 1}]
+        self.resources = [{'resource_id': 'id-%d' % i,
+                           'resource_data': {'value': value}} for
+                          i, value in enumerate(values)]
+        self.resources.append({'resource_id': 'id-missing',
+                               'resource_data': {}})
+
+    def values(self, resources):
+        return [resource['resource_data'].get('value', 'missing') for
+                resource in resources]
+
+    def test_sort_value(self):
+        values = [SortValue(value) for value in ['a', 2, None, 1.5, [1]]]
+        self.assertEqual([value.value for value in sorted(values)],
+                         [None, 1.5, 2, 'a', repr(canonical([1]))])
+        self.assertLess(SortValue(2, True), SortValue(1, True))
+
+    def test_paginate_mixed_types(self):
+        result = paginate(self.resources, 'value')
+        self.assertEqual(self.values(result),
+                         [None, 'missing', 1, 2.5, 3, 'a', 'b', {'a': 1},
+                          [1]])
+
+        result = paginate(self.resources, '-value')
+        self.assertEqual(self.values(result)[:5],
+                         [[1], {'a': 1}, 'b', 'a', 3])
+
+    def test_paginate_pages(self):
+        values = []
+        after = None
+        while True:
+            page = paginate(self.resources, 'value', limit=2, after=after)
+            values.extend(self.values(page['resources']))
+            after = page['cursor']
+            if after is None:
+                break
+        self.assertEqual(values, self.values(paginate(self.resources,
+                                                      'value')))
+
+    def test_paginate_bad_limit(self):
+        for limit in (0, -1, '2'):
+            with self.assertRaises(ValueError):
+                paginate(self.resources, 'value', limit=limit)
+
+    def test_paginate_bad_cursor(self):
+        with self.assertRaises(ValueError):
+            paginate(self.resources, ['value'], limit=2, after=['id-1'])
+
+
+class ProjectTestCase(TestCase):
+
+    def setUp(self):
+        self.resource_data = {'name': 'foo', 'size': 42,
+                              'nested': {'a': 1, 'b': 2},
+                              '_links': {'owner': [1, 2, 3]}}
+
+    def test_keep_fields(self):
+        self.assertEqual(project(self.resource_data, ['name', 'nested.b',
+                                                      'missing']),
+                         {'name': 'foo', 'nested': {'b': 2}})
+        self.assertEqual(project(self.resource_data, []), {})
+        self.assertIs(project(self.resource_data, None), self.resource_data)
+
+    def test_drop_fields(self):
+        result = project(self.resource_data, ['-_links', '-nested.a',
+                                              '-missing.field'])
+        self.assertEqual(result, {'name': 'foo', 'size': 42,
+                                  'nested': {'b': 2}})
+
+        # The resource is left untouched
+        self.assertEqual(self.resource_data['nested'], {'a': 1, 'b': 2})
+        self.assertIn('_links', self.resource_data)
+
+    def test_mixed_fields(self):
+        with self.assertRaises(ValueError):
+            project(self.resource_data, ['name', '-size'])
+
+    def test_extend_projection(self):
+        self.assertEqual(extend_projection(['name'], ['size', 'name']),
+                         ['name', 'size'])
+        self.assertEqual(extend_projection(['-size', '-_links'], ['size']),
+                         ['-_links'])
+        self.assertIsNone(extend_projection(['-size'], ['size']))
@@ -1,12 +1,19 @@
 import sys
+import time
 import asyncio
 import unittest
 
 from zeroservices import ResourceService, ResourceCollection, ResourceWorker
 from zeroservices.resources import NoActionHandler, is_callable, Resource
-from zeroservices.exceptions import UnknownService, ResourceException
+from zeroservices.exceptions import (UnknownService, ResourceException,
+                                     RequestTimeout, ServiceUnavailable)
 from zeroservices.discovery.memory import MemoryDiscoveryMedium
-from .utils import test_medium, sample_collection, TestCase, _create_test_resource_service, _async_test
+from zeroservices.query import follow_links, follow_links_many
+from zeroservices.cache import ResourceCache
+from zeroservices.medium.memory import MemoryMedium
+from .utils import (test_medium, sample_collection, TestCase,
+                    _create_test_resource_service, _async_test,
+                    TestCollection, TestResourceService)
 from copy import deepcopy
 
 
@@ -115,6 +122,556 @@ class ResourceServiceTestCase(TestCase):
             [{'resource_data': self.resource_data,
               'resource_id': self.resource_id}])
 
+    @_async_test
+    def test_resource_send_many(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        in_flight = []
+
+        @is_callable
+        def slow(collection, index):
+            in_flight.append(index)
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            self.assertLessEqual(len(in_flight), 3)
+            in_flight.remove(index)
+            return index
+
+        with patch.object(TestCollection, 'slow', slow, create=True):
+            requests = [{'collection_name': self.resource, 'action': 'slow',
+                         'index': i} for i in range(10)]
+            requests.insert(4, {'collection_name': 'NotFound',
+                                'action': 'list'})
+            results = yield from self.service2.send_many(requests,
+                                                         max_concurrency=3)
+
+        self.assertEqual(results[:4] + results[5:], list(range(10)))
+        self.assertIsInstance(results[4], UnknownService)
+
+    @_async_test
+    def test_resource_send_coalesced(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        call_request = {'collection_name': self.resource, 'action': 'get',
+                        'resource_id': self.resource_id}
+        with patch.object(self.service2, 'send_to_node',
+                          wraps=self.service2.send_to_node) as send_to_node:
+            requests = [self.service2.send(**call_request) for _ in range(5)]
+            requests.append(self.service2.send(
+                collection_name=self.resource, action='list'))
+            results = yield from asyncio.gather(*requests, loop=self.loop)
+
+            # One request for the gets, one for the list
+            self.assertEqual(send_to_node.call_count, 2)
+            for result in results[1:5]:
+                self.assertIs(result, results[0])
+            self.assertEqual(results[0]['resource_data'], self.resource_data)
+            self.assertEqual(self.service2.in_flight, {})
+
+            # Writes are always sent
+            requests = [self.service2.send(
+                collection_name=self.resource, action='patch',
+                resource_id=self.resource_id,
+                patch={'$set': {'key': 'new'}}) for _ in range(2)]
+            yield from asyncio.gather(*requests, loop=self.loop)
+            self.assertEqual(send_to_node.call_count, 4)
+
+            # Finished requests aren't reused
+            result = yield from self.service2.send(**call_request)
+            self.assertEqual(result['resource_data']['key'], 'new')
+            self.assertEqual(send_to_node.call_count, 5)
+
+    @_async_test
+    def test_resource_send_coalesced_timeouts(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        @is_callable
+        def list(collection, **kwargs):
+            yield from asyncio.sleep(0.2, loop=self.loop)
+            return 'OK'
+
+        with patch.object(TestCollection, 'list', list):
+            # Requests with different timeouts aren't shared
+            requests = [self.service2.send(collection_name=self.resource,
+                                           action='list', timeout=0.05),
+                        self.service2.send(collection_name=self.resource,
+                                           action='list')]
+            results = yield from asyncio.gather(*requests, loop=self.loop,
+                                                return_exceptions=True)
+            self.assertIsInstance(results[0], RequestTimeout)
+            self.assertEqual(results[1], 'OK')
+
+            # Once its only waiter gave up, the request is cancelled
+            with self.assertRaises(RequestTimeout):
+                yield from self.service2.send(collection_name=self.resource,
+                                              action='list', timeout=0.05)
+            self.assertEqual(self.service2.in_flight, {})
+
+    @_async_test
+    def test_resource_send_coalesced_hung_node(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        deadlines = []
+
+        @is_callable
+        def list(collection, **kwargs):
+            yield from asyncio.sleep(1, loop=self.loop)
+            return 'OK'
+
+        medium = self.service1.medium
+        on_message = medium.on_message_callback
+
+        def record_deadline(**message):
+            deadlines.append(message.get('deadline'))
+            return on_message(**message)
+
+        call_request = {'collection_name': self.resource, 'action': 'list',
+                        'timeout': 0.05}
+        with patch.object(TestCollection, 'list', list), \
+                patch.object(medium, 'on_message_callback', record_deadline):
+            for _ in range(self.service2.max_failures):
+                requests = [self.service2.send(**call_request)
+                            for _ in range(2)]
+                results = yield from asyncio.gather(
+                    *requests, loop=self.loop, return_exceptions=True)
+                for result in results:
+                    self.assertIsInstance(result, RequestTimeout)
+
+        # One shared request each time, sent with its deadline
+        self.assertEqual(len(deadlines), self.service2.max_failures)
+        for deadline in deadlines:
+            self.assertIsNotNone(deadline)
+
+        # The hung node is skipped for a while
+        self.assertEqual(self.service2.node_failures[self.node_id1],
+                         self.service2.max_failures)
+        self.assertIn(self.node_id1, self.service2.failed_nodes)
+        self.assertEqual(self.service2.in_flight, {})
+
+    @_async_test
+    def test_resource_send_cancelled(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        @is_callable
+        def list(collection, **kwargs):
+            yield from asyncio.sleep(1, loop=self.loop)
+            return 'OK'
+
+        with patch.object(TestCollection, 'list', list):
+            # Giving up on a request without timeout counts as a failure
+            with self.assertRaises(asyncio.TimeoutError):
+                yield from asyncio.wait_for(
+                    self.service2.send(collection_name=self.resource,
+                                       action='list'),
+                    0.05, loop=self.loop)
+            # Let the shared request handle its cancellation
+            yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertEqual(self.service2.node_failures[self.node_id1], 1)
+        self.assertEqual(self.service2.in_flight, {})
+
+    @_async_test
+    def test_resource_send_cached(self):
+        self.service2.cache = ResourceCache()
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        call_request = {'collection_name': self.resource, 'action': 'get',
+                        'resource_id': self.resource_id}
+        with patch.object(self.service2, 'send_to_node',
+                          wraps=self.service2.send_to_node) as send_to_node:
+            expected = deepcopy(self.resource_data)
+            for _ in range(3):
+                result = yield from self.service2.send(**call_request)
+                self.assertEqual(result['resource_data'], expected)
+                # Editing a result doesn't change the cached resource
+                result['resource_data']['key2'] = 'edited'
+            self.assertEqual(send_to_node.call_count, 1)
+
+            # Projections are served from the cached resource
+            result = yield from self.service2.send(fields=['key'],
+                                                   **call_request)
+            self.assertEqual(result['resource_data'], {'key': 'value'})
+            self.assertEqual(send_to_node.call_count, 1)
+
+            # The patch event invalidates it
+            yield from self.service1.send(
+                collection_name=self.resource, action='patch',
+                resource_id=self.resource_id,
+                patch={'$set': {'key': 'new'}})
+            result = yield from self.service2.send(**call_request)
+            self.assertEqual(result['resource_data']['key'], 'new')
+            self.assertEqual(send_to_node.call_count, 2)
+
+            result = yield from self.service2.send(**call_request)
+            self.assertEqual(send_to_node.call_count, 2)
+
+            # A create event replaces it
+            new_data = {'key': 'created'}
+            yield from self.collection.on_message(
+                action='create', resource_id=self.resource_id,
+                resource_data=new_data)
+            result = yield from self.service2.send(**call_request)
+            self.assertEqual(result['resource_data'], new_data)
+            self.assertEqual(send_to_node.call_count, 2)
+
+            # Without the events of the collection, nothing is cached
+            self.service2.medium.subscribe('OtherResource')
+            yield from self.service2.send(**call_request)
+            yield from self.service2.send(**call_request)
+            self.assertEqual(send_to_node.call_count, 4)
+
+        stats = self.service2.cache.stats()
+        self.assertEqual(stats['hits'], 5)
+        self.assertEqual(stats['invalidations'], 1)
+
+    @_async_test
+    def test_follow_links_many(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        for i in range(3):
+            yield from self.service1.send(
+                collection_name=self.resource, action='create',
+                resource_id='target-%d' % i, resource_data={'index': i})
+
+        resources = []
+        for i in range(4):
+            resource = {'_links': {'latest': {
+                'target': [self.resource, 'target-%d' % (i % 3)]}}}
+            resources.append(resource)
+        resources.append({'_links': {'latest': {}}})
+
+        with patch.object(self.service2, 'send',
+                          wraps=self.service2.send) as send:
+            results = yield from follow_links_many(self.service2, resources,
+                                                   'target')
+
+        self.assertEqual(results[:4], [{'index': 0}, {'index': 1},
+                                       {'index': 2}, {'index': 0}])
+        self.assertIsInstance(results[4], KeyError)
+        # Each linked resource is fetched once
+        self.assertEqual(send.call_count, 3)
+
+        result = yield from follow_links(self.service2, resources[1],
+                                         'target')
+        self.assertEqual(result, {'index': 1})
+
+    @_async_test
+    def test_resource_send_load_balanced(self):
+        service3 = _create_test_resource_service("TestService3",
+                                                 loop=self.loop)
+        collection3 = sample_collection(self.resource)
+        service3.register_resource(collection3)
+        other_data = {'key': 'other'}
+        yield from collection3.on_message(action='create',
+                                          resource_id=self.resource_id,
+                                          resource_data=other_data)
+
+        yield from self.service1.start()
+        yield from service3.start()
+        yield from self.service2.start()
+
+        self.assertItemsEqual(self.service2.resources_directory[self.resource],
+                              [self.node_id1, service3.medium.node_id])
+
+        call_request = {'collection_name': self.resource, 'action': 'get',
+                        'resource_id': self.resource_id}
+        results = []
+        for _ in range(4):
+            result = yield from self.service2.send(**call_request)
+            results.append(result['resource_data'])
+
+        self.assertItemsEqual(results, [self.resource_data, other_data] * 2)
+        self.assertNotEqual(results[0], results[1])
+
+        # Peers forget a leaving node
+        yield from service3.leave()
+        self.assertEqual(self.service2.resources_directory[self.resource],
+                         [self.node_id1])
+        self.assertNotIn(service3.medium.node_id, self.service2.directory)
+        self.assertNotIn(service3.medium.node_id,
+                         self.service2.medium.directory)
+
+    @_async_test
+    def test_resource_send_failed_node(self):
+        service3 = _create_test_resource_service("TestService3",
+                                                 loop=self.loop)
+        service3.register_resource(sample_collection(self.resource))
+
+        yield from self.service1.start()
+        yield from service3.start()
+        yield from self.service2.start()
+
+        # A crashed node never says it leaves
+        service3.close()
+
+        call_request = {'collection_name': self.resource, 'action': 'list'}
+        failures = 0
+        for _ in range(10):
+            try:
+                yield from self.service2.send(**call_request)
+            except ServiceUnavailable:
+                failures += 1
+
+        # Skipped by routing after max_failures failed requests in a row
+        self.assertEqual(failures, self.service2.max_failures)
+        self.assertIn(service3.medium.node_id, self.service2.failed_nodes)
+
+        # Tried again once the cooldown is over
+        self.service2.failed_nodes[service3.medium.node_id] = 0
+        with self.assertRaises(ServiceUnavailable):
+            for _ in range(2):
+                yield from self.service2.send(**call_request)
+
+    @_async_test
+    def test_resource_send_sharded(self):
+        resource = 'ShardedResource'
+        services = []
+        for i in range(3):
+            service = _create_test_resource_service("Shard%d" % i,
+                                                    loop=self.loop)
+            service.register_resource(TestCollection(resource, sharded=True))
+            services.append(service)
+            yield from service.start()
+        yield from self.service2.start()
+
+        try:
+            # Shards are named after their services
+            ring = self.service2.shard_rings[resource]
+            self.assertEqual(ring.nodes, set(service.name for service in
+                                             services))
+
+            resource_ids = []
+            for i in range(30):
+                result = yield from self.service2.send(
+                    collection_name=resource, action='create',
+                    resource_data={'index': i})
+                resource_ids.append(result['resource_id'])
+
+            # Each resource lives in the shard owning its id only
+            for service in services:
+                collection = service.resources[resource]._collection
+                for resource_id in collection:
+                    self.assertEqual(ring.get_node(resource_id),
+                                     service.name)
+                self.assertGreater(len(collection), 0)
+
+            result = yield from self.service2.send(collection_name=resource,
+                                                   action='get',
+                                                   resource_id=resource_ids[5])
+            self.assertEqual(result['resource_data'], {'index': 5})
+
+            # A shard reaches the others and itself
+            result = yield from services[0].send(collection_name=resource,
+                                                 action='list',
+                                                 where={'index': 7})
+            self.assertEqual(result, [{'resource_id': resource_ids[7],
+                                       'resource_data': {'index': 7}}])
+
+            result = yield from self.service2.send(collection_name=resource,
+                                                   action='list')
+            self.assertItemsEqual([item['resource_id'] for item in result],
+                                  resource_ids)
+
+            # Pages are merged across shards
+            cursor = self.service2.list_cursor(resource, sort='-index',
+                                               chunk_size=7)
+            indexes = []
+            resources = yield from cursor.next()
+            while resources:
+                self.assertLessEqual(len(resources), 7)
+                indexes.extend(item['resource_data']['index'] for item in
+                               resources)
+                resources = yield from cursor.next()
+            self.assertEqual(indexes, list(reversed(range(30))))
+
+            page = yield from self.service2.send(
+                collection_name=resource, action='list', sort='index',
+                limit=2, fields=['-index'])
+            self.assertEqual(page['resources'],
+                             [{'resource_id': resource_ids[0],
+                               'resource_data': {}},
+                              {'resource_id': resource_ids[1],
+                               'resource_data': {}}])
+            self.assertEqual(page['cursor'], [1, resource_ids[1]])
+
+            # Without sort, lists are resumed after a resource id
+            after = sorted(resource_ids)[10]
+            result = yield from self.service2.send(
+                collection_name=resource, action='list', after=[after])
+            self.assertEqual([item['resource_id'] for item in result],
+                             sorted(resource_ids)[11:])
+
+            # Bulk actions are split by shard, results keep their order
+            result = yield from self.service2.send(
+                collection_name=resource, action='bulk_create',
+                resources=[{'resource_data': {'index': i}} for i in
+                           range(30, 40)])
+            self.assertEqual(len(result), 10)
+            bulk_ids = [item['resource_id'] for item in result]
+            for index, resource_id in enumerate(bulk_ids, 30):
+                owner = [service for service in services if
+                         service.name == ring.get_node(resource_id)][0]
+                self.assertEqual(
+                    owner.resources[resource]._collection[resource_id],
+                    {'index': index})
+
+            result = yield from self.service2.send(
+                collection_name=resource, action='bulk_delete',
+                resource_ids=bulk_ids + ['missing'])
+            self.assertEqual([item['success'] for item in result],
+                             [True] * 10 + [False])
+            result = yield from self.service2.send(collection_name=resource,
+                                                   action='list')
+            self.assertEqual(len(result), 30)
+        finally:
+            for service in services:
+                service.close()
+
+    @_async_test
+    def test_resource_shard_replaced(self):
+        resource = 'ShardedResource'
+        services = []
+        for i in range(2):
+            service = _create_test_resource_service("Shard%d" % i,
+                                                    loop=self.loop)
+            service.register_resource(TestCollection(resource, sharded=True))
+            services.append(service)
+            yield from service.start()
+        yield from self.service2.start()
+
+        try:
+            resource_ids = []
+            for i in range(10):
+                result = yield from self.service2.send(
+                    collection_name=resource, action='create',
+                    resource_data={'index': i})
+                resource_ids.append(result['resource_id'])
+            ring = self.service2.shard_rings[resource]
+            lost_ids = [resource_id for resource_id in resource_ids if
+                        ring.get_node(resource_id) == 'Shard1']
+            self.assertTrue(lost_ids)
+
+            # The ids of a shard without node don't move to the others
+            yield from services[1].leave()
+            self.assertEqual(ring.nodes, {'Shard0', 'Shard1'})
+            with self.assertRaises(ServiceUnavailable):
+                yield from self.service2.send(collection_name=resource,
+                                              action='get',
+                                              resource_id=lost_ids[0])
+
+            # A node taking the shard over under its name serves them again
+            replacement = _create_test_resource_service("Shard1",
+                                                        loop=self.loop)
+            collection = TestCollection(resource, sharded=True)
+            replacement.register_resource(collection)
+            for resource_id in lost_ids:
+                data = services[1].resources[resource]._collection[
+                    resource_id]
+                yield from collection.on_message(
+                    action='create', resource_id=resource_id,
+                    resource_data=data)
+            services.append(replacement)
+            yield from replacement.start()
+
+            self.assertEqual(ring.nodes, {'Shard0', 'Shard1'})
+            for resource_id in resource_ids:
+                result = yield from self.service2.send(
+                    collection_name=resource, action='get',
+                    resource_id=resource_id)
+                self.assertEqual(result['resource_id'], resource_id)
+        finally:
+            for service in services:
+                service.close()
+
+    def test_declared_shards(self):
+        service = TestResourceService(
+            "Declared", MemoryMedium(self.loop, MemoryDiscoveryMedium),
+            shards={'Sharded': ['shard-a']})
+        try:
+            service.save_new_node_info({
+                'node_id': 'node-a', 'name': 'a', 'node_type': 'node',
+                'sharded_resources': ['Sharded'],
+                'shards': {'Sharded': 'shard-a'}})
+            service.save_new_node_info({
+                'node_id': 'node-b', 'name': 'b', 'node_type': 'node',
+                'sharded_resources': ['Sharded'],
+                'shards': {'Sharded': 'shard-b'}})
+
+            # Undeclared shards don't change the ring
+            self.assertEqual(service.shard_rings['Sharded'].nodes,
+                             {'shard-a'})
+            self.assertEqual(service.shard_nodes['Sharded'],
+                             {'shard-a': 'node-a'})
+
+            service.add_shard('Sharded', 'shard-b')
+            service.save_new_node_info({
+                'node_id': 'node-b', 'name': 'b', 'node_type': 'node',
+                'sharded_resources': ['Sharded'],
+                'shards': {'Sharded': 'shard-b'}})
+            self.assertEqual(service.shard_nodes['Sharded'],
+                             {'shard-a': 'node-a', 'shard-b': 'node-b'})
+        finally:
+            service.close()
+
+    @_async_test
+    def test_resource_list_cursor(self):
+        for i in range(5):
+            yield from self.collection.on_message(
+                action='create', resource_id='UUID-%d' % i,
+                resource_data={'index': i})
+
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        cursor = self.service2.list_cursor(self.resource,
+                                           where={'index': {'$gte': 0}},
+                                           sort='index', chunk_size=2)
+        chunks = []
+        resources = yield from cursor.next()
+        while resources:
+            chunks.append([item['resource_id'] for item in resources])
+            resources = yield from cursor.next()
+
+        self.assertEqual(chunks, [['UUID-0', 'UUID-1'], ['UUID-2', 'UUID-3'],
+                                  ['UUID-4']])
+        self.assertTrue(cursor.done)
+
+    @_async_test
+    def test_resource_send_timeout(self):
+        yield from self.service1.start()
+        yield from self.service2.start()
+
+        @asyncio.coroutine
+        def slow_action(**kwargs):
+            yield from asyncio.sleep(0.5, loop=self.loop)
+
+        self.collection.on_message = slow_action
+
+        call_request = {'collection_name': self.resource, 'action': 'list',
+                        'timeout': 0.05}
+
+        with self.assertRaises(RequestTimeout):
+            yield from self.service2.send(**call_request)
+
+        with self.assertRaises(RequestTimeout):
+            yield from self.service1.send(**call_request)
+
+    @_async_test
+    def test_resource_deadline_expired(self):
+        message = {'collection_name': self.resource, 'action': 'list',
+                   'deadline': time.time() - 1}
+        self.collection.on_message = Mock()
+
+        result = yield from self.service1.on_message(**message)
+
+        self.assertEqual(result['success'], False)
+        self.assertEqual(self.collection.on_message.call_count, 0)
+
     @_async_test
     def test_resource_publish_to_itself(self):
         self.service1.on_event_mock.reset_mock()
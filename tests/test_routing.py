@@ -0,0 +1,104 @@
+from zeroservices.routing import (RoundRobinPolicy, LeastOutstandingPolicy,
+                                  LatencyPolicy, get_routing_policy)
+from .utils import TestCase
+
+
+class RoundRobinPolicyTestCase(TestCase):
+
+    def test_choose(self):
+        policy = RoundRobinPolicy()
+        nodes = ['node1', 'node2', 'node3']
+
+        chosen = [policy.choose('collection', nodes) for _ in range(6)]
+        self.assertEqual(chosen, nodes * 2)
+
+    def test_choose_per_collection(self):
+        policy = RoundRobinPolicy()
+        nodes = ['node1', 'node2']
+
+        self.assertEqual(policy.choose('collection1', nodes), 'node1')
+        self.assertEqual(policy.choose('collection2', nodes), 'node1')
+        self.assertEqual(policy.choose('collection1', nodes), 'node2')
+
+
+class LeastOutstandingPolicyTestCase(TestCase):
+
+    def test_choose(self):
+        policy = LeastOutstandingPolicy()
+        nodes = ['node1', 'node2']
+
+        policy.request_started('node1')
+        self.assertEqual(policy.choose('collection', nodes), 'node2')
+
+        policy.request_started('node2')
+        policy.request_started('node2')
+        self.assertEqual(policy.choose('collection', nodes), 'node1')
+
+        policy.request_finished('node2', 0.1)
+        policy.request_finished('node2', 0.1)
+        self.assertEqual(policy.choose('collection', nodes), 'node2')
+        self.assertEqual(dict(policy.outstanding), {'node1': 1})
+
+
+class LatencyPolicyTestCase(TestCase):
+
+    def test_choose_unknown_first(self):
+        policy = LatencyPolicy()
+
+        policy.request_started('node1')
+        policy.request_finished('node1', 0.01)
+
+        self.assertEqual(policy.choose('collection', ['node1', 'node2']),
+                         'node2')
+
+    def test_cold_start_burst(self):
+        policy = LatencyPolicy()
+        nodes = ['node1', 'node2', 'node3']
+
+        # Nothing measured yet, requests in flight spread the burst
+        chosen = []
+        for _ in range(6):
+            node_id = policy.choose('collection', nodes)
+            policy.request_started(node_id)
+            chosen.append(node_id)
+        self.assertItemsEqual(chosen, nodes * 2)
+
+    def test_choose_fastest(self):
+        policy = LatencyPolicy(alpha=0.5)
+        nodes = ['node1', 'node2']
+
+        for node_id, elapsed in [('node1', 0.1), ('node2', 0.02),
+                                 ('node1', 0.3)]:
+            policy.request_started(node_id)
+            policy.request_finished(node_id, elapsed)
+
+        self.assertAlmostEqual(policy.latencies['node1'], 0.2)
+        self.assertEqual(policy.choose('collection', nodes), 'node2')
+
+        # Requests in flight make a node slower
+        for _ in range(10):
+            policy.request_started('node2')
+        self.assertEqual(policy.choose('collection', nodes), 'node1')
+
+    def test_forget(self):
+        policy = LatencyPolicy()
+        policy.request_started('node1')
+        policy.request_finished('node1', 0.1)
+
+        policy.forget('node1')
+        self.assertEqual(policy.latencies, {})
+
+
+class GetRoutingPolicyTestCase(TestCase):
+
+    def test_get_routing_policy(self):
+        self.assertIsInstance(get_routing_policy(None), RoundRobinPolicy)
+        self.assertIsInstance(get_routing_policy('latency'), LatencyPolicy)
+        self.assertIsInstance(get_routing_policy(LeastOutstandingPolicy),
+                              LeastOutstandingPolicy)
+
+        policy = LatencyPolicy()
+        self.assertIs(get_routing_policy(policy), policy)
+
+        with self.assertRaises(ValueError):
+            get_routing_policy('foo')
@@ -0,0 +1,50 @@
+from zeroservices.sharding import HashRing
+from .utils import TestCase
+
+
+class HashRingTestCase(TestCase):
+
+    def setUp(self):
+        self.keys = ['resource-%d' % i for i in range(3000)]
+
+    def test_empty_ring(self):
+        with self.assertRaises(KeyError):
+            HashRing().get_node('foo')
+
+    def test_get_node(self):
+        ring = HashRing(['node1', 'node2', 'node3'])
+
+        owners = [ring.get_node(key) for key in self.keys]
+
+        # Same owner each time
+        self.assertEqual(owners, [ring.get_node(key) for key in self.keys])
+
+        # Keys are spread over every node
+        for node in ['node1', 'node2', 'node3']:
+            self.assertGreater(owners.count(node), len(self.keys) / 6)
+
+    def test_add_node_moves_few_keys(self):
+        ring = HashRing(['node1', 'node2', 'node3'])
+        before = {key: ring.get_node(key) for key in self.keys}
+
+        ring.add_node('node4')
+        after = {key: ring.get_node(key) for key in self.keys}
+
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # Only keys taken by the new node moved
+        self.assertEqual(set(after[key] for key in moved), {'node4'})
+        self.assertLess(len(moved), len(self.keys) / 3)
+
+    def test_remove_node(self):
+        ring = HashRing(['node1', 'node2', 'node3'])
+        before = {key: ring.get_node(key) for key in self.keys}
+
+        ring.remove_node('node2')
+        self.assertNotIn('node2', ring)
+        self.assertEqual(len(ring), 2)
+
+        for key in self.keys:
+            if before[key] != 'node2':
+                self.assertEqual(ring.get_node(key), before[key])
+            else:
+                self.assertIn(ring.get_node(key), ('node1', 'node3'))
@@ -1,22 +1,73 @@
+import os
 import asyncio
 
 try:
-    from unittest.mock import Mock, call
+    from unittest.mock import Mock, call, patch
 except ImportError:
-    from mock import Mock, call
+    from mock import Mock, call, patch
 
 from copy import copy
 from zeroservices import ResourceWorker
 from zeroservices.medium.memory import MemoryMedium
 from zeroservices.discovery.memory import MemoryDiscoveryMedium
 from zeroservices.memory import MemoryCollection
+from zeroservices.resources import Rule, is_callable
+from zeroservices.indexes import RuleIndex
 from .utils import TestCase, _create_test_resource_service, _async_test
 
 
+def square(resource_name, resource_data, resource_id, action):
+    return {'result': resource_data['value'] ** 2, 'pid': os.getpid()}
+
+
 class RuleTestCase(TestCase):
     pass
 
 
+class RuleIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.index = RuleIndex()
+        self.matchers = [
+            {'status': 'pending'},
+            {'status': 'done', 'kind': 'a'},
+            {'kind': {'$in': ['a', 'b']}},
+            {'kind': {'$eq': 'c'}, 'size': {'$gt': 2}},
+            {'size': {'$gt': 2}},
+            {'status': None},
+            {'tags': 'x'},
+            {'nested.value': 1},
+            {'$or': [{'status': 'pending'}, {'kind': 'b'}]},
+        ]
+        self.rules = [Rule(Mock(), matcher) for matcher in self.matchers]
+        for rule in self.rules:
+            self.index.add(rule)
+
+    def test_unindexed(self):
+        self.assertEqual(self.index.unindexed,
+                         [self.rules[4], self.rules[8]])
+        self.assertEqual(len(self.index), len(self.rules))
+
+    def test_candidates(self):
+        candidates = self.index.candidates({'status': 'pending',
+                                            'kind': 'z'})
+        self.assertEqual(candidates, [self.rules[0], self.rules[4],
+                                      self.rules[8]])
+
+    def test_candidates_include_matching_rules(self):
+        resources = [{}, {'status': 'pending'}, {'status': 'done'},
+                     {'status': 'done', 'kind': 'a', 'size': 3},
+                     {'kind': 'c', 'size': 3}, {'kind': 'b'},
+                     {'tags': ['y', 'x']}, {'tags': {'x': 1}},
+                     {'nested': {'value': 1}}, {'status': ['done']}]
+        for resource in resources:
+            candidates = self.index.candidates(resource)
+            matching = [rule for rule in self.rules if rule.match(resource)]
+            self.assertTrue(set(matching) <= set(candidates),
+                            (resource, matching, candidates))
+            self.assertLess(len(candidates), len(self.rules))
+
+
 class ResourceWorkerUnitTestCase(TestCase):
 
     def setUp(self):
@@ -200,3 +251,279 @@ class ResourceWorkerTestCase(TestCase):
         self.assertEqual(
             updated_resource_data,
             expected_resource)
+
+    @_async_test
+    def test_poll_check_changes(self):
+        yield from self.service1.start()
+
+        for i in range(3):
+            yield from self.collection1.on_message(
+                action='create', resource_id='UUID%d' % i,
+                resource_data={'kwarg_1': 1, 'index': i})
+
+        callback = Mock()
+        worker = ResourceWorker('worker2', MemoryMedium(
+            self.loop, MemoryDiscoveryMedium, 'node3'))
+        worker.register(asyncio.coroutine(callback), self.resource_name,
+                        kwarg_1=1)
+        yield from worker.start()
+
+        try:
+            # Every matching resource at first
+            yield from worker.poll_check()
+            self.assertEqual(callback.call_count, 3)
+
+            # Then only the changed ones
+            callback.reset_mock()
+            yield from worker.poll_check()
+            self.assertEqual(callback.call_count, 0)
+
+            yield from self.collection1.on_message(
+                action='patch', resource_id='UUID1',
+                patch={'$set': {'index': 10}})
+            callback.reset_mock()
+            yield from worker.poll_check()
+            callback.assert_called_once_with(
+                self.resource_name, {'kwarg_1': 1, 'index': 10}, 'UUID1',
+                'periodic')
+
+            # The collection restarted, resync everything
+            self.collection1.epoch = 'restarted'
+            callback.reset_mock()
+            yield from worker.poll_check()
+            self.assertEqual(callback.call_count, 3)
+        finally:
+            worker.close()
+
+    @_async_test
+    def test_poll_check_replicas(self):
+        # A replica of the collection with its own change sequence
+        service3 = _create_test_resource_service('test_service3', self.loop)
+        collection3 = MemoryCollection(self.resource_name)
+        service3.register_resource(collection3)
+        for collection in (self.collection1, collection3):
+            yield from collection.on_message(
+                action='create', resource_id='UUID1',
+                resource_data={'kwarg_1': 1})
+
+        yield from self.service1.start()
+        yield from service3.start()
+
+        callback = Mock()
+        worker = ResourceWorker('worker2', MemoryMedium(
+            self.loop, MemoryDiscoveryMedium, 'node3'))
+        worker.register(asyncio.coroutine(callback), self.resource_name,
+                        kwarg_1=1)
+        yield from worker.start()
+
+        try:
+            yield from worker.poll_check()
+            self.assertEqual(callback.call_count, 1)
+
+            # The changes are polled from the same replica
+            callback.reset_mock()
+            for _ in range(3):
+                yield from worker.poll_check()
+            self.assertEqual(callback.call_count, 0)
+        finally:
+            worker.close()
+            service3.close()
+
+    @_async_test
+    def test_poll_check_without_changes(self):
+        calls = []
+
+        class Collection(MemoryCollection):
+
+            @is_callable
+            def list(self, where=None):
+                calls.append(where)
+                return [{'resource_id': 'UUID1',
+                         'resource_data': {'kwarg_1': 1}}]
+
+        service3 = _create_test_resource_service('test_service3', self.loop)
+        service3.register_resource(Collection('NoChanges'))
+        yield from service3.start()
+
+        callback = Mock()
+        worker = ResourceWorker('worker2', MemoryMedium(
+            self.loop, MemoryDiscoveryMedium, 'node3'))
+        worker.register(asyncio.coroutine(callback), 'NoChanges', kwarg_1=1)
+        yield from worker.start()
+
+        try:
+            with patch.object(worker, 'send_to_node',
+                              wraps=worker.send_to_node) as send_to_node:
+                for _ in range(3):
+                    yield from worker.poll_check()
+            self.assertEqual(callback.call_count, 3)
+            self.assertEqual(len(calls), 3)
+
+            # The changes were only asked once
+            self.assertEqual(worker.no_changes, {'NoChanges'})
+            since_calls = [args for args, _ in send_to_node.call_args_list
+                           if 'since' in args[1]]
+            self.assertEqual(len(since_calls), 1)
+        finally:
+            worker.close()
+            service3.close()
+
+    @_async_test
+    def test_poll_check_changes_error(self):
+        yield from self.service1.start()
+
+        for i in range(3):
+            yield from self.collection1.on_message(
+                action='create', resource_id='UUID%d' % i,
+                resource_data={'kwarg_1': 1, 'index': i})
+
+        callback = Mock()
+        worker = ResourceWorker('worker2', MemoryMedium(
+            self.loop, MemoryDiscoveryMedium, 'node3'))
+        worker.register(asyncio.coroutine(callback), self.resource_name,
+                        kwarg_1=1)
+        yield from worker.start()
+
+        list_changes = self.collection1.list_changes
+        errors = [RuntimeError('Temporary failure')]
+
+        def failing_list_changes(*args, **kwargs):
+            if errors:
+                raise errors.pop()
+            return list_changes(*args, **kwargs)
+
+        try:
+            # A failed changes list falls back to every resource
+            with patch.object(self.collection1, 'list_changes',
+                              failing_list_changes):
+                yield from worker.poll_check()
+                self.assertEqual(callback.call_count, 3)
+                self.assertEqual(worker.no_changes, set())
+
+                # And the changes are asked again next time
+                callback.reset_mock()
+                yield from worker.poll_check()
+                self.assertEqual(callback.call_count, 3)
+                callback.reset_mock()
+                yield from worker.poll_check()
+                self.assertEqual(callback.call_count, 0)
+        finally:
+            worker.close()
+
+    @_async_test
+    def test_concurrent_rules(self):
+        yield from self.service1.start()
+
+        started = []
+        release = asyncio.Future(loop=self.loop)
+
+        @asyncio.coroutine
+        def slow(resource_name, resource_data, resource_id, action):
+            started.append(resource_id)
+            yield from release
+
+        worker = ResourceWorker('worker2', MemoryMedium(
+            self.loop, MemoryDiscoveryMedium, 'node3'), concurrency=4)
+        worker.register(slow, self.resource_name, kwarg_1=1)
+        yield from worker.start()
+
+        try:
+            # Events don't wait for the callbacks of the previous ones
+            for i in range(6):
+                yield from self.collection1.on_message(
+                    action='create', resource_id='UUID%d' % i,
+                    resource_data={'kwarg_1': 1})
+            yield from asyncio.sleep(0, loop=self.loop)
+
+            self.assertEqual(started, ['UUID0', 'UUID1', 'UUID2', 'UUID3'])
+            stats = worker.executor.stats()
+            self.assertEqual(stats['in_flight'], 4)
+            self.assertEqual(stats['queued'], 2)
+
+            release.set_result(None)
+            yield from worker.executor.join()
+            self.assertEqual(len(started), 6)
+        finally:
+            worker.close()
+
+    @_async_test
+    def test_competing_workers(self):
+        yield from self.service1.start()
+
+        calls = []
+        workers = []
+        for i in range(2):
+            worker = ResourceWorker('worker%d' % i, MemoryMedium(
+                self.loop, MemoryDiscoveryMedium, 'competing%d' % i),
+                lease_ttl=5)
+
+            @asyncio.coroutine
+            def callback(resource_name, resource_data, resource_id, action,
+                         worker=worker):
+                calls.append((worker.name, resource_id))
+
+            worker.register(callback, self.resource_name, kwarg_1=1)
+            workers.append(worker)
+            yield from worker.start()
+
+        try:
+            for i in range(4):
+                yield from self.collection1.on_message(
+                    action='create', resource_id='UUID%d' % i,
+                    resource_data={'kwarg_1': 1})
+
+            # Each event is processed by one worker only
+            self.assertItemsEqual([resource_id for _, resource_id in calls],
+                                  ['UUID%d' % i for i in range(4)])
+
+            # Resources are skipped while another worker holds their lease
+            for worker in workers:
+                yield from worker.poll_check()
+            self.assertEqual(len(calls), 8)
+            self.assertEqual(len(set(calls)), 4)
+
+            leases = self.collection1.leases.stats()
+            self.assertEqual(leases['claims'], 4)
+            self.assertEqual(leases['conflicts'], 8)
+            self.assertEqual(sum(worker.lease_stats['conflicts'] for worker
+                                 in workers), 8)
+        finally:
+            for worker in workers:
+                worker.close()
+
+    @_async_test
+    def test_cpu_bound_rule(self):
+        yield from self.service1.start()
+
+        worker = ResourceWorker('worker2', MemoryMedium(
+            self.loop, MemoryDiscoveryMedium, 'node3'), process_pool_size=1)
+        results = []
+
+        @asyncio.coroutine
+        def on_result(resource_name, resource_data, resource_id, action,
+                      result):
+            results.append(result)
+            yield from worker.send(collection_name=resource_name,
+                                   action='patch', resource_id=resource_id,
+                                   patch={'$set': {'status': 'done',
+                                                   'result': result['result']}})
+
+        worker.register(square, self.resource_name, cpu_bound=True,
+                        on_result=on_result, status='pending')
+        yield from worker.start()
+
+        try:
+            yield from self.collection1.on_message(
+                action='create', resource_id='UUID1',
+                resource_data={'status': 'pending', 'value': 7})
+
+            self.assertEqual(len(results), 1)
+            self.assertNotEqual(results[0]['pid'], os.getpid())
+
+            resource = yield from self.collection1.on_message(
+                action='get', resource_id='UUID1')
+            self.assertEqual(resource['resource_data'],
+                             {'status': 'done', 'value': 7, 'result': 49})
+        finally:
+            worker.close()
+
@@ -1,12 +1,63 @@
 import sys
+import time
+import asyncio
 import pymongo
 from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 import os
 
 from copy import copy
+from functools import partial
 
 from zeroservices import ResourceCollection, Resource
 from zeroservices.resources import is_callable
+from zeroservices.query import (parse_sort, make_cursor, parse_fields,
+                                project, extend_projection, check_limit)
+
+
+def mongo_projection(fields, exclude=None):
+    """Turn a projection into a MongoDB one, _id is always fetched
+    """
+    if exclude is None:
+        fields, exclude = parse_fields(fields)
+    if not fields:
+        return None if exclude else {'_id': 1}
+    value = 0 if exclude else 1
+    return {field_name: value for field_name in fields}
+
+
+def document_ids(resource_id):
+    """Return the _id values a resource id could be stored as
+    """
+    if ObjectId.is_valid(resource_id):
+        return [resource_id, ObjectId(resource_id)]
+    return [resource_id]
+
+
+def _failed(resource_id, error):
+    return {'resource_id': resource_id, 'success': False, 'error': error}
+
+
+def _item_id(item):
+    return item.get('resource_id') if isinstance(item, dict) else None
+
+
+def _merge_invalid(count, invalid, results):
+    """Return the results of count items, those of the invalid items, by
+    position, among the results of the valid ones
+    """
+    results = iter(results)
+    return [invalid[position] if position in invalid else next(results) for
+            position in range(count)]
+
+
+def _valid_id(resource_id):
+    try:
+        hash(resource_id)
+    except TypeError:
+        return False
+    return resource_id is not None
 
 
 class MongoDBResource(Resource):
@@ -14,13 +65,19 @@ class MongoDBResource(Resource):
     def __init__(self, collection, **kwargs):
         super(MongoDBResource, self).__init__(**kwargs)
         self.collection = collection
-        self._document = None
+
+    def run(self, function, *args, **kwargs):
+        return self.resource_collection.run(function, *args, **kwargs)
+
+    @property
+    def id_query(self):
+        return {'_id': {'$in': document_ids(self.resource_id)}}
 
     @is_callable
     def create(self, resource_data):
         document_data = {'_id': self.resource_id}
         document_data.update(resource_data)
-        self.collection.insert(document_data)
+        yield from self.run(self.collection.insert, document_data)
 
         yield from self.publish('create', {'action': 'create',
                                 'resource_data': resource_data})
@@ -28,8 +85,10 @@ class MongoDBResource(Resource):
         return {'resource_id': self.resource_id}
 
     @is_callable
-    def get(self):
-        document = self.document
+    def get(self, fields=None):
+        projection = None if fields is None else mongo_projection(fields)
+        document = yield from self.run(self.collection.find_one,
+                                       self.id_query, projection)
 
         if not document:
             return 'NOK'
@@ -39,8 +98,8 @@ class MongoDBResource(Resource):
 
     @is_callable
     def patch(self, patch):
-        new_document = self.collection.find_and_modify({'_id': ObjectId(self.resource_id)},
-            patch, new=True)
+        new_document = yield from self.run(self.collection.find_and_modify,
+                                           self.id_query, patch, new=True)
 
         yield from self.publish('patch', {'action': 'patch', 'patch': patch})
 
@@ -49,7 +108,7 @@ class MongoDBResource(Resource):
 
     @is_callable
     def delete(self):
-        self.collection.remove({'_id': self.resource_id})
+        yield from self.run(self.collection.remove, self.id_query)
         yield from self.publish('delete', {'action': 'delete'})
         return 'OK'
 
@@ -60,8 +119,8 @@ class MongoDBResource(Resource):
                     {"target_id": target_id, "title": title}},
                  "$set": {"_links.latest.{}".format(target_relation):
                     target_id}}
-        self.collection.find_and_modify({'_id': self.resource_id}, patch,
-                                        new=True)
+        yield from self.run(self.collection.find_and_modify, self.id_query,
+                            patch, new=True)
 
         event = {'action': 'add_link', 'target_id': target_id,
                  'title': title, 'relation': relation}
@@ -69,25 +128,22 @@ class MongoDBResource(Resource):
 
         return "OK"
 
-    @property
-    def document(self):
-        if self._document is None:
-            self._document = self.collection.find_one({'_id': ObjectId(self.resource_id)})
-        return self._document
-
 
 class MongoDBCollection(ResourceCollection):
 
     resource_class = MongoDBResource
 
-    def __init__(self, collection_name, database_name):
-        super(MongoDBCollection, self).__init__(collection_name)
+    def __init__(self, collection_name, database_name, sharded=None,
+                 client=None):
+        super(MongoDBCollection, self).__init__(collection_name, sharded)
         self.database_name = database_name
         self.collection_name = collection_name
 
-        mongo_host = os.environ.get('MONGO_HOST', 'localhost')
+        if client is None:
+            mongo_host = os.environ.get('MONGO_HOST', 'localhost')
+            client = pymongo.MongoClient(host=mongo_host)
 
-        self.connection = pymongo.MongoClient(host=mongo_host)
+        self.connection = client
         self.database = self.connection[database_name]
         self.collection = self.database[collection_name]
 
@@ -95,8 +151,16 @@ class MongoDBCollection(ResourceCollection):
         return super(MongoDBCollection, self).instantiate(
             collection=self.collection, **kwargs)
 
+    @asyncio.coroutine
+    def run(self, function, *args, **kwargs):
+        """Call a blocking pymongo function, directly in the event loop
+        """
+        return function(*args, **kwargs)
+
     @is_callable
-    def list(self, where=None):
+    def list(self, where=None, limit=None, after=None, sort=None,
+             fields=None):
+        check_limit(limit)
         if where is None:
             where = {}
 
@@ -105,16 +169,83 @@ class MongoDBCollection(ResourceCollection):
             text = where.pop('text')
             where['$text'] = {'$search': text}
 
+        sort = parse_sort(sort)
+
+        if after is not None:
+            where = {'$and': [where, self._after_query(sort, after)]}
+
+        projection = None
+        if fields is not None:
+            # The sort fields are needed to build the page cursor
+            query_fields = extend_projection(
+                fields, [field_name for field_name, _ in sort])
+            if query_fields is not None:
+                projection = mongo_projection(query_fields)
+
+        mongo_sort = None
+        if sort or limit is not None or after is not None:
+            mongo_sort = [(field_name, pymongo.DESCENDING if descending else
+                           pymongo.ASCENDING) for field_name, descending in
+                          sort] + [('_id', pymongo.ASCENDING)]
+        # One more document tells if there is a next page
+        documents = yield from self.run(
+            self._find, where, projection, mongo_sort,
+            None if limit is None else limit + 1)
+
         result = list()
-        for document in self.collection.find(where):
+        for document in documents:
             result.append({'resource_id': str(document.pop('_id')),
                            'resource_data': document})
-        return result
+
+        page_cursor = None
+        if limit is not None and len(result) > limit:
+            result = result[:limit]
+            page_cursor = make_cursor(sort, result[-1])
+
+        # Drop the sort fields which were only fetched for the cursor
+        if fields is not None and sort:
+            for resource in result:
+                resource['resource_data'] = project(resource['resource_data'],
+                                                    fields)
+
+        if limit is None:
+            return result
+        return {'resources': result, 'cursor': page_cursor}
+
+    def _find(self, where, projection, sort, limit):
+        cursor = self.collection.find(where, projection)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    @staticmethod
+    def _after_query(sort, after):
+        """Keyset query for the documents sorted after the cursor
+        """
+        keys = [(field_name, '$lt' if descending else '$gt') for
+                field_name, descending in sort]
+
+        resource_id = after[-1]
+        if ObjectId.is_valid(resource_id):
+            resource_id = ObjectId(resource_id)
+        keys.append(('_id', '$gt'))
+        values = after[:-1] + [resource_id]
+
+        clauses = []
+        for position, (field_name, operator_name) in enumerate(keys):
+            clause = {previous_field: value for (previous_field, _), value in
+                      zip(keys[:position], values)}
+            clause[field_name] = {operator_name: values[position]}
+            clauses.append(clause)
+        return {'$or': clauses}
 
     @is_callable
     def create(self, resource_data):
         document_data = copy(resource_data)
-        document_id = self.collection.insert(document_data)
+        document_id = yield from self.run(self.collection.insert,
+                                          document_data)
         # Replace ObjectId by a str
         document_data['_id'] = str(document_data['_id'])
 
@@ -123,3 +254,213 @@ class MongoDBCollection(ResourceCollection):
                                 'resource_id': str(document_id)})
 
         return {'resource_id': str(document_id)}
+
+    @is_callable
+    def bulk_create(self, resources):
+        """Create a list of {'resource_id': ..., 'resource_data': ...} in a
+        single bulk write, an ObjectId is generated when the resource_id is
+        missing. Return one result per item.
+        """
+        new_ids, requests, invalid = [], [], {}
+        for position, resource in enumerate(resources):
+            try:
+                document_id = resource.get('resource_id') or ObjectId()
+                if not isinstance(resource['resource_data'], dict):
+                    raise TypeError('resource_data must be a dict')
+            except (AttributeError, KeyError, TypeError) as e:
+                invalid[position] = _failed(_item_id(resource),
+                                            'Invalid resource: %r' % e)
+                continue
+            document_data = {'_id': document_id}
+            document_data.update(resource['resource_data'])
+            new_ids.append(document_id)
+            requests.append(InsertOne(document_data))
+
+        results = yield from self.run(self._bulk_write, requests)
+        for document_id, result in zip(new_ids, results):
+            result['resource_id'] = str(document_id)
+        results = _merge_invalid(len(resources), invalid, results)
+
+        events = []
+        for resource, result in zip(resources, results):
+            if result['success']:
+                events.append(('create.%s' % result['resource_id'],
+                               {'action': 'create',
+                                'resource_data': resource['resource_data'],
+                                'resource_id': result['resource_id']}))
+        yield from self.publish_many(events)
+        return results
+
+    @is_callable
+    def bulk_patch(self, patches):
+        """Apply a list of {'resource_id': ..., 'patch': ...} in a single
+        bulk write. Return one result per item.
+        """
+        valid, invalid = [], {}
+        for position, item in enumerate(patches):
+            try:
+                resource_id, patch = item['resource_id'], item['patch']
+                if not _valid_id(resource_id):
+                    raise TypeError('invalid resource_id')
+                if not patch or not all(key.startswith('$') for key in patch):
+                    raise ValueError('patch must only use $ operators')
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                invalid[position] = _failed(_item_id(item),
+                                            'Invalid patch: %r' % e)
+                continue
+            valid.append(item)
+
+        existing = yield from self.run(
+            self._existing_ids, [item['resource_id'] for item in valid])
+
+        requests = []
+        for item in valid:
+            document_id = existing.get(item['resource_id'])
+            if document_id is not None:
+                requests.append(UpdateOne({'_id': document_id},
+                                          item['patch']))
+        write_results = yield from self.run(self._bulk_write, requests)
+        results = _merge_invalid(len(patches), invalid, self._merge_missing(
+            [item['resource_id'] for item in valid], existing,
+            write_results))
+
+        events = []
+        for item, result in zip(patches, results):
+            if result['success']:
+                events.append(('patch.%s' % item['resource_id'],
+                               {'action': 'patch', 'patch': item['patch'],
+                                'resource_id': item['resource_id']}))
+        yield from self.publish_many(events)
+        return results
+
+    @is_callable
+    def bulk_delete(self, resource_ids):
+        """Delete a list of resource ids in a single bulk write. Return one
+        result per id.
+        """
+        valid_ids = [resource_id for resource_id in resource_ids if
+                     _valid_id(resource_id)]
+        existing = yield from self.run(self._existing_ids, valid_ids)
+
+        requests = []
+        for resource_id in valid_ids:
+            document_id = existing.get(resource_id)
+            if document_id is not None:
+                requests.append(DeleteOne({'_id': document_id}))
+        write_results = yield from self.run(self._bulk_write, requests)
+        results = self._merge_missing(resource_ids, existing, write_results)
+
+        events = []
+        for resource_id, result in zip(resource_ids, results):
+            if result['success']:
+                events.append(('delete.%s' % resource_id,
+                               {'action': 'delete',
+                                'resource_id': resource_id}))
+        yield from self.publish_many(events)
+        return results
+
+    def _existing_ids(self, resource_ids):
+        """Return {resource_id: _id} for the resources found
+        """
+        candidates = {}
+        for resource_id in resource_ids:
+            for document_id in document_ids(resource_id):
+                candidates[document_id] = resource_id
+
+        if not candidates:
+            return {}
+        cursor = self.collection.find({'_id': {'$in': list(candidates)}},
+                                      {'_id': 1})
+        return {candidates[document['_id']]: document['_id'] for
+                document in cursor}
+
+    @staticmethod
+    def _merge_missing(resource_ids, existing, write_results):
+        """Insert a failed result for each resource not found among the
+        results of the writes sent for the existing ones
+        """
+        write_results = iter(write_results)
+        results = []
+        for resource_id in resource_ids:
+            if _valid_id(resource_id) and resource_id in existing:
+                result = next(write_results)
+                result['resource_id'] = resource_id
+            else:
+                result = {'resource_id': resource_id, 'success': False,
+                          'error': 'No resource %s' % resource_id}
+            results.append(result)
+        return results
+
+    def _bulk_write(self, requests):
+        """Send the requests in one unordered bulk write and return one
+        result per request, failed requests don't stop the others
+        """
+        errors = {}
+        if requests:
+            try:
+                self.collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                errors = {error['index']: error['errmsg'] for error in
+                          e.details['writeErrors']}
+
+        results = []
+        for index in range(len(requests)):
+            result = {'success': index not in errors}
+            if index in errors:
+                result['error'] = errors[index]
+            results.append(result)
+        return results
+
+
+class AsyncMongoDBCollection(MongoDBCollection):
+
+    """MongoDBCollection running the blocking pymongo calls in a thread
+    pool instead of the event loop, at most max_concurrency at once for
+    the collection. The others wait in a queue.
+
+    executor defaults to the default executor of the loop.
+    """
+
+    def __init__(self, collection_name, database_name, sharded=None,
+                 client=None, max_concurrency=4, executor=None):
+        super(AsyncMongoDBCollection, self).__init__(
+            collection_name, database_name, sharded, client)
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self._semaphore = None
+
+        self.queued = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.max_queued = 0
+        self.queue_time = 0
+
+    @asyncio.coroutine
+    def run(self, function, *args, **kwargs):
+        loop = self.service.medium.loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency,
+                                                loop=loop)
+
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        queued_at = time.time()
+        try:
+            yield from self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.queue_time += time.time() - queued_at
+
+        self.in_flight += 1
+        self.calls += 1
+        try:
+            return (yield from loop.run_in_executor(
+                self.executor, partial(function, *args, **kwargs)))
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {'queued': self.queued, 'in_flight': self.in_flight,
+                'calls': self.calls, 'max_queued': self.max_queued,
+                'queue_time': self.queue_time}
@@ -0,0 +1,119 @@
+import json
+
+from collections import OrderedDict
+from copy import deepcopy
+
+
+def _size(value):
+    # Approximate size, the length of the value encoded in json
+    return len(json.dumps(value, default=repr))
+
+
+class ResourceCache(object):
+
+    """LRU cache of get results keyed by (collection name, resource id),
+    bounded by its number of entries and optionally by their size in bytes.
+
+    A value fetched while its key is invalidated is not stored, it may
+    predate the change. Values are copied in and out, a caller editing the
+    value it got doesn't change the cached one.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Key -> (value, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # Key being fetched -> whether it was invalidated meanwhile
+        self.fetching = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        try:
+            value, _ = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return deepcopy(value)
+
+    def fetch_started(self, key):
+        self.fetching[key] = False
+
+    def fetch_failed(self, key):
+        self.fetching.pop(key, None)
+
+    def put(self, key, value):
+        """Store the value fetched for key
+        """
+        if self.fetching.pop(key, False):
+            return
+        self._store(key, value)
+
+    def _store(self, key, value):
+        size = _size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self.entries[key] = (deepcopy(value), size)
+        self.size += size
+
+        while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def update(self, key, value):
+        """Replace the value of key if it is cached
+        """
+        if key in self.fetching:
+            self.fetching[key] = True
+        if self._remove(key):
+            self._store(key, value)
+
+    def invalidate(self, key):
+        if key in self.fetching:
+            self.fetching[key] = True
+        if self._remove(key):
+            self.invalidations += 1
+
+    def invalidate_collection(self, collection_name):
+        for key in list(self.fetching):
+            if key[0] == collection_name:
+                self.fetching[key] = True
+        for key in [key for key in self.entries if key[0] == collection_name]:
+            self.invalidate(key)
+
+    def clear(self):
+        for key in self.fetching:
+            self.fetching[key] = True
+        self.entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        try:
+            _, size = self.entries.pop(key)
+        except KeyError:
+            return False
+        self.size -= size
+        return True
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
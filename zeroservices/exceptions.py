@@ -7,6 +7,9 @@ class UnknownNode(Exception):
 class UnknownService(Exception):
     pass
 
+class RequestTimeout(Exception):
+    pass
+
 class ResourceException(Exception):
 
     def __init__(self, error_message):
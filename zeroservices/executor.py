@@ -0,0 +1,144 @@
+import asyncio
+import logging
+
+from collections import deque, namedtuple, defaultdict
+
+
+Job = namedtuple('Job', ['key', 'rule', 'args'])
+
+
+class RuleExecutor(object):
+
+    """Run rule callbacks as tasks, at most `concurrency` at once and at most
+    `rule.concurrency` at once for a rule when it has one.
+
+    Jobs of the same key, a resource, run one after another in submission
+    order. submit waits while `max_queue` jobs are already waiting.
+    """
+
+    def __init__(self, concurrency, max_queue=1000, loop=None, logger=None,
+                 run=None):
+        self.concurrency = concurrency
+        # Called as run(rule, *args) instead of rule(*args) when given
+        self.run = run
+        self.max_queue = max_queue
+        self.loop = loop
+        self.logger = logger or logging.getLogger(__name__)
+
+        # Jobs which can start, in submission order
+        self.ready = deque()
+        # Key -> jobs waiting for the job of the same key in ready or running
+        self.blocked = {}
+        self.busy_keys = set()
+
+        self.queued = 0
+        self.in_flight = 0
+        self.rules_in_flight = defaultdict(int)
+        self.tasks = set()
+        self.closed = False
+        self._waiters = deque()
+        self._idle = []
+
+    @asyncio.coroutine
+    def submit(self, key, rule, *args):
+        while self.queued >= self.max_queue:
+            waiter = asyncio.Future(loop=self.loop)
+            self._waiters.append(waiter)
+            yield from waiter
+
+        job = Job(key, rule, args)
+        self.queued += 1
+        if key in self.busy_keys:
+            self.blocked.setdefault(key, deque()).append(job)
+        else:
+            self.busy_keys.add(key)
+            self.ready.append(job)
+        self._dispatch()
+
+    def _can_start(self, rule):
+        limit = getattr(rule, 'concurrency', None)
+        return limit is None or self.rules_in_flight.get(rule, 0) < limit
+
+    def _dispatch(self):
+        if self.closed:
+            return
+        skipped = deque()
+        while self.ready and self.in_flight < self.concurrency:
+            job = self.ready.popleft()
+            if self._can_start(job.rule):
+                self._start(job)
+            else:
+                skipped.append(job)
+        skipped.extend(self.ready)
+        self.ready = skipped
+
+    def _start(self, job):
+        self.queued -= 1
+        self.in_flight += 1
+        self.rules_in_flight[job.rule] += 1
+
+        task = asyncio.async(self._run(job), loop=self.loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        # Room for a waiting submit
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    @asyncio.coroutine
+    def _run(self, job):
+        try:
+            if self.run is None:
+                yield from job.rule(*job.args)
+            else:
+                yield from self.run(job.rule, *job.args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception('Rule %s failed', job.rule)
+        finally:
+            self._finish(job)
+
+    def _finish(self, job):
+        self.in_flight -= 1
+        self.rules_in_flight[job.rule] -= 1
+        if not self.rules_in_flight[job.rule]:
+            del self.rules_in_flight[job.rule]
+
+        blocked = self.blocked.get(job.key)
+        if blocked:
+            self.ready.append(blocked.popleft())
+            if not blocked:
+                del self.blocked[job.key]
+        else:
+            self.busy_keys.discard(job.key)
+
+        self._dispatch()
+
+        if not self.queued and not self.in_flight:
+            idle, self._idle = self._idle, []
+            for waiter in idle:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    @asyncio.coroutine
+    def join(self):
+        """Wait until every submitted job is done
+        """
+        if self.queued or self.in_flight:
+            waiter = asyncio.Future(loop=self.loop)
+            self._idle.append(waiter)
+            yield from waiter
+
+    def close(self):
+        self.closed = True
+        for task in list(self.tasks):
+            task.cancel()
+
+    def stats(self):
+        return {'queued': self.queued, 'in_flight': self.in_flight,
+                'rules_in_flight': {repr(rule): count for rule, count in
+                                    self.rules_in_flight.items()}}
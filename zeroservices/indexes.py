@@ -0,0 +1,265 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from .query import get_field, get_operators
+
+
+class HashIndex(object):
+
+    """Map the values of a field to the ids of the resources holding them,
+    used for equality queries.
+
+    Resources whose value can't be hashed are returned by every lookup and
+    left to the query to filter.
+    """
+
+    kind = 'hash'
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+        self.buckets = defaultdict(set)
+        self.unhashable = set()
+
+    def add(self, resource_id, resource_data):
+        value = get_field(resource_data, self.field_name)
+        # Arrays match the values they contain, keep them aside too
+        if isinstance(value, (list, tuple)):
+            self.unhashable.add(resource_id)
+            return
+        try:
+            self.buckets[value].add(resource_id)
+        except TypeError:
+            self.unhashable.add(resource_id)
+
+    def remove(self, resource_id, resource_data):
+        value = get_field(resource_data, self.field_name)
+        if isinstance(value, (list, tuple)):
+            self.unhashable.discard(resource_id)
+            return
+        try:
+            bucket = self.buckets.get(value)
+        except TypeError:
+            self.unhashable.discard(resource_id)
+            return
+
+        if bucket is not None:
+            bucket.discard(resource_id)
+            if not bucket:
+                del self.buckets[value]
+
+    def lookup(self, query_field_value):
+        """Return the ids of the resources which may match the field query,
+        None if the index can't answer it
+        """
+        operators = get_operators(query_field_value)
+        if operators is None:
+            values = [query_field_value]
+        elif list(operators) == ['$eq']:
+            values = [operators['$eq']]
+        elif list(operators) == ['$in']:
+            values = operators['$in']
+        else:
+            return None
+
+        resource_ids = set(self.unhashable)
+        for value in values:
+            try:
+                resource_ids.update(self.buckets.get(value, ()))
+            except TypeError:
+                return None
+        return resource_ids
+
+
+def _sort_group(value):
+    # Only values of the same group can be ordered together
+    if isinstance(value, (int, float)):
+        return float
+    if isinstance(value, str):
+        return str
+    return None
+
+
+class SortedIndex(object):
+
+    """Keep the values of a field sorted, used for equality and range
+    queries ($gt, $gte, $lt, $lte).
+
+    Numbers and strings are kept in separate sorted lists, arrays are kept
+    aside for equality queries and other values (None, documents) never
+    match these queries and aren't indexed.
+    """
+
+    kind = 'sorted'
+
+    operators = ('$eq', '$gt', '$gte', '$lt', '$lte')
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+        # Group -> (sorted values, resource ids at the same positions)
+        self.groups = {}
+        self.arrays = set()
+
+    def add(self, resource_id, resource_data):
+        value = get_field(resource_data, self.field_name)
+        if isinstance(value, (list, tuple)):
+            self.arrays.add(resource_id)
+            return
+
+        group = _sort_group(value)
+        if group is None:
+            return
+
+        values, resource_ids = self.groups.setdefault(group, ([], []))
+        position = bisect_right(values, value)
+        values.insert(position, value)
+        resource_ids.insert(position, resource_id)
+
+    def remove(self, resource_id, resource_data):
+        value = get_field(resource_data, self.field_name)
+        if isinstance(value, (list, tuple)):
+            self.arrays.discard(resource_id)
+            return
+
+        group = _sort_group(value)
+        if group not in self.groups:
+            return
+
+        values, resource_ids = self.groups[group]
+        start = bisect_left(values, value)
+        end = bisect_right(values, value)
+        for position in range(start, end):
+            if resource_ids[position] == resource_id:
+                del values[position]
+                del resource_ids[position]
+                return
+
+    def lookup(self, query_field_value):
+        """Return the ids of the resources which may match the field query,
+        None if the index can't answer it
+        """
+        operators = get_operators(query_field_value)
+        if operators is None:
+            operators = {'$eq': query_field_value}
+        if not all(operator_name in self.operators for operator_name in
+                   operators):
+            return None
+
+        groups = set(_sort_group(operand) for operand in operators.values())
+        if len(groups) != 1 or None in groups:
+            return None
+
+        values, resource_ids = self.groups.get(groups.pop(), ([], []))
+        start, end = 0, len(values)
+        for operator_name, operand in operators.items():
+            if operator_name in ('$eq', '$gt', '$gte'):
+                if operator_name == '$gt':
+                    start = max(start, bisect_right(values, operand))
+                else:
+                    start = max(start, bisect_left(values, operand))
+            if operator_name in ('$eq', '$lt', '$lte'):
+                if operator_name == '$lt':
+                    end = min(end, bisect_left(values, operand))
+                else:
+                    end = min(end, bisect_right(values, operand))
+
+        resource_ids = set(resource_ids[start:end])
+        if '$eq' in operators:
+            resource_ids |= self.arrays
+        return resource_ids
+
+
+INDEXES = {HashIndex.kind: HashIndex, SortedIndex.kind: SortedIndex}
+
+
+def _equality_values(query_field_value):
+    """Return the values a field must equal to match the field query, None
+    if it isn't an equality on hashable values
+    """
+    operators = get_operators(query_field_value)
+    if operators is None:
+        values = [query_field_value]
+    elif list(operators) == ['$eq']:
+        values = [operators['$eq']]
+    elif list(operators) == ['$in']:
+        values = operators['$in']
+    else:
+        return None
+
+    for value in values:
+        # Documents and arrays could equal unhashable values
+        if isinstance(value, (dict, list, tuple)):
+            return None
+        try:
+            hash(value)
+        except TypeError:
+            return None
+    return values
+
+
+class RuleIndex(object):
+
+    """Find the rules whose matcher may match a resource without trying all
+    of them.
+
+    Each rule is indexed on one field its matcher requires to equal some
+    values, rules without such a field are candidates for every resource.
+    """
+
+    def __init__(self):
+        # Field name -> value -> rules
+        self.fields = {}
+        self.unindexed = []
+        # Rule -> registration order
+        self.order = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, rule):
+        self.order[rule] = len(self.order)
+
+        indexable = {}
+        for field_name, query_field_value in rule.matcher.items():
+            if field_name.startswith('$'):
+                continue
+            values = _equality_values(query_field_value)
+            if values is not None:
+                indexable[field_name] = values
+
+        if not indexable:
+            self.unindexed.append(rule)
+            return
+
+        # Share the fields already indexed to keep the lookups few
+        field_name = min(indexable, key=lambda field_name: (
+            field_name not in self.fields, field_name))
+        buckets = self.fields.setdefault(field_name, {})
+        for value in indexable[field_name]:
+            buckets.setdefault(value, []).append(rule)
+
+    def candidates(self, resource_data):
+        """Return the rules which may match resource_data in registration
+        order
+        """
+        if resource_data is None:
+            return sorted(self.order, key=self.order.get)
+
+        rules = set(self.unindexed)
+        for field_name, buckets in self.fields.items():
+            value = get_field(resource_data, field_name)
+            # Arrays match the values they contain
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for value in values:
+                try:
+                    rules.update(buckets.get(value, ()))
+                except TypeError:
+                    continue
+        return sorted(rules, key=self.order.get)
+
+
+def create_index(field_name, kind='hash'):
+    try:
+        index_class = INDEXES[kind]
+    except KeyError:
+        raise ValueError("Unknown index kind {}".format(kind))
+    return index_class(field_name)
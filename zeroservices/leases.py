@@ -0,0 +1,88 @@
+import time
+
+
+class Leases(object):
+
+    """Time-bounded leases on resources, at most one owner holds the lease
+    of a resource until it releases it or the lease expires.
+
+    Each claim returns a new token, a release only drops the lease of its
+    latest claim so an older job of the owner can't release a renewed lease.
+    """
+
+    # Expired leases are purged every purge_interval claims
+    purge_interval = 1024
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        # Resource id -> (owner, token, expiration)
+        self.leases = {}
+        self.token = 0
+        self._until_purge = self.purge_interval
+
+        self.claims = 0
+        self.renewals = 0
+        self.conflicts = 0
+        self.releases = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.leases)
+
+    def get(self, resource_id):
+        """Return the owner of the lease of resource_id, None when free
+        """
+        lease = self._lease(resource_id)
+        return lease[0] if lease is not None else None
+
+    def _lease(self, resource_id):
+        lease = self.leases.get(resource_id)
+        if lease is not None and lease[2] <= self.clock():
+            del self.leases[resource_id]
+            self.expirations += 1
+            return None
+        return lease
+
+    def claim(self, resource_id, owner, ttl):
+        """Claim the lease of resource_id for ttl seconds, return
+        {'claimed': True, 'token': token} on success and
+        {'claimed': False, 'owner': owner} when another owner holds it
+        """
+        self._until_purge -= 1
+        if self._until_purge <= 0:
+            self.purge()
+
+        lease = self._lease(resource_id)
+        if lease is not None and lease[0] != owner:
+            self.conflicts += 1
+            return {'claimed': False, 'owner': lease[0]}
+
+        if lease is None:
+            self.claims += 1
+        else:
+            self.renewals += 1
+        self.token += 1
+        self.leases[resource_id] = (owner, self.token, self.clock() + ttl)
+        return {'claimed': True, 'token': self.token}
+
+    def release(self, resource_id, owner, token):
+        lease = self._lease(resource_id)
+        if lease is None or lease[:2] != (owner, token):
+            return False
+        del self.leases[resource_id]
+        self.releases += 1
+        return True
+
+    def purge(self):
+        self._until_purge = self.purge_interval
+        now = self.clock()
+        expired = [resource_id for resource_id, lease in self.leases.items()
+                   if lease[2] <= now]
+        for resource_id in expired:
+            del self.leases[resource_id]
+        self.expirations += len(expired)
+
+    def stats(self):
+        return {'leases': len(self.leases), 'claims': self.claims,
+                'renewals': self.renewals, 'conflicts': self.conflicts,
+                'releases': self.releases, 'expirations': self.expirations}
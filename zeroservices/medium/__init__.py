@@ -3,28 +3,55 @@ import logging
 from uuid import uuid4
 from abc import ABCMeta, abstractmethod
 from ..utils import maybe_asynchronous
+from .codec import available_codecs, negotiate_codec
 
 import asyncio
 
 
+def match_topic(topic, event_type):
+    """Check if the event_type is topic or one of its dotted sub-topics
+
+    >>> match_topic('foo', 'foo.create.42')
+    True
+    >>> match_topic('foo', 'foobar.create.42')
+    False
+    """
+    if not topic or event_type == topic:
+        return True
+
+    if not topic.endswith('.'):
+        topic += '.'
+    return event_type.startswith(topic)
+
+
 class BaseMedium(object):
 
     __metaclass__ = ABCMeta
     node_id = None
 
-    def __init__(self, loop, discovery_class, node_id=None):
+    def __init__(self, loop, discovery_class, node_id=None, codecs=None):
         # Node id
         if node_id is None:
             node_id = uuid4().hex
         self.node_id = node_id
         self.directory = {}
 
+        # Wire codecs, ordered by preference
+        if codecs is None:
+            codecs = available_codecs()
+        self.codecs = list(codecs)
+        self.peer_codecs = {}
+        self._publish_codec = None
+
         self.loop = loop
         self.discovery = None
         self.discovery_class = discovery_class
         self.event_listeners = set()
         self.server_sockets = set()
 
+        # Event topics, receive every event while empty
+        self.topics = set()
+
     @asyncio.coroutine
     def start(self):
         self.discovery = self.discovery_class(self.process_message, self.loop,
@@ -42,38 +69,90 @@ class BaseMedium(object):
     def register(self):
         pass
 
-    @abstractmethod
     def subscribe(self, topic):
-        pass
+        self.topics.add(topic)
+
+    def unsubscribe(self, topic):
+        self.topics.discard(topic)
+
+    def is_subscribed(self, event_type):
+        if not self.topics:
+            return True
+
+        return any(match_topic(topic, event_type) for topic in self.topics)
 
     def get_node_info(self):
         service_info = self.service.service_info()
         service_info['node_id'] = self.node_id
-        return {'node_id': self.node_id, 'service_info': service_info}
+        return {'node_id': self.node_id, 'service_info': service_info,
+                'codecs': self.codecs}
+
+    def get_codec(self, node_id):
+        """Return the codec negotiated with node_id from the codecs it
+        advertised at registration
+        """
+        try:
+            return self.peer_codecs[node_id]
+        except KeyError:
+            peer_info = self.directory.get(node_id, {})
+            codec = negotiate_codec(self.codecs, peer_info.get('codecs', ()))
+            self.peer_codecs[node_id] = codec
+            return codec
+
+    def get_publish_codec(self):
+        """Return the preferred codec supported by every known peer, events
+        are received by all of them
+        """
+        if self._publish_codec is None:
+            codecs = self.codecs
+            for peer_info in self.directory.values():
+                peer_codecs = peer_info.get('codecs', ())
+                codecs = [name for name in codecs if name in peer_codecs]
+            self._publish_codec = negotiate_codec(codecs, codecs)
+        return self._publish_codec
 
     @abstractmethod
     def publish(self, event_type, event_data):
         pass
 
+    @asyncio.coroutine
+    def publish_many(self, events):
+        """Publish a list of (event_type, event_data), mediums able to send
+        them together should override it
+        """
+        for event_type, event_data in events:
+            yield from self.publish(event_type, event_data)
+
     def process_event(self, message_type, event_message):
+        # Topic filters are prefixes, drop events like "foobar.create" for
+        # a subscription to "foo"
+        if not self.is_subscribed(message_type):
+            return
+
         for event_listener in self.event_listeners:
             yield from event_listener(message_type, event_message)
 
     @abstractmethod
-    def send(self, node_id, message, message_type="message", wait_response=True):
+    def send(self, node_id, message, message_type="message", wait_response=True,
+             timeout=None):
         pass
 
     @asyncio.coroutine
-    def process_message(self, message_type, message, sender=None):
+    def process_message(self, message_type, message, sender=None,
+                        request_id=None, codec=None):
         self.logger.info("Process [{}] {}".format(message_type, message))
         if message_type == 'register':
             service_info = message.pop('service_info')
             yield from self.process_registration(message)
             return self.service.on_registration_message(service_info)
+        elif message_type == 'close':
+            self.forget_node(message['node_id'])
+            return self.service.on_leave_message(message)
         else:
             result = yield from self.on_message_callback(message_type=message_type, **message)
             if sender:
-                yield from self.respond(sender, result)
+                yield from self.respond(sender, result, request_id=request_id,
+                                        codec=codec)
                 return ('message', result)
 
             return result
@@ -115,9 +194,28 @@ class BaseMedium(object):
 
         if node_id not in self.directory:
             self.directory[node_id] = message
+            self.peer_codecs.pop(node_id, None)
+            self._publish_codec = None
 
             yield from self.send_registration_answer(node_id)
 
+    def forget_node(self, node_id):
+        if self.directory.pop(node_id, None) is not None:
+            self.peer_codecs.pop(node_id, None)
+            self._publish_codec = None
+
+    @asyncio.coroutine
+    def send_leave(self):
+        """Tell every known node this node is leaving, best effort
+        """
+        node_info = {'node_id': self.node_id}
+        for node_id in list(self.directory):
+            try:
+                yield from self.send(node_id, node_info, 'close',
+                                     wait_response=False)
+            except Exception:
+                self.logger.exception('Could not send leave to %s', node_id)
+
     def get_directory(self):
         return self.directory
 
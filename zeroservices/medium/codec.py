@@ -0,0 +1,155 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Binary values at least this large travel as separate frames
+DEFAULT_FRAME_THRESHOLD = 64 * 1024
+
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+FRAME_KEY = '$frame'
+# Wraps the dicts of the data which would be taken for placeholders
+ESCAPE_KEY = '$escaped'
+
+
+class JsonCodec(object):
+
+    name = 'json'
+    binary = False
+
+    def encode(self, data):
+        return json.dumps(data).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+class MsgpackCodec(object):
+
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+DEFAULT_CODEC = JsonCodec()
+
+CODECS = {DEFAULT_CODEC.name: DEFAULT_CODEC}
+
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown codec {}".format(name))
+
+
+def available_codecs():
+    """Codec names ordered by preference, binary codecs first
+    """
+    return sorted(CODECS.keys(), key=lambda name: name == DEFAULT_CODEC.name)
+
+
+def negotiate_codec(local_codecs, peer_codecs):
+    """Return the first of our codecs that the peer supports, fallback on
+    JSON for peers which don't advertise any codec
+    """
+    for name in local_codecs:
+        if name in peer_codecs:
+            return get_codec(name)
+    return DEFAULT_CODEC
+
+
+def _extract_frames(value, frames, threshold):
+    if isinstance(value, BINARY_TYPES):
+        size = value.nbytes if isinstance(value, memoryview) else len(value)
+        if size < threshold:
+            return value
+        frames.append(value)
+        return {FRAME_KEY: len(frames) - 1}
+
+    if isinstance(value, dict):
+        result = None
+        for key, item in value.items():
+            new_item = _extract_frames(item, frames, threshold)
+            if new_item is not item:
+                if result is None:
+                    result = dict(value)
+                result[key] = new_item
+        result = value if result is None else result
+        if _is_placeholder(result):
+            return {ESCAPE_KEY: result}
+        return result
+
+    if isinstance(value, (list, tuple)):
+        result = None
+        for index, item in enumerate(value):
+            new_item = _extract_frames(item, frames, threshold)
+            if new_item is not item:
+                if result is None:
+                    result = list(value)
+                result[index] = new_item
+        return value if result is None else result
+
+    return value
+
+
+def _is_placeholder(value):
+    return len(value) == 1 and (FRAME_KEY in value or ESCAPE_KEY in value)
+
+
+def _insert_frames(value, frames):
+    if isinstance(value, dict):
+        if _is_placeholder(value):
+            if FRAME_KEY in value:
+                return frames[value[FRAME_KEY]]
+            value = value[ESCAPE_KEY]
+        for key, item in value.items():
+            value[key] = _insert_frames(item, frames)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            value[index] = _insert_frames(item, frames)
+    return value
+
+
+def encode_frames(codec, data, threshold=DEFAULT_FRAME_THRESHOLD):
+    """Encode data as a list of frames, the encoded body followed by the
+    large binary values which are replaced in the body by a placeholder.
+
+    Binary values are not copied, codecs which can't encode binary values
+    get all of them as separate frames.
+    """
+    if not codec.binary:
+        threshold = 0
+
+    frames = []
+    extracted = _extract_frames(data, frames, threshold)
+    if not frames:
+        # Nothing to insert back, the data is decoded as it is
+        return [codec.encode(data)]
+    return [codec.encode(extracted)] + frames
+
+
+def decode_frames(codec, frames):
+    """Decode frames built by encode_frames, binary values are given back as
+    memoryviews on the received frames, bytes or zmq.Frame
+    """
+    data = codec.decode(frames[0])
+    if len(frames) > 1:
+        data = _insert_frames(data, [memoryview(frame) for frame in frames[1:]])
+    return data
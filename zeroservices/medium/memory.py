@@ -1,10 +1,10 @@
 import asyncio
-import json
 
 from ..medium import BaseMedium
+from ..medium.codec import encode_frames, decode_frames
 from ..resources import (ResourceCollection, Resource,
                          is_callable)
-from ..exceptions import ServiceUnavailable
+from ..exceptions import ServiceUnavailable, RequestTimeout
 from ..query import match
 
 
@@ -13,10 +13,9 @@ class MemoryMedium(BaseMedium):
 
     NODES = {}
 
-    def __init__(self, loop, discovery_class, node_id=None):
-        super().__init__(loop, discovery_class, node_id)
+    def __init__(self, loop, discovery_class, node_id=None, codecs=None):
+        super().__init__(loop, discovery_class, node_id, codecs)
 
-        self.topics = []
         self.callbacks = []
 
     @classmethod
@@ -38,9 +37,6 @@ class MemoryMedium(BaseMedium):
     def connect_to_node(self, node_id):
         pass
 
-    def subscribe(self, topic):
-        self.topics.append(topic)
-
     @asyncio.coroutine
     def publish(self, event_type, event_data):
         for node in self.NODES.values():
@@ -49,17 +45,25 @@ class MemoryMedium(BaseMedium):
             yield from node.process_event(event_type, event_data)
 
     @asyncio.coroutine
-    def send(self, node_id, message, message_type="message", wait_response=True):
+    def send(self, node_id, message, message_type="message", wait_response=True,
+             timeout=None):
         try:
             node = self.NODES[node_id]
         except KeyError:
             raise ServiceUnavailable('Service %s is unavailable.' % node_id)
 
-        # Be sure that message could be dumped in json
-        message = json.dumps(message)
+        # Be sure that message could be encoded with the negotiated codec
+        codec = self.get_codec(node_id)
+        message = decode_frames(codec, encode_frames(codec, message))
 
-        result = yield from node.process_message(message_type, json.loads(message),
-                                                 sender=self.node_id)
+        response = node.process_message(message_type, message,
+                                         sender=self.node_id)
+        try:
+            result = yield from asyncio.wait_for(response, timeout,
+                                                 loop=self.loop)
+        except asyncio.TimeoutError:
+            raise RequestTimeout('No response from %s after %ss' % (
+                node_id, timeout))
 
         if wait_response:
             assert result[0] == 'message'
@@ -68,7 +72,8 @@ class MemoryMedium(BaseMedium):
         return
 
     @asyncio.coroutine
-    def respond(self, sender, message, message_type="message"):
+    def respond(self, sender, message, message_type="message",
+                request_id=None, codec=None):
         return
 
     def send_registration_answer(self, node_id, node_info=None):
@@ -4,38 +4,163 @@ import aiozmq
 import time
 import zmq
 import sys
-import json
 import logging
 import socket
 
 from asyncio import coroutine
+from itertools import count
 from socket import AF_INET, SOCK_STREAM, SOCK_DGRAM, IPPROTO_UDP, SOL_SOCKET, SO_REUSEADDR, IPPROTO_IP, IP_MULTICAST_TTL, IP_ADD_MEMBERSHIP, inet_aton
-from os.path import join
-from os import makedirs
+from os.path import join, commonprefix, exists
+from os import makedirs, getpid, remove
+from tempfile import gettempdir
+from uuid import uuid4
 from asyncio import coroutine
 
+from zeroservices.exceptions import RequestTimeout
 from zeroservices.medium import BaseMedium
+from zeroservices.medium.codec import (DEFAULT_CODEC, DEFAULT_FRAME_THRESHOLD,
+                                       get_codec, encode_frames, decode_frames)
 
 logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 loop = asyncio.get_event_loop()
 
+# Codec frame prefix of messages holding a batch of events
+BATCH_PREFIX = 'batch+'
 
-class ServerProtocol(object):
 
-    def __init__(self, callback, loop):
-        self.callback = callback
+def write_frames(transport, frames):
+    """Write a multipart message without copying its frames when the socket
+    accepts it right away, otherwise queue it in the transport buffer.
+    """
+    if not transport.get_write_buffer_size():
+        zmq_socket = transport.get_extra_info('zmq_socket')
+        try:
+            zmq_socket.send_multipart(frames, zmq.DONTWAIT, copy=False)
+            return
+        except zmq.Again:
+            pass
+    transport.write(frames)
+
+
+class FrameSocket(zmq.Socket):
+
+    """Socket sending and receiving without copying by default, aiozmq
+    transports read and write with the default copy.
+
+    Frames are received as zmq.Frame, decode_frames hands the binary ones
+    over as memoryviews on the libzmq buffers. libzmq still copies frames
+    smaller than zmq.COPY_THRESHOLD, cheaper than tracking them.
+    """
+
+    def send_multipart(self, msg_parts, flags=0, copy=False, track=False,
+                       **kwargs):
+        return super(FrameSocket, self).send_multipart(
+            msg_parts, flags, copy=copy, track=track, **kwargs)
+
+    def recv_multipart(self, flags=0, copy=False, track=False):
+        return super(FrameSocket, self).recv_multipart(flags, copy=copy,
+                                                       track=track)
+
+
+def frame_bytes(frame):
+    """Bytes of a small header frame, received as a zmq.Frame
+    """
+    return frame.bytes if isinstance(frame, zmq.Frame) else frame
+
+
+SOCKET_KINDS = ('pub', 'server', 'sub', 'dealer')
+
+# Transports ordered from the cheapest, inproc needs the peer to live in the
+# same process and ipc on the same host
+TRANSPORTS = ('inproc', 'ipc', 'tcp')
+
+if sys.platform == 'win32':
+    TRANSPORTS = ('inproc', 'tcp')
+
+# Identify this process, the pid alone could be reused by another process
+PROCESS_TOKEN = uuid4().hex
+
+HWM_POLICIES = (None, 'drop', 'block')
+
+
+def resolve_socket_options(socket_options):
+    """Turn {kind: {option: value}} into {kind: {zmq_option: value}}, options
+    may be given by name ('sndhwm', 'tcp_keepalive'...) and options under
+    the '*' kind apply to every socket.
+    """
+    socket_options = socket_options or {}
+    resolved = {}
+    for kind in SOCKET_KINDS:
+        options = dict(socket_options.get('*', {}))
+        options.update(socket_options.get(kind, {}))
+        resolved[kind] = {}
+        for option, value in options.items():
+            if isinstance(option, str):
+                option = getattr(zmq, option.upper())
+            resolved[kind][option] = value
+    return resolved
+
+
+class FlowControlProtocol(aiozmq.ZmqProtocol):
+
+    """Base protocol which lets writers wait for the transport buffer to be
+    flushed, the transport pauses us when the socket reached its high-water
+    mark.
+    """
+
+    def __init__(self, loop):
         self.loop = loop
+        self.transport = None
+        self.paused = False
+        self._drain_waiter = None
 
     def connection_made(self, transport):
         self.transport = transport
 
+    def connection_lost(self, exc):
+        self.transport = None
+        self.resume_writing()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    @asyncio.coroutine
+    def drain(self):
+        if not self.paused:
+            return
+        if self._drain_waiter is None:
+            self._drain_waiter = asyncio.Future(loop=self.loop)
+        yield from asyncio.shield(self._drain_waiter, loop=self.loop)
+
+
+class ServerProtocol(FlowControlProtocol):
+
+    def __init__(self, callback, loop):
+        super(ServerProtocol, self).__init__(loop)
+        self.callback = callback
+
     def msg_received(self, msg):
-        sender, message_type, message = msg
+        sender, request_id, message_type, codec = map(frame_bytes, msg[:4])
         message_type = message_type.decode('utf-8')
-        message = json.loads(message.decode('utf-8'))
 
-        asyncio.async(self.callback(message_type, message, sender=sender), loop=self.loop)
+        try:
+            codec = get_codec(codec.decode('utf-8'))
+        except ValueError as e:
+            logger.warning('Drop %s message: %s', message_type, e)
+            return
+        message = decode_frames(codec, msg[4:])
+
+        callback = self.callback(message_type, message, sender=sender,
+                                 request_id=request_id or None, codec=codec)
+        asyncio.async(callback, loop=self.loop)
 
 
 class SubProtocol(object):
@@ -48,28 +173,316 @@ class SubProtocol(object):
         self.transport = transport
 
     def msg_received(self, msg):
-        event_type, event_data = msg[0].decode('utf-8').split(' ', maxsplit=1)
-        event_data = json.loads(event_data)
+        event_type, codec = map(frame_bytes, msg[:2])
+        event_type = event_type.decode('utf-8')
+        codec = codec.decode('utf-8')
+
+        batch = codec.startswith(BATCH_PREFIX)
+        if batch:
+            codec = codec[len(BATCH_PREFIX):]
+
+        try:
+            codec = get_codec(codec)
+        except ValueError as e:
+            logger.warning('Drop %s event: %s', event_type, e)
+            return
+        event_data = decode_frames(codec, msg[2:])
+
+        if batch:
+            asyncio.async(self.process_batch(event_data), loop=self.loop)
+        else:
+            asyncio.async(self.callback(event_type, event_data),
+                          loop=self.loop)
+
+    @asyncio.coroutine
+    def process_batch(self, events):
+        # Process events one after the other to keep their order
+        for event_type, event_data in events:
+            yield from self.callback(event_type, event_data)
+
+
+class EventBatch(object):
+
+    """Events published in a row and sent as one message, whose topic is
+    the common prefix of their topics.
+
+    An event is only added if every subscription matching an event of the
+    batch is still a prefix of this topic, so subscribers only receive the
+    batches holding events they subscribed to.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.topic = None
+        self.subscription_length = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, topic, event_type, event_data, subscriptions):
+        subscription_length = max(len(subscription) for subscription in
+                                  subscriptions if
+                                  topic.startswith(subscription))
+        subscription_length = max(subscription_length,
+                                  self.subscription_length)
+
+        if self.events:
+            common_topic = commonprefix([self.topic, topic])
+        else:
+            common_topic = topic
+
+        if subscription_length > len(common_topic):
+            return False
+
+        self.topic = common_topic
+        self.subscription_length = subscription_length
+        self.events.append((event_type, event_data))
+        return True
+
+
+class XPubProtocol(FlowControlProtocol):
+
+    """Keep track of the topics subscribed by peers SUB sockets, so events
+    nobody listens to are neither encoded nor sent.
+    """
+
+    def __init__(self, loop):
+        super(XPubProtocol, self).__init__(loop)
+        self.subscriptions = set()
+
+    def msg_received(self, msg):
+        subscription = frame_bytes(msg[0])
+        if subscription[:1] == b'\x01':
+            self.subscriptions.add(subscription[1:])
+        elif subscription[:1] == b'\x00':
+            self.subscriptions.discard(subscription[1:])
+
+    def has_subscriber(self, topic):
+        return any(topic.startswith(subscription) for subscription in
+                   self.subscriptions)
+
+
+class DealerProtocol(FlowControlProtocol):
+
+    """Client side of the request/response protocol.
+
+    Every request is prefixed with a request id and the ROUTER echoes it back
+    in its reply, so any number of requests can be in flight on one socket
+    and replies are resolved to the right future whatever their order.
+    """
+
+    def __init__(self, loop):
+        super(DealerProtocol, self).__init__(loop)
+        self.pending = {}
+        self.request_ids = count()
+
+    def connection_lost(self, exc):
+        super(DealerProtocol, self).connection_lost(exc)
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError('Connection lost'))
+
+    def msg_received(self, msg):
+        request_id, message_type, codec = map(frame_bytes, msg[:3])
+        future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result((message_type, codec, msg[3:]))
+
+    def request(self, msg, wait_response=True, timeout=None):
+        if not wait_response:
+            write_frames(self.transport, [b''] + msg)
+            return
+
+        request_id = ('%x' % next(self.request_ids)).encode('utf-8')
+        future = asyncio.Future(loop=self.loop)
+        self.pending[request_id] = future
+        future.add_done_callback(lambda _: self.forget(request_id, future))
+        write_frames(self.transport, [request_id] + msg)
+
+        if timeout is not None:
+            handle = self.loop.call_later(timeout, self.expire, request_id,
+                                          timeout)
+            future.add_done_callback(lambda _: handle.cancel())
+
+        return future
+
+    def forget(self, request_id, future):
+        # The waiter gave up, a late reply will be dropped
+        if future.cancelled() and self.pending.get(request_id) is future:
+            del self.pending[request_id]
+
+    def expire(self, request_id, timeout):
+        # A late reply will find no waiter and be dropped
+        future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_exception(RequestTimeout(
+                'No response after %ss' % timeout))
 
-        asyncio.async(self.callback(event_type, event_data), loop=self.loop)
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class ConnectionPool(object):
+
+    """Keep one multiplexed DEALER socket open per peer address.
+
+    Sockets without pending requests which have not been used for more than
+    `max_idle_time` seconds are closed by `evict`.
+    """
+
+    def __init__(self, loop, max_idle_time=60, socket_factory=None):
+        self.loop = loop
+        self.max_idle_time = max_idle_time
+        self.socket_factory = socket_factory
+        self.connections = {}
+        self.last_used = {}
+        self.connecting = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @asyncio.coroutine
+    def acquire(self, address):
+        self.last_used[address] = self.loop.time()
+
+        connection = self.connections.get(address)
+        if connection is not None and connection.transport is not None:
+            self.hits += 1
+            return connection
+
+        # Another request is already opening a socket to this peer
+        if address in self.connecting:
+            self.hits += 1
+            return (yield from asyncio.shield(self.connecting[address],
+                                              loop=self.loop))
+
+        self.misses += 1
+        connecting = asyncio.Future(loop=self.loop)
+        self.connecting[address] = connecting
+        try:
+            zmq_sock = None
+            if self.socket_factory is not None:
+                zmq_sock = self.socket_factory(zmq.DEALER)
+            _, connection = yield from aiozmq.create_zmq_connection(
+                lambda: DealerProtocol(self.loop), zmq.DEALER,
+                connect=address, zmq_sock=zmq_sock, loop=self.loop
+            )
+        except Exception as e:
+            connecting.set_exception(e)
+            raise
+        else:
+            connecting.set_result(connection)
+        finally:
+            del self.connecting[address]
+
+        self.connections[address] = connection
+        return connection
+
+    def discard(self, address):
+        connection = self.connections.pop(address, None)
+        self.last_used.pop(address, None)
+        if connection is not None:
+            connection.close()
+
+    def evict(self):
+        deadline = self.loop.time() - self.max_idle_time
+        for address, connection in list(self.connections.items()):
+            if connection.pending:
+                continue
+            if self.last_used.get(address, 0) < deadline:
+                self.discard(address)
+                self.evictions += 1
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+        self.last_used = {}
+
+    @property
+    def size(self):
+        return len(self.connections)
+
+    @property
+    def pending(self):
+        return sum(len(connection.pending) for connection in
+                   self.connections.values())
+
+    def stats(self):
+        return {'size': self.size, 'pending': self.pending,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
 
 
 class ZeroMQMedium(BaseMedium):
 
+    def __init__(self, loop, discovery_class, node_id=None, codecs=None,
+                 pool_max_idle_time=60,
+                 frame_threshold=DEFAULT_FRAME_THRESHOLD,
+                 batch_window=None, batch_size=100, socket_options=None,
+                 hwm_policy=None, transports=TRANSPORTS, ipc_path=None):
+        super(ZeroMQMedium, self).__init__(loop, discovery_class, node_id,
+                                           codecs)
+        self.frame_threshold = frame_threshold
+
+        # Options applied to sockets before they bind or connect
+        self.socket_options = resolve_socket_options(socket_options)
+
+        # What to do when a socket reaches its high-water mark: None keeps
+        # libzmq behavior, 'drop' drops and counts messages, 'block' makes
+        # publish and respond wait for the socket to be writable
+        if hwm_policy not in HWM_POLICIES:
+            raise ValueError("Unknown hwm_policy {}".format(hwm_policy))
+        self.hwm_policy = hwm_policy
+
+        # Local transports advertised to peers, tcp is always bound
+        self.transports = [transport for transport in transports if
+                           transport in TRANSPORTS]
+        if 'tcp' not in self.transports:
+            self.transports.append('tcp')
+        if ipc_path is None:
+            ipc_path = join(gettempdir(), 'zeroservices')
+        self.ipc_path = ipc_path
+        self.endpoints = {}
+
+        self.pool = ConnectionPool(
+            loop, max_idle_time=pool_max_idle_time,
+            socket_factory=lambda zmq_type: self.create_socket('dealer',
+                                                               zmq_type)
+        )
+        self._evict_handle = None
+        self.sub = None
+        self.skipped_events = 0
+        self.dropped_events = 0
+        self.dropped_responses = 0
+
+        # Events batching, disabled when batch_window is None, 0 batches
+        # events published during the same loop iteration
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batch = EventBatch()
+        self.batches = 0
+        self._flush_handle = None
+
     @asyncio.coroutine
     def start(self):
 
-        # Pub
-        self.pub = yield from aiozmq.create_zmq_stream(
-            zmq.PUB,
-            bind="tcp://*:*",
-            loop=self.loop
+        self.endpoints = self._local_endpoints()
+
+        # Pub, XPUB exposes peers subscriptions
+        self.pub, self.pub_t = yield from aiozmq.create_zmq_connection(
+            lambda: XPubProtocol(self.loop), zmq.XPUB,
+            bind=self._bind_endpoints('pub'),
+            zmq_sock=self.create_socket('pub', zmq.XPUB), loop=self.loop
         )
 
         # Server
         self.server, self.server_t = yield from aiozmq.create_zmq_connection(
             lambda: ServerProtocol(self.process_message, self.loop),
-            zmq.ROUTER, bind="tcp://*:*",
+            zmq.ROUTER, bind=self._bind_endpoints('server'),
+            zmq_sock=self.create_socket('server', zmq.ROUTER),
             loop=self.loop
         )
         self.server_t.transport.setsockopt(zmq.IDENTITY, self.node_id.encode('utf-8'))
@@ -78,72 +491,331 @@ class ZeroMQMedium(BaseMedium):
         self.sub, _ = yield from aiozmq.create_zmq_connection(
             lambda: SubProtocol(self.process_event, self.loop),
             zmq.SUB,
+            zmq_sock=self.create_socket('sub', zmq.SUB),
             loop=self.loop
         )
+        self._apply_subscriptions()
+
+        self._schedule_eviction()
 
         yield from super(ZeroMQMedium, self).start()
 
+    def _local_endpoints(self):
+        endpoints = {}
+        if 'inproc' in self.transports:
+            endpoints['inproc'] = {
+                kind: 'inproc://zeroservices-%s-%s' % (self.node_id, kind)
+                for kind in ('server', 'pub')}
+        if 'ipc' in self.transports:
+            try:
+                makedirs(self.ipc_path)
+            except OSError:
+                # Path exists
+                pass
+            endpoints['ipc'] = {
+                kind: 'ipc://%s' % join(self.ipc_path, '%s-%s.sock' % (
+                    self.node_id, kind))
+                for kind in ('server', 'pub')}
+        return endpoints
+
+    def _bind_endpoints(self, kind):
+        bind = ['tcp://*:*']
+        for endpoints in self.endpoints.values():
+            bind.append(endpoints[kind])
+        return bind
+
+    def get_endpoint(self, node_id, kind):
+        """Return the cheapest endpoint to reach the kind ('server' or 'pub')
+        socket of node_id
+        """
+        peer_info = self.directory[node_id]
+        peer_endpoints = peer_info.get('endpoints', {})
+
+        same_host = peer_info.get('host') == socket.gethostname()
+        same_process = same_host and peer_info.get('process') == \
+            self.get_process()
+
+        if same_process and 'inproc' in self.endpoints and \
+                'inproc' in peer_endpoints:
+            return peer_endpoints['inproc'][kind]
+
+        if same_host and 'ipc' in self.endpoints and 'ipc' in peer_endpoints:
+            endpoint = peer_endpoints['ipc'][kind]
+            # Hosts may share a hostname without sharing a filesystem
+            if exists(endpoint[len('ipc://'):]):
+                return endpoint
+
+        port = peer_info['%s_port' % kind]
+        return 'tcp://%s:%s' % (peer_info['address'], port)
+
+    @staticmethod
+    def get_process():
+        return '%s-%s' % (getpid(), PROCESS_TOKEN)
+
+    def create_socket(self, kind, zmq_type):
+        zmq_sock = FrameSocket(zmq.Context.instance(), zmq_type)
+        for option, value in self.socket_options[kind].items():
+            zmq_sock.setsockopt(option, value)
+
+        if self.hwm_policy is not None:
+            # Let us see the high-water mark instead of libzmq silently
+            # dropping messages
+            if zmq_type == zmq.XPUB:
+                zmq_sock.setsockopt(zmq.XPUB_NODROP, 1)
+            elif zmq_type == zmq.ROUTER:
+                zmq_sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
+
+        return zmq_sock
+
+    def stats(self):
+        return {'pool': self.pool.stats(),
+                'skipped_events': self.skipped_events,
+                'dropped_events': self.dropped_events,
+                'dropped_responses': self.dropped_responses,
+                'batches': self.batches}
+
+    def _schedule_eviction(self):
+        def evict():
+            self.pool.evict()
+            self._schedule_eviction()
+
+        delay = max(self.pool.max_idle_time / 2, 1)
+        self._evict_handle = self.loop.call_later(delay, evict)
+
     def close(self):
+        if self._evict_handle is not None:
+            self._evict_handle.cancel()
+            self._evict_handle = None
+        self.flush()
+        self.pool.close()
         self.server.close()
         self.pub.close()
         self.sub.close()
+
+        for endpoint in self.endpoints.get('ipc', {}).values():
+            try:
+                remove(endpoint[len('ipc://'):])
+            except OSError:
+                pass
+
         super(ZeroMQMedium, self).close()
 
     def get_node_info(self):
         node_info = super(ZeroMQMedium, self).get_node_info()
 
-        node_info['server_port'] = int(tuple(self.server.bindings())[0].split(':')[-1])
-        node_info['pub_port'] = int(tuple(self.pub._transport.bindings())[0].split(':')[-1])
+        node_info['server_port'] = self._tcp_port(self.server)
+        node_info['pub_port'] = self._tcp_port(self.pub)
+        node_info['host'] = socket.gethostname()
+        node_info['process'] = self.get_process()
+        node_info['endpoints'] = self.endpoints
 
         return node_info
 
+    @staticmethod
+    def _tcp_port(transport):
+        for binding in transport.bindings():
+            if binding.startswith('tcp://'):
+                return int(binding.split(':')[-1])
+
+    def _apply_subscriptions(self):
+        """Sync the SUB socket filters with topics, peers connecting later
+        receive them from the socket too
+        """
+        if self.sub is None:
+            return
+
+        wanted = set(topic.encode('utf-8') for topic in self.topics)
+        if not wanted:
+            wanted = {b''}
+
+        current = set(self.sub.subscriptions())
+        for topic in current - wanted:
+            self.sub.unsubscribe(topic)
+        for topic in wanted - current:
+            self.sub.subscribe(topic)
+
+    def subscribe(self, topic):
+        super(ZeroMQMedium, self).subscribe(topic)
+        self._apply_subscriptions()
+
+    def unsubscribe(self, topic):
+        super(ZeroMQMedium, self).unsubscribe(topic)
+        self._apply_subscriptions()
+
     def connect_to_node(self, node_id):
-        peer_info = self.directory[node_id]
-        peer_address = 'tcp://%s:%s' % (peer_info['address'],
-                                        peer_info['pub_port'])
+        peer_address = self.get_endpoint(node_id, 'pub')
         self.logger.debug('Connecting my sub socket to %s' % peer_address)
         self.sub.connect(peer_address)
-        self.sub.setsockopt(zmq.SUBSCRIBE, ''.encode('utf-8'))
 
-    @coroutine
-    def send(self, node_id, message, message_type="message", wait_response=True):
-        peer_info = self.directory[node_id]
+        if peer_address.startswith('inproc://'):
+            # libzmq only wakes up an inproc reader which polled the pipe
+            # once, else the first events would stay unnoticed on the socket
+            self.sub.get_extra_info('zmq_socket').getsockopt(zmq.EVENTS)
 
-        address = peer_info['address']
-        port = peer_info['server_port']
+    def forget_node(self, node_id):
+        if node_id in self.directory:
+            self.pool.discard(self.get_endpoint(node_id, 'server'))
+            peer_address = self.get_endpoint(node_id, 'pub')
+            if self.sub is not None and \
+                    peer_address in self.sub.connections():
+                self.sub.disconnect(peer_address)
+        super(ZeroMQMedium, self).forget_node(node_id)
 
-        address = 'tcp://%(address)s:%(port)s' % locals()
-        request_socket = yield from aiozmq.create_zmq_stream(
-            zmq.DEALER, connect=address, loop=self.loop
-        )
+    @coroutine
+    def send(self, node_id, message, message_type="message", wait_response=True,
+             timeout=None):
+        address = self.get_endpoint(node_id, 'server')
+        connection = yield from self.pool.acquire(address)
+
+        codec = self.get_codec(node_id)
+        self.logger.info('Send %s/%s to %s', message_type, message, address)
+        frames = [message_type.encode('utf-8'), codec.name.encode('utf-8')]
+        frames.extend(encode_frames(codec, message, self.frame_threshold))
+
+        if not wait_response:
+            connection.request(frames, wait_response=False)
+            if self.hwm_policy == 'block':
+                yield from connection.drain()
+            return
+
+        response = connection.request(frames, timeout=timeout)
+        if self.hwm_policy == 'block':
+            yield from connection.drain()
+
+        try:
+            message_type, codec, frames = yield from response
+        except RequestTimeout:
+            # The peer may be dead, don't let the socket queue more requests
+            # to it unless others are still waiting on it
+            if not connection.pending:
+                self.pool.discard(address)
+            raise
+        assert message_type.decode('utf-8') == 'message'
+        return decode_frames(get_codec(codec.decode('utf-8')), frames)
+
+    @coroutine
+    def publish(self, event_type, event_data):
+        topic = event_type.encode('utf-8')
+        if not self.pub_t.has_subscriber(topic):
+            self.skipped_events += 1
+            return
 
-        log_info = (message_type, json.dumps(message), address)
-        self.logger.info('Send %s/%s to %s' % log_info)
-        message = (message_type.encode('utf-8'), json.dumps(message).encode('utf-8'))
-        request_socket.write(message)
+        self.logger.debug("Publish %s %s", event_type, event_data)
 
-        if wait_response:
-            message_type, message = yield from request_socket.read()
-            request_socket.close()
-            assert message_type.decode('utf-8') == 'message'
-            return json.loads(message.decode('utf-8'))
+        if self.batch_window is None:
+            self._write_event(topic, '', event_data)
+        else:
+            self._batch_event(topic, event_type, event_data)
 
-        yield from request_socket.drain()
-        request_socket.close()
+        if self.hwm_policy == 'block':
+            yield from self.pub_t.drain()
 
     @coroutine
-    def publish(self, event_type, event_data):
-        self.logger.debug("Publish %s %s" % (event_type, event_data))
-        pub_message = '%s %s' % (event_type, json.dumps(event_data))
-        pub_message = (pub_message.encode('utf-8'),)
-        self.pub.write(pub_message)
+    def publish_many(self, events):
+        """Publish a list of (event_type, event_data), they are sent in
+        batches even when batch_window is None
+        """
+        for event_type, event_data in events:
+            topic = event_type.encode('utf-8')
+            if not self.pub_t.has_subscriber(topic):
+                self.skipped_events += 1
+                continue
+            self._batch_event(topic, event_type, event_data)
+
+        if self.batch_window is None:
+            self.flush()
+
+        if self.hwm_policy == 'block':
+            yield from self.pub_t.drain()
+
+    def _batch_event(self, topic, event_type, event_data):
+        subscriptions = self.pub_t.subscriptions
+        if not self.batch.add(topic, event_type, event_data, subscriptions):
+            self.flush()
+            self.batch.add(topic, event_type, event_data, subscriptions)
+
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            if self.batch_window:
+                self._flush_handle = self.loop.call_later(self.batch_window,
+                                                          self.flush)
+            else:
+                self._flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Send the pending batch of events
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self.batch = self.batch, EventBatch()
+        if len(batch) == 1:
+            self._write_event(batch.topic, '', batch.events[0][1])
+        elif batch:
+            self._write_event(batch.topic, BATCH_PREFIX, batch.events,
+                              len(batch))
+            self.batches += 1
+
+    def _write_event(self, topic, codec_prefix, event_data, count=1):
+        # The socket reached its high-water mark and the transport is
+        # already buffering
+        if self.hwm_policy == 'drop' and self.pub.get_write_buffer_size():
+            self.dropped_events += count
+            return
+
+        codec = self.get_publish_codec()
+        pub_message = [topic, (codec_prefix + codec.name).encode('utf-8')]
+        pub_message.extend(encode_frames(codec, event_data,
+                                         self.frame_threshold))
+        write_frames(self.pub, pub_message)
+
+    @asyncio.coroutine
+    def respond(self, sender, message, message_type="message",
+                request_id=None, codec=None):
+        # The requester doesn't wait for an answer
+        if request_id is None:
+            return
 
-        return
+        # Answer with the codec used by the request
+        if codec is None:
+            codec = DEFAULT_CODEC
+
+        data = [sender, request_id, message_type.encode('utf-8'),
+                codec.name.encode('utf-8')]
+        data.extend(encode_frames(codec, message, self.frame_threshold))
+
+        if self.hwm_policy is None:
+            write_frames(self.server, data)
+        else:
+            yield from self._send_response(data)
 
     @asyncio.coroutine
-    def respond(self, sender, message, message_type="message"):
-        data = (sender, message_type.encode('utf-8'), json.dumps(message).encode('utf-8'))
-        self.server.write(data)
+    def _send_response(self, data):
+        """Send a response on the ROUTER socket with ROUTER_MANDATORY set,
+        the transport would close the socket on unroutable messages so we
+        send them ourselves.
+        """
+        zmq_socket = self.server.get_extra_info('zmq_socket')
+        delay = 0.001
+        while True:
+            try:
+                zmq_socket.send_multipart(data, zmq.DONTWAIT, copy=False)
+                return
+            except zmq.Again:
+                # Requester reached its high-water mark
+                if self.hwm_policy == 'drop':
+                    break
+                yield from asyncio.sleep(delay, loop=self.loop)
+                delay = min(delay * 2, 0.1)
+            except zmq.ZMQError as e:
+                # Requester is gone
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                break
+
+        self.dropped_responses += 1
 
     def send_registration_answer(self, node_id, node_info=None):
         node_info = self.get_node_info()
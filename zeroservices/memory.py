@@ -1,13 +1,30 @@
+from collections import OrderedDict
+from itertools import count
+from uuid import uuid4
+
 from .medium import BaseMedium
 from .resources import (ResourceCollection, Resource,
                          is_callable)
 from .exceptions import ServiceUnavailable
-from .query import match
+from .query import compile_query, paginate, project
+from .indexes import create_index
 
 
 # Memory Collection
 
 
+def _missing(resource_id):
+    return _failed(resource_id, 'No resource %s' % resource_id)
+
+
+def _failed(resource_id, error):
+    return {'resource_id': resource_id, 'success': False, 'error': error}
+
+
+def _item_id(item):
+    return item.get('resource_id') if isinstance(item, dict) else None
+
+
 class MemoryResource(Resource):
 
     def __init__(self, collection, **kwargs):
@@ -16,34 +33,43 @@ class MemoryResource(Resource):
 
     @is_callable
     def create(self, resource_data):
+        if self.resource_id in self.collection:
+            self.resource_collection.unindex(
+                self.resource_id, self.collection[self.resource_id])
         self.collection[self.resource_id] = resource_data
+        self.resource_collection.index(self.resource_id, resource_data)
         yield from self.publish('create', {'action': 'create', 'resource_data': resource_data})
         return {'resource_id': self.resource_id}
 
     @is_callable
-    def get(self):
+    def get(self, fields=None):
         try:
-            resource = {'resource_id': self.resource_id,
-                         'resource_data': self.collection[self.resource_id]}
+            resource_data = self.collection[self.resource_id]
         except KeyError:
             return 'NOK'
-        return resource
+        return {'resource_id': self.resource_id,
+                'resource_data': project(resource_data, fields)}
 
     @is_callable
     def patch(self, patch):
         resource = self.collection[self.resource_id]
+        self.resource_collection.unindex(self.resource_id, resource)
 
         set_keys = patch['$set']
         for key, value in set_keys.items():
             resource[key] = value
 
+        self.resource_collection.index(self.resource_id, resource)
+
         yield from self.publish('patch', {'action': 'patch', 'patch': patch})
 
         return resource
 
     @is_callable
     def delete(self):
-        del self.collection[self.resource_id]
+        resource = self.collection.pop(self.resource_id)
+        self.resource_collection.unindex(self.resource_id, resource)
+        self.resource_collection.record_change(self.resource_id, deleted=True)
         yield from self.publish('delete', {'action': 'delete'})
         return 'OK'
 
@@ -51,11 +77,15 @@ class MemoryResource(Resource):
     def add_link(self, relation, target_id, title):
         target_relation = target_id[0]
         resource = self.collection[self.resource_id]
+        self.resource_collection.unindex(self.resource_id, resource)
+
         links = resource.setdefault('_links', {})
         links.setdefault(relation, []).append({'target_id': target_id,
                                                'title': title})
         links.setdefault('latest', {})[target_relation] = target_id
 
+        self.resource_collection.index(self.resource_id, resource)
+
         event = {'action': 'add_link', 'target_id': target_id,
                  'title': title, 'relation': relation}
         yield from self.publish('add_link', event)
@@ -66,25 +96,270 @@ class MemoryCollection(ResourceCollection):
 
     resource_class = MemoryResource
 
-    def __init__(self, collection_name):
-        super(MemoryCollection, self).__init__(collection_name)
+    # Indexes declared by subclasses, {field_name: 'hash' or 'sorted'}
+    indexes = {}
+
+    # Deleted resources remembered for list(since=...)
+    max_tombstones = 10000
+
+    def __init__(self, collection_name, sharded=None, indexes=None):
+        super(MemoryCollection, self).__init__(collection_name, sharded)
         self._collection = {}
+        self._indexes = {}
+        # Resource id -> insertion rank, index lookups are listed in the
+        # order of the collection
+        self._positions = {}
+        self._next_position = count()
+
+        # Change sequence, the epoch tells apart the sequences of two
+        # instances of the collection
+        self.epoch = uuid4().hex
+        self.seq = 0
+        # Resource id -> (seq, deleted) of its last change, ordered by seq
+        self.changes = OrderedDict()
+        self.tombstones = 0
+        # Changes up to this seq may have been forgotten
+        self.forgotten_seq = 0
+
+        declared = dict(self.indexes)
+        declared.update(indexes or {})
+        for field_name, kind in declared.items():
+            self.create_index(field_name, kind)
+
+    def create_index(self, field_name, kind='hash'):
+        """Index field_name, a dotted path could index a sub-document field
+        """
+        index = create_index(field_name, kind)
+        for resource_id, resource_data in self._collection.items():
+            index.add(resource_id, resource_data)
+        self._indexes[field_name] = index
+
+    def index(self, resource_id, resource_data):
+        """Index a new version of the resource and record its change
+        """
+        for index in self._indexes.values():
+            index.add(resource_id, resource_data)
+        if resource_id not in self._positions:
+            self._positions[resource_id] = next(self._next_position)
+        self.record_change(resource_id)
+
+    def unindex(self, resource_id, resource_data):
+        for index in self._indexes.values():
+            index.remove(resource_id, resource_data)
+
+    def record_change(self, resource_id, deleted=False):
+        self.seq += 1
+        previous = self.changes.pop(resource_id, None)
+        if previous is not None and previous[1]:
+            self.tombstones -= 1
+        self.changes[resource_id] = (self.seq, deleted)
+
+        if deleted:
+            self._positions.pop(resource_id, None)
+            self.tombstones += 1
+            if self.tombstones > self.max_tombstones:
+                self._forget_tombstones()
+
+    def _forget_tombstones(self):
+        # Forget the oldest half of the tombstones at once
+        for resource_id, (seq, deleted) in list(self.changes.items()):
+            if self.tombstones <= self.max_tombstones // 2:
+                break
+            if deleted:
+                del self.changes[resource_id]
+                self.tombstones -= 1
+                self.forgotten_seq = seq
+
+    def _candidates(self, where):
+        """Return the ids of the resources which may match where using the
+        indexes, None when no index could be used
+        """
+        candidates = None
+        for field_name, query_field_value in where.items():
+            index = self._indexes.get(field_name)
+            if index is None:
+                continue
+            resource_ids = index.lookup(query_field_value)
+            if resource_ids is None:
+                continue
+            if candidates is None:
+                candidates = resource_ids
+            else:
+                candidates &= resource_ids
+        return candidates
 
     def instantiate(self, **kwargs):
         return super(MemoryCollection, self).instantiate(
             collection=self._collection, **kwargs)
 
     @is_callable
-    def list(self, where=None):
-        resources = []
-        for resource_id, resource_data in self._collection.items():
+    def list(self, where=None, limit=None, after=None, sort=None,
+             fields=None, since=None, epoch=None):
+        """List resources matching where, sorted by the sort fields.
 
-            # Filtering happens here
-            if where:
-                if not match(where, resource_data):
-                    continue
+        With a limit, return a page {'resources': [...], 'cursor': cursor},
+        pass the cursor as after to get the next page. Only the fields of
+        the projection are returned when given.
+
+        With since, return the changes after this seq instead, see
+        list_changes.
+        """
+        if since is not None:
+            return self.list_changes(where, since, epoch, fields)
+
+        resources = self._iter_resources(where)
+        if limit is None and after is None and sort is None:
+            result = list(resources)
+        else:
+            result = paginate(resources, sort, limit, after)
 
+        if fields is not None:
+            page = result['resources'] if limit is not None else result
+            page[:] = [{'resource_id': resource['resource_id'],
+                        'resource_data': project(resource['resource_data'],
+                                                 fields)} for
+                       resource in page]
+        return result
+
+    @is_callable
+    def bulk_create(self, resources):
+        """Create a list of {'resource_id': ..., 'resource_data': ...}, a
+        resource_id is generated when missing. Return one result per item.
+        """
+        results, events = [], []
+        for resource in resources:
+            try:
+                resource_id = resource.get('resource_id') or uuid4().hex
+                resource_data = resource['resource_data']
+                if not isinstance(resource_data, dict):
+                    raise TypeError('resource_data must be a dict')
+            except (AttributeError, KeyError, TypeError) as e:
+                results.append(_failed(_item_id(resource),
+                                       'Invalid resource: %r' % e))
+                continue
+
+            if resource_id in self._collection:
+                self.unindex(resource_id, self._collection[resource_id])
+            self._collection[resource_id] = resource_data
+            self.index(resource_id, resource_data)
+
+            events.append(('create.%s' % resource_id,
+                           {'action': 'create', 'resource_data': resource_data,
+                            'resource_id': resource_id}))
+            results.append({'resource_id': resource_id, 'success': True})
+
+        yield from self.publish_many(events)
+        return results
+
+    @is_callable
+    def bulk_patch(self, patches):
+        """Apply a list of {'resource_id': ..., 'patch': ...}. Return one
+        result per item.
+        """
+        results, events = [], []
+        for item in patches:
+            try:
+                resource_id, patch = item['resource_id'], item['patch']
+                set_keys = dict(patch['$set'])
+            except (KeyError, TypeError, ValueError) as e:
+                results.append(_failed(_item_id(item),
+                                       'Invalid patch: %r' % e))
+                continue
+
+            try:
+                resource = self._collection[resource_id]
+            except KeyError:
+                results.append(_missing(resource_id))
+                continue
+
+            self.unindex(resource_id, resource)
+            resource.update(set_keys)
+            self.index(resource_id, resource)
+
+            events.append(('patch.%s' % resource_id,
+                           {'action': 'patch', 'patch': patch,
+                            'resource_id': resource_id}))
+            results.append({'resource_id': resource_id, 'success': True})
+
+        yield from self.publish_many(events)
+        return results
+
+    @is_callable
+    def bulk_delete(self, resource_ids):
+        """Delete a list of resource ids. Return one result per id.
+        """
+        results, events = [], []
+        for resource_id in resource_ids:
+            try:
+                resource = self._collection.pop(resource_id)
+            except (KeyError, TypeError):
+                results.append(_missing(resource_id))
+                continue
+
+            self.unindex(resource_id, resource)
+            self.record_change(resource_id, deleted=True)
+
+            events.append(('delete.%s' % resource_id,
+                           {'action': 'delete', 'resource_id': resource_id}))
+            results.append({'resource_id': resource_id, 'success': True})
+
+        yield from self.publish_many(events)
+        return results
+
+    def list_changes(self, where=None, since=0, epoch=None, fields=None):
+        """Return the resources matching where changed after the since seq
+        of epoch and the ids of those deleted, in the order of their
+        changes: {'epoch', 'seq', 'resources', 'deleted', 'resync'}.
+
+        Pass the returned epoch and seq to get the next changes. When
+        they can't be honored (other epoch, forgotten changes), every
+        resource is returned and resync is True.
+        """
+        resync = (epoch != self.epoch or since < self.forgotten_seq or
+                  since > self.seq)
+        if resync:
+            since = 0
+
+        changed = []
+        for resource_id in reversed(self.changes):
+            seq, deleted = self.changes[resource_id]
+            if seq <= since:
+                break
+            changed.append((resource_id, deleted))
+        changed.reverse()
+
+        matcher = compile_query(where) if where else None
+        resources, deleted_ids = [], []
+        for resource_id, deleted in changed:
+            if deleted:
+                deleted_ids.append(resource_id)
+                continue
+            resource_data = self._collection[resource_id]
+            if matcher is not None and not matcher(resource_data):
+                continue
             resources.append({'resource_id': resource_id,
-                               'resource_data': resource_data})
+                              'resource_data': project(resource_data,
+                                                       fields)})
+
+        return {'epoch': self.epoch, 'seq': self.seq, 'resources': resources,
+                'deleted': deleted_ids, 'resync': resync}
+
+    def _iter_resources(self, where=None):
+        items = self._collection.items()
+        if where:
+            candidates = self._candidates(where)
+            if candidates is not None:
+                items = [(resource_id, self._collection[resource_id]) for
+                         resource_id in sorted(
+                             candidates, key=self._positions.__getitem__)]
+
+        matcher = compile_query(where) if where else None
+
+        for resource_id, resource_data in items:
+
+            # Filtering happens here
+            if matcher is not None and not matcher(resource_data):
+                continue
 
-        return resources
+            yield {'resource_id': resource_id,
+                   'resource_data': resource_data}
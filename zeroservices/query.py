@@ -1,11 +1,412 @@
+import heapq
+import asyncio
+import operator
+
+from collections import OrderedDict
+from copy import deepcopy
+from functools import total_ordering
+
+
+# Returned by get_field for fields missing from a resource
+MISSING = object()
+
+# Compiled queries kept by compile_query
+QUERY_CACHE_SIZE = 256
+
+_query_cache = OrderedDict()
+
+
+def get_field(resource, field_name, default=None):
+    """Return a field of resource, field_name could be a dotted path to a
+    field of a sub-document
+
+    >>> get_field({'foo': {'bar': 42}}, 'foo.bar')
+    42
+    """
+    if field_name in resource:
+        return resource[field_name]
+
+    value = resource
+    for part in field_name.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return default
+        value = value[part]
+    return value
+
+
+def equals(value, other):
+    """Compare values like their JSON encoding would, tuples equal lists
+    """
+    if isinstance(value, (list, tuple)) and isinstance(other, (list, tuple)):
+        return len(value) == len(other) and \
+            all(equals(item, other_item) for item, other_item in
+                zip(value, other))
+    if isinstance(value, dict) and isinstance(other, dict):
+        return value.keys() == other.keys() and \
+            all(equals(item, other[key]) for key, item in value.items())
+    return value == other
+
+
+def _equal(value, operand):
+    if value is MISSING:
+        value = None
+    if equals(value, operand):
+        return True
+    # Arrays match the values they contain
+    if isinstance(value, (list, tuple)):
+        return any(equals(item, operand) for item in value)
+    return False
+
+
+def _compare(compare):
+    def operator_function(value, operand):
+        try:
+            return compare(value, operand)
+        except TypeError:
+            # Values which can't be compared, like None and 3
+            return False
+    return operator_function
+
+
+def _in(value, operand):
+    return any(_equal(value, item) for item in operand)
+
+
+def _elem_match(value, matcher):
+    if not isinstance(value, (list, tuple)):
+        return False
+    return any(matcher(item) for item in value)
+
+
+# Field operators, {'field': {'$gt': 3, '$lt': 10}}
+OPERATORS = {
+    '$eq': _equal,
+    '$ne': lambda value, operand: not _equal(value, operand),
+    '$gt': _compare(operator.gt),
+    '$gte': _compare(operator.ge),
+    '$lt': _compare(operator.lt),
+    '$lte': _compare(operator.le),
+    '$in': _in,
+    '$nin': lambda value, operand: not _in(value, operand),
+    '$exists': lambda value, operand: (value is not MISSING) == bool(operand),
+    '$elemMatch': _elem_match,
+}
+
+
+def get_operators(query_field_value):
+    """Return the operators of a field query, None for an equality query
+    """
+    if isinstance(query_field_value, dict) and query_field_value and \
+            all(key.startswith('$') for key in query_field_value):
+        return query_field_value
+    return None
+
+
+def _compile_field(query_field_value):
+    operators = get_operators(query_field_value)
+    if operators is None:
+        return lambda value: _equal(value, query_field_value)
+
+    checks = []
+    for operator_name, operand in operators.items():
+        try:
+            operator_function = OPERATORS[operator_name]
+        except KeyError:
+            raise ValueError("Unknown query operator {}".format(operator_name))
+
+        if operator_name == '$elemMatch':
+            # Either a query on documents or operators on the values
+            if get_operators(operand) is None:
+                operand = _compile(operand)
+            else:
+                operand = _compile_field(operand)
+        checks.append((operator_function, operand))
+
+    def match_field(value):
+        for operator_function, operand in checks:
+            if not operator_function(value, operand):
+                return False
+        return True
+    return match_field
+
+
+def _compile(query):
+    matchers = []
+    for query_field_name, query_field_value in query.items():
+        if query_field_name in ('$and', '$or'):
+            sub_matchers = [_compile(sub_query) for sub_query in
+                            query_field_value]
+            combine = all if query_field_name == '$and' else any
+            matchers.append(lambda resource, sub_matchers=sub_matchers,
+                            combine=combine: combine(
+                                sub_matcher(resource) for sub_matcher in
+                                sub_matchers))
+            continue
+
+        match_field = _compile_field(query_field_value)
+
+        def match_document(resource, field_name=query_field_name,
+                           match_field=match_field):
+            if not isinstance(resource, dict):
+                return False
+            return match_field(get_field(resource, field_name, MISSING))
+        matchers.append(match_document)
+
+    def match_query(resource):
+        for matcher in matchers:
+            if not matcher(resource):
+                return False
+        return True
+    return match_query
+
+
+def canonical(query):
+    """Hashable form of a query, equal for queries which match the same
+    resources whatever their keys order
+
+    >>> canonical({'b': [1, 2], 'a': 1}) == canonical({'a': 1, 'b': (1, 2)})
+    True
+    """
+    if isinstance(query, dict):
+        return ('dict', tuple(sorted((key, canonical(value)) for key, value in
+                                     query.items())))
+    if isinstance(query, (list, tuple)):
+        return ('list', tuple(canonical(item) for item in query))
+    return (type(query).__name__, query)
+
+
+def compile_query(query):
+    """Compile a query inspired by MongoDB into a function telling whether
+    a resource matches it, compiled queries are cached.
+
+    >>> is_big = compile_query({'size': {'$gt': 10}})
+    >>> is_big({'size': 42}), is_big({'size': 1}), is_big({})
+    (True, False, False)
+    """
+    key = canonical(query)
+    try:
+        matcher = _query_cache.pop(key)
+    except KeyError:
+        # The caller may change the query after
+        matcher = _compile(deepcopy(query))
+    except TypeError:
+        # Unhashable values in the query, don't cache it
+        return _compile(query)
+
+    _query_cache[key] = matcher
+    if len(_query_cache) > QUERY_CACHE_SIZE:
+        _query_cache.popitem(last=False)
+    return matcher
+
+
 def match(query, resource):
     """Validated a query inspired by MongoDB and TaffyDB queries languages
     """
-    for query_field_name, query_field_value in query.items():
-        if resource.get(query_field_name) != query_field_value:
-            return False
+    return compile_query(query)(resource)
+
+
+def parse_fields(fields):
+    """Return (field names, exclude) from a projection, a list of field names
+    to keep or of field names prefixed by '-' to drop
 
-    return True
+    >>> parse_fields(['-_links', '-history'])
+    (['_links', 'history'], True)
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+
+    excluded = [field_name.startswith('-') for field_name in fields]
+    if any(excluded) and not all(excluded):
+        raise ValueError("Can't mix kept and dropped fields in {}".format(
+            fields))
+
+    if all(excluded) and fields:
+        return [field_name[1:] for field_name in fields], True
+    return list(fields), False
+
+
+def extend_projection(fields, field_names):
+    """Return a projection which also keeps field_names, None keeps every
+    field
+    """
+    names, exclude = parse_fields(fields)
+    if exclude:
+        names = [name for name in names if name not in field_names]
+        return ['-' + name for name in names] or None
+    return names + [name for name in field_names if name not in names]
+
+
+def project(resource_data, fields):
+    """Return a copy of resource_data with only the projected fields, fields
+    could be dotted paths to fields of sub-documents
+
+    >>> project({'a': 1, 'b': {'c': 2, 'd': 3}}, ['b.c'])
+    {'b': {'c': 2}}
+    """
+    if fields is None:
+        return resource_data
+
+    field_names, exclude = parse_fields(fields)
+
+    if exclude:
+        result = dict(resource_data)
+        for field_name in field_names:
+            if field_name in result:
+                del result[field_name]
+                continue
+
+            # Copy the sub-documents on the path before changing them
+            parts = field_name.split('.')
+            document = result
+            for part in parts[:-1]:
+                if not isinstance(document.get(part), dict):
+                    break
+                document[part] = dict(document[part])
+                document = document[part]
+            else:
+                document.pop(parts[-1], None)
+        return result
+
+    result = {}
+    for field_name in field_names:
+        value = get_field(resource_data, field_name, MISSING)
+        if value is MISSING:
+            continue
+        if field_name in resource_data:
+            result[field_name] = value
+            continue
+
+        parts = field_name.split('.')
+        document = result
+        for part in parts[:-1]:
+            document = document.setdefault(part, {})
+        document[parts[-1]] = value
+    return result
+
+
+@total_ordering
+class SortValue(object):
+
+    """Order values of any type like MongoDB does: None, then numbers, then
+    strings, then documents and arrays. Descending values compare reversed.
+    """
+
+    __slots__ = ('rank', 'value', 'descending')
+
+    def __init__(self, value, descending=False):
+        if value is None or value is MISSING:
+            self.rank, value = 0, None
+        elif isinstance(value, (int, float)):
+            self.rank = 1
+        elif isinstance(value, str):
+            self.rank = 2
+        else:
+            # Compare what can't be ordered by its canonical form
+            self.rank, value = 3, repr(canonical(value))
+        self.value = value
+        self.descending = descending
+
+    def __eq__(self, other):
+        return (self.rank, self.value) == (other.rank, other.value)
+
+    def __lt__(self, other):
+        if self.descending:
+            return (other.rank, other.value) < (self.rank, self.value)
+        return (self.rank, self.value) < (other.rank, other.value)
+
+
+def parse_sort(sort):
+    """Return [(field_name, descending)] from a field name or a list of
+    field names, prefixed by '-' for a descending order
+
+    >>> parse_sort(['-size', 'name'])
+    [('size', True), ('name', False)]
+    """
+    if not sort:
+        return []
+    if isinstance(sort, str):
+        sort = [sort]
+
+    parsed = []
+    for field_name in sort:
+        if isinstance(field_name, (list, tuple)):
+            # Already parsed
+            parsed.append(tuple(field_name))
+        elif field_name.startswith('-'):
+            parsed.append((field_name[1:], True))
+        else:
+            parsed.append((field_name, False))
+    return parsed
+
+
+def sort_key(sort):
+    """Return a function giving the sort key of a {'resource_id',
+    'resource_data'} resource, ties are broken by resource_id
+    """
+    sort = parse_sort(sort)
+
+    def key(resource):
+        resource_data = resource['resource_data']
+        return tuple(SortValue(get_field(resource_data, field_name),
+                               descending) for field_name, descending in
+                     sort) + (SortValue(resource['resource_id']),)
+    return key
+
+
+def make_cursor(sort, resource):
+    """Cursor pointing after resource, the values of its sort fields
+    followed by its id
+    """
+    resource_data = resource['resource_data']
+    return [get_field(resource_data, field_name) for field_name, _ in
+            parse_sort(sort)] + [resource['resource_id']]
+
+
+def cursor_key(sort, cursor):
+    sort = parse_sort(sort)
+    if len(cursor) != len(sort) + 1:
+        raise ValueError("Cursor {} doesn't match sort {}".format(cursor,
+                                                                 sort))
+    return tuple(SortValue(value, descending) for value, (_, descending) in
+                 zip(cursor, sort)) + (SortValue(cursor[-1]),)
+
+
+def check_limit(limit):
+    """Raise a ValueError unless limit is None or a positive integer
+    """
+    if limit is None:
+        return
+    if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+        raise ValueError("limit must be a positive integer, got "
+                         "{!r}".format(limit))
+
+
+def paginate(resources, sort=None, limit=None, after=None):
+    """Sort {'resource_id', 'resource_data'} resources and return those
+    after the cursor.
+
+    Without limit the resources are returned as a list, else as a page
+    {'resources': [...], 'cursor': cursor} where cursor is None on the
+    last page.
+    """
+    check_limit(limit)
+    key = sort_key(sort)
+
+    if after is not None:
+        after_key = cursor_key(sort, after)
+        resources = (resource for resource in resources if
+                     key(resource) > after_key)
+
+    if limit is None:
+        return sorted(resources, key=key)
+
+    # Fetch one more resource to know if there is a next page
+    page = heapq.nsmallest(limit + 1, resources, key=key)
+    cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        cursor = make_cursor(sort, page[-1])
+    return {'resources': page, 'cursor': cursor}
 
 
 def query_incoming(caller, rel, resource_id, outgoing_resource_type,
@@ -17,7 +418,7 @@ def query_incoming(caller, rel, resource_id, outgoing_resource_type,
 
         caller.logger.info("%s / %s", resource_type, query)
 
-        resource = yield from caller.send(collection=resource_type,
+        resource = yield from caller.send(collection_name=resource_type,
                                           action='list',
                                           where=query)
 
@@ -31,20 +432,52 @@ def query_incoming(caller, rel, resource_id, outgoing_resource_type,
     return resource
 
 
+@asyncio.coroutine
 def follow_links(caller, first_resource, *rels):
-    resource = first_resource
-    for rel in rels:
-        rel_links = resource['_links']['latest'][rel]
+    resources = yield from follow_links_many(caller, [first_resource], *rels)
+    resource = resources[0]
+    if isinstance(resource, Exception):
+        raise resource
+    return resource
+
 
-        caller.logger.info('Rel %s, outgoing resource %s',
-            rel, rel_links)
+@asyncio.coroutine
+def follow_links_many(caller, resources, *rels):
+    """Follow the latest rels links from each resource, every hop fetches
+    the linked resources of all of them at once with caller.send_many.
 
-        resource_type, resource_id = rel_links
+    Return the resources data at the end of the links in the order of
+    resources, the exception instead for those which failed.
+    """
+    resources = list(resources)
+    for rel in rels:
+        # Resources linking to the same target share its request
+        targets = OrderedDict()
+        for position, resource in enumerate(resources):
+            if isinstance(resource, Exception):
+                continue
+            try:
+                target = tuple(resource['_links']['latest'][rel])
+            except KeyError:
+                resources[position] = KeyError(
+                    'No {} link in resource'.format(rel))
+                continue
+            targets.setdefault(target, []).append(position)
 
-        resource = caller.send(collection=resource_type, action='get',
-            resource_id=resource_id)['resource_data']
-        caller.logger.info('Resource %s', resource)
+        caller.logger.info('Rel %s, outgoing resources %s', rel,
+                           list(targets))
 
-    return resource
+        requests = [{'collection_name': resource_type, 'action': 'get',
+                     'resource_id': resource_id} for
+                    resource_type, resource_id in targets]
+        results = yield from caller.send_many(requests)
 
+        for (target, positions), result in zip(targets.items(), results):
+            if isinstance(result, dict):
+                result = result['resource_data']
+            elif not isinstance(result, Exception):
+                result = KeyError('No resource {}'.format(target))
+            for position in positions:
+                resources[position] = result
 
+    return resources
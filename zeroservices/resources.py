@@ -1,10 +1,23 @@
+import os
+import time
 import asyncio
 
+from .cache import ResourceCache
+from .executor import RuleExecutor
+from .indexes import RuleIndex
+from .leases import Leases
 from .service import BaseService
-from .exceptions import UnknownService, ResourceException
-from .query import match
+from .exceptions import (UnknownService, UnknownNode, ResourceException,
+                         RequestTimeout, ServiceUnavailable)
+from .query import (canonical, compile_query, paginate, make_cursor,
+                    parse_sort, project, extend_projection, check_limit)
+from .routing import get_routing_policy
+from .sharding import HashRing
 from .utils import accumulate
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
 from uuid import uuid4
 
 import logging
@@ -13,6 +26,30 @@ import logging
 ### Utils
 
 
+# Bulk collection actions -> message key of their list of items
+BULK_ACTIONS = {'bulk_create': 'resources', 'bulk_patch': 'patches',
+                'bulk_delete': 'resource_ids'}
+
+# Resource actions on the leases held by a collection
+LEASE_ACTIONS = ('claim', 'release')
+
+# Requests in flight at once by default in send_many
+SEND_MANY_CONCURRENCY = 64
+
+# Errors telling a node may be down
+NODE_FAILURES = (RequestTimeout, ServiceUnavailable, UnknownNode,
+                 ConnectionError)
+
+
+def changes_unsupported(error):
+    """Return whether a list error comes from a collection which doesn't
+    accept the since and epoch arguments
+    """
+    message = str(error)
+    return 'argument' in message and ("'since'" in message or
+                                      "'epoch'" in message)
+
+
 def is_callable(method):
     method.is_callable = True
     return asyncio.coroutine(method)
@@ -20,12 +57,54 @@ def is_callable(method):
 
 class BaseResourceService(BaseService):
 
+    """Send messages to the collections of the nodes.
+
+    A sharded collection is split between shards, each one held by a node
+    and named after its service unless the collection names it. Resources
+    are mapped to shards on a consistent-hash ring of the shard names, so
+    a node replacing a shard under the same name takes over its resources.
+
+    Resources are never moved between shards: adding or removing a shard
+    name maps about 1/N of the ids to another shard, those resources
+    can't be reached by id anymore until they are moved by hand. Pass
+    `shards`, {collection name: [shard names]}, to fix the rings instead
+    of growing them with the shards advertised by the nodes, and change
+    them with add_shard and remove_shard.
+    """
+
     application = None
 
-    def __init__(self, name, medium):
+    # Identical in-flight messages with these actions are sent only once
+    coalesced_actions = ('get', 'list')
+
+    def __init__(self, name, medium, routing_policy=None, cache=None,
+                 max_failures=3, failure_cooldown=30, shards=None):
         self.resources = {}
+        # Collection name -> node ids providing it, in registration order
         self.resources_directory = {}
         self.resources_worker_directory = {}
+        # Sharded collection name -> HashRing of its shard names
+        self.shard_rings = {}
+        # Sharded collection name -> {shard name: node id holding it}
+        self.shard_nodes = {}
+        # Sharded collections whose rings only change explicitly
+        self.declared_shards = set()
+        for collection_name, shard_names in (shards or {}).items():
+            self.shard_rings[collection_name] = HashRing(shard_names)
+            self.declared_shards.add(collection_name)
+        self.routing_policy = get_routing_policy(routing_policy)
+        # Coalesced message key -> future of its result
+        self.in_flight = {}
+        # Opt-in cache of remote get results, True for the default one
+        self.cache = ResourceCache() if cache is True else cache
+        # After max_failures failed requests in a row, a provider is
+        # skipped by routing for failure_cooldown seconds
+        self.max_failures = max_failures
+        self.failure_cooldown = failure_cooldown
+        # Node id -> failed requests in a row
+        self.node_failures = {}
+        # Node id -> loop time until which routing skips it
+        self.failed_nodes = {}
         super().__init__(name, medium)
 
     @property
@@ -37,33 +116,544 @@ class BaseResourceService(BaseService):
         super().save_new_node_info(node_info)
 
         for resource in node_info.get('resources', ()):
-            self.resources_directory[resource] = node_info['node_id']
+            providers = self.resources_directory.setdefault(resource, [])
+            if node_info['node_id'] not in providers:
+                providers.append(node_info['node_id'])
+
+        # Nodes which don't name their shards hold one named after their id
+        shards = node_info.get('shards', {})
+        for resource in node_info.get('sharded_resources', ()):
+            node_id = node_info['node_id']
+            self.bind_shard(resource, shards.get(resource, node_id), node_id)
+
+    def bind_shard(self, collection_name, shard_name, node_id):
+        """Record that node_id holds the shard, the shard is added to the
+        ring unless the ring of the collection was declared
+        """
+        ring = self.shard_rings.get(collection_name)
+        if ring is None or shard_name not in ring:
+            if collection_name in self.declared_shards:
+                self.logger.warning('Shard %s of %s is not declared, ignore '
+                                    'node %s', shard_name, collection_name,
+                                    node_id)
+                return
+            self.add_shard(collection_name, shard_name)
+        self.shard_nodes.setdefault(collection_name, {})[shard_name] = node_id
+
+    def add_shard(self, collection_name, shard_name):
+        """Add a shard to the ring of the collection, the resources whose
+        ids now map to it are not moved
+        """
+        ring = self.shard_rings.setdefault(collection_name, HashRing())
+        if shard_name in ring:
+            return
+        if ring:
+            self.logger.info('Shard %s joins the ring of %s, about 1/%d of '
+                             'the ids now map to it', shard_name,
+                             collection_name, len(ring) + 1)
+        ring.add_node(shard_name)
+
+    def remove_shard(self, collection_name, shard_name):
+        """Remove a shard from the ring of the collection, the resources
+        whose ids mapped to it are not moved
+        """
+        ring = self.shard_rings.get(collection_name)
+        if ring is None:
+            return
+        ring.remove_node(shard_name)
+        self.shard_nodes.get(collection_name, {}).pop(shard_name, None)
+        if not ring and collection_name not in self.declared_shards:
+            del self.shard_rings[collection_name]
+            self.shard_nodes.pop(collection_name, None)
+
+    def shard_node(self, collection_name, shard_name):
+        try:
+            return self.shard_nodes[collection_name][shard_name]
+        except KeyError:
+            raise ServiceUnavailable('No node holds shard {0} of {1}'.format(
+                shard_name, collection_name))
+
+    def resource_shard_node(self, collection_name, resource_id):
+        """Return the node holding the shard which owns resource_id
+        """
+        shard_name = self.shard_rings[collection_name].get_node(resource_id)
+        return self.shard_node(collection_name, shard_name)
+
+    def on_peer_leave(self, node_info):
+        node_id = node_info['node_id']
+        for resource, providers in list(self.resources_directory.items()):
+            if node_id in providers:
+                providers.remove(node_id)
+                # Its last events may have been lost
+                if self.cache is not None:
+                    self.cache.invalidate_collection(resource)
+            if not providers:
+                del self.resources_directory[resource]
+        # Its shards stay in the rings, a node may take them over
+        for shard_nodes in self.shard_nodes.values():
+            for shard_name, shard_node_id in list(shard_nodes.items()):
+                if shard_node_id == node_id:
+                    del shard_nodes[shard_name]
+        self.routing_policy.forget(node_id)
+        self.node_failures.pop(node_id, None)
+        self.failed_nodes.pop(node_id, None)
+        super().on_peer_leave(node_info)
+
+    def node_failed(self, node_id):
+        failures = self.node_failures.get(node_id, 0) + 1
+        self.node_failures[node_id] = failures
+        if failures >= self.max_failures:
+            self.logger.warning('Node %s failed %d requests in a row, skip '
+                                'it for %ss', node_id, failures,
+                                self.failure_cooldown)
+            self.failed_nodes[node_id] = (self.medium.loop.time() +
+                                          self.failure_cooldown)
+
+    def node_succeeded(self, node_id):
+        self.node_failures.pop(node_id, None)
+        self.failed_nodes.pop(node_id, None)
+
+    def healthy_nodes(self, node_ids):
+        """Return the node ids not skipped after their failures, all of them
+        when every one is
+        """
+        if not self.failed_nodes:
+            return node_ids
+        now = self.medium.loop.time()
+        healthy = [node_id for node_id in node_ids if
+                   self.failed_nodes.get(node_id, 0) <= now]
+        return healthy or node_ids
 
     @asyncio.coroutine
-    def send(self, collection_name, **kwargs):
-        message = kwargs
+    def process_event(self, message_type, event_message):
+        if self.cache is not None and message_type not in ('close',
+                                                           'register'):
+            self.update_cache(event_message)
+        return (yield from super().process_event(message_type,
+                                                 event_message))
+
+    def update_cache(self, event):
+        """Update the cached resource changed by a resource event
+        """
+        try:
+            key = (event['resource_name'], event['resource_id'])
+        except KeyError:
+            return
+
+        if event.get('action') == 'create' and 'resource_data' in event:
+            self.cache.update(key, {'resource_id': event['resource_id'],
+                                    'resource_data': event['resource_data']})
+        else:
+            self.cache.invalidate(key)
+
+    def _cache_key(self, collection_name, message):
+        """Return the cache key of a get message which could be served by
+        the cache, None otherwise
+        """
+        if self.cache is None or message.get('action') != 'get':
+            return None
+        if set(message) - {'action', 'resource_id', 'fields'}:
+            return None
+        # Local resources are read directly, don't cache them
+        if collection_name in self.resources:
+            return None
+
+        resource_id = message.get('resource_id')
+        if not resource_id:
+            return None
+
+        # Without their events, cached resources would never be updated
+        for action in ('create', 'patch', 'delete', 'add_link'):
+            topic = '.'.join((collection_name, action, str(resource_id)))
+            if not self.medium.is_subscribed(topic):
+                return None
+        return (collection_name, resource_id)
+
+    @asyncio.coroutine
+    def send(self, collection_name, timeout=None, **kwargs):
+        """Send a message to the collection, wait at most timeout seconds
+        for the result or raise RequestTimeout.
+
+        Identical read messages sent with the same timeout while one is in
+        flight wait for its result instead of being sent again, all of them
+        get the same result. The shared request is cancelled once every
+        waiter gave up.
+        """
+        cache_key = self._cache_key(collection_name, kwargs)
+        if cache_key is not None:
+            result = self.cache.get(cache_key)
+            if result is not None:
+                if kwargs.get('fields') is None:
+                    return result
+                return {'resource_id': result['resource_id'],
+                        'resource_data': project(result['resource_data'],
+                                                 kwargs['fields'])}
+
+        if kwargs.get('action') not in self.coalesced_actions:
+            return (yield from self._send(collection_name, timeout, kwargs))
+
+        # The shared request carries the timeout, and so the deadline, of
+        # its waiters
+        key = canonical(dict(kwargs, collection_name=collection_name,
+                             timeout=timeout))
+        entry = self.in_flight.get(key)
+        if entry is None:
+            request = asyncio.async(self._send(collection_name, timeout,
+                                               kwargs),
+                                    loop=self.medium.loop)
+            entry = self.in_flight[key] = [request, 0]
+            request.add_done_callback(
+                lambda request: self._request_done(key, request))
+
+        request = entry[0]
+        entry[1] += 1
+        # Don't cancel the request of the other waiters
+        try:
+            return (yield from asyncio.shield(request, loop=self.medium.loop))
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not request.done():
+                # Nobody waits for it anymore
+                if self.in_flight.get(key) is entry:
+                    del self.in_flight[key]
+                request.cancel()
+
+    def _request_done(self, key, request):
+        entry = self.in_flight.get(key)
+        if entry is not None and entry[0] is request:
+            del self.in_flight[key]
+        # Every waiter may have given up, don't log it as never retrieved
+        if not request.cancelled():
+            request.exception()
+
+    @asyncio.coroutine
+    def _send(self, collection_name, timeout, message):
+        # Only whole resources are cached
+        cache_key = None
+        if message.get('fields') is None:
+            cache_key = self._cache_key(collection_name, message)
+        if cache_key is None:
+            return (yield from self._send_message(collection_name, timeout,
+                                                  message))
+
+        self.cache.fetch_started(cache_key)
+        result = None
+        try:
+            result = yield from self._send_message(collection_name, timeout,
+                                                   message)
+        finally:
+            if isinstance(result, dict):
+                self.cache.put(cache_key, result)
+            else:
+                self.cache.fetch_failed(cache_key)
+        return result
+
+    @asyncio.coroutine
+    def _send_message(self, collection_name, timeout, message):
         message.update({'collection_name': collection_name})
 
-        if collection_name in self.resources.keys():
-            result = yield from self.on_message(**message)
+        # Let the receiver drop the message once nobody waits for it anymore
+        if timeout is not None:
+            message['deadline'] = time.time() + timeout
+
+        if collection_name in self.shard_rings:
+            result = yield from self.send_sharded(message, timeout)
+        elif collection_name in self.resources.keys():
+            result = yield from self.send_to_node(self.medium.node_id,
+                                                  message, timeout)
         else:
             try:
-                node_id = self.resources_directory[collection_name]
+                node_ids = self.resources_directory[collection_name]
             except KeyError:
                 raise UnknownService("Unknown service {0}".format(collection_name))
 
-            result = yield from super().send(node_id, message)
+            if message.get('action') in LEASE_ACTIONS:
+                # Every worker must reach the same leases
+                node_id = min(node_ids)
+            else:
+                node_id = self.routing_policy.choose(
+                    collection_name, self.healthy_nodes(node_ids))
+            result = yield from self.send_to_node(node_id, message, timeout)
 
         if result['success'] is False:
             raise ResourceException(result.pop("data"))
 
         return result.pop("data")
 
+    @asyncio.coroutine
+    def send_many(self, requests, max_concurrency=SEND_MANY_CONCURRENCY,
+                  timeout=None):
+        """Send a list of requests concurrently, each one a dict of send
+        keyword arguments, with at most max_concurrency requests in flight.
+
+        Return the results in the order of the requests, a failed request
+        gives its exception instead of a result.
+        """
+        loop = self.medium.loop
+        semaphore = asyncio.Semaphore(max_concurrency, loop=loop)
+
+        @asyncio.coroutine
+        def send_one(request):
+            request = dict(request)
+            request.setdefault('timeout', timeout)
+            with (yield from semaphore):
+                try:
+                    return (yield from self.send(**request))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    return e
+
+        # Requests to a node share its connection, interleave the nodes so
+        # all of them are busy from the start
+        groups = OrderedDict()
+        for position, request in enumerate(requests):
+            groups.setdefault(self._target(request), []).append(position)
+
+        tasks = {}
+        for positions in zip_longest(*groups.values()):
+            for position in positions:
+                if position is not None:
+                    tasks[position] = asyncio.async(
+                        send_one(requests[position]), loop=loop)
+
+        return (yield from asyncio.gather(
+            *[tasks[position] for position in range(len(requests))],
+            loop=loop))
+
+    def _target(self, request):
+        """Return the node a request will be sent to when it is known
+        beforehand, the collection name otherwise
+        """
+        collection_name = request['collection_name']
+        if collection_name in self.shard_rings:
+            resource_id = request.get('resource_id')
+            if resource_id and request.get('action') not in BULK_ACTIONS:
+                try:
+                    return self.resource_shard_node(collection_name,
+                                                    resource_id)
+                except (KeyError, ServiceUnavailable):
+                    pass
+        elif collection_name in self.resources:
+            return self.medium.node_id
+        else:
+            node_ids = self.resources_directory.get(collection_name, ())
+            if len(node_ids) == 1:
+                return node_ids[0]
+        return collection_name
+
+    @asyncio.coroutine
+    def send_to_node(self, node_id, message, timeout=None):
+        if node_id == self.medium.node_id:
+            try:
+                return (yield from asyncio.wait_for(
+                    self.on_message(**message), timeout,
+                    loop=self.medium.loop))
+            except asyncio.TimeoutError:
+                raise RequestTimeout('No response from {0} after {1}s'.format(
+                    message['collection_name'], timeout))
+
+        self.routing_policy.request_started(node_id)
+        start = self.medium.loop.time()
+        try:
+            result = yield from super().send(node_id, message,
+                                             timeout=timeout)
+        except NODE_FAILURES:
+            self.node_failed(node_id)
+            raise
+        except asyncio.CancelledError:
+            # Without a timeout, a hung node is only noticed by callers
+            # giving up on it
+            if timeout is None:
+                self.node_failed(node_id)
+            raise
+        else:
+            self.node_succeeded(node_id)
+            return result
+        finally:
+            self.routing_policy.request_finished(
+                node_id, self.medium.loop.time() - start)
+
+    @asyncio.coroutine
+    def send_sharded(self, message, timeout=None):
+        """Send a message about one resource to the shard owning it, list
+        messages are sent to every shard and their results concatenated
+        """
+        ring = self.shard_rings[message['collection_name']]
+
+        if message.get('action') == 'list' and not message.get('resource_id'):
+            shard_message = dict(message)
+            fields, sort = message.get('fields'), message.get('sort')
+            if fields is not None and sort:
+                # Shards results are merged on their sort fields
+                shard_message['fields'] = extend_projection(
+                    fields, [field_name for field_name, _ in
+                             parse_sort(sort)])
+
+            node_ids = [self.shard_node(message['collection_name'],
+                                        shard_name) for
+                        shard_name in sorted(ring.nodes)]
+            requests = [self.send_to_node(node_id, dict(shard_message),
+                                          timeout)
+                        for node_id in node_ids]
+            results = yield from asyncio.gather(*requests,
+                                                loop=self.medium.loop)
+
+            for result in results:
+                if result['success'] is False:
+                    return result
+            return {'success': True,
+                    'data': self._merge_pages(message, [
+                        result['data'] for result in results])}
+
+        if message.get('action') in BULK_ACTIONS:
+            return (yield from self.send_bulk_sharded(message, timeout))
+
+        if not message.get('resource_id'):
+            if message.get('action') != 'create':
+                return {'success': False,
+                        'data': 'resource_id is required on a sharded '
+                                'collection'}
+            message['resource_id'] = uuid4().hex
+
+        node_id = self.resource_shard_node(message['collection_name'],
+                                           message['resource_id'])
+        return (yield from self.send_to_node(node_id, message, timeout))
+
+    @asyncio.coroutine
+    def send_bulk_sharded(self, message, timeout=None):
+        """Split a bulk message by shard and send each part to its shard,
+        the per-item results are returned in the original order
+        """
+        collection_name = message['collection_name']
+        items_key = BULK_ACTIONS[message['action']]
+
+        # Node id -> positions of its items in the message
+        positions = {}
+        for position, item in enumerate(message[items_key]):
+            if message['action'] == 'bulk_delete':
+                resource_id = item
+            else:
+                if not item.get('resource_id'):
+                    item['resource_id'] = uuid4().hex
+                resource_id = item['resource_id']
+            positions.setdefault(self.resource_shard_node(
+                collection_name, resource_id), []).append(position)
+
+        node_ids = sorted(positions)
+        requests = []
+        for node_id in node_ids:
+            shard_message = dict(message)
+            shard_message[items_key] = [message[items_key][position] for
+                                        position in positions[node_id]]
+            requests.append(self.send_to_node(node_id, shard_message,
+                                              timeout))
+        results = yield from asyncio.gather(*requests, loop=self.medium.loop)
+
+        data = [None] * len(message[items_key])
+        for node_id, result in zip(node_ids, results):
+            if result['success'] is False:
+                return result
+            for position, item_result in zip(positions[node_id],
+                                             result['data']):
+                data[position] = item_result
+        return {'success': True, 'data': data}
+
+    @staticmethod
+    def _merge_pages(message, results):
+        """Merge the list results of every shard, pages are merged into the
+        first resources of the global order
+        """
+        sort, limit = message.get('sort'), message.get('limit')
+
+        fields = message.get('fields')
+
+        if limit is None:
+            resources = [resource for result in results for resource in
+                         result]
+            # Resumed lists are merged on the cursor key, the resource id
+            # without sort
+            if sort is None and message.get('after') is None:
+                return resources
+            resources = paginate(resources, sort)
+            page = {'resources': resources}
+        else:
+            resources = [resource for result in results for resource in
+                         result['resources']]
+            page = paginate(resources, sort, limit)
+
+            # A shard has more resources after the merged page
+            if page['cursor'] is None and page['resources'] and \
+                    any(result['cursor'] is not None for result in results):
+                page['cursor'] = make_cursor(sort, page['resources'][-1])
+
+        if fields is not None and sort:
+            for resource in page['resources']:
+                resource['resource_data'] = project(resource['resource_data'],
+                                                    fields)
+
+        return page if limit is not None else page['resources']
+
+    def list_cursor(self, collection_name, where=None, sort=None,
+                    chunk_size=100, **kwargs):
+        """Return a ListCursor fetching the resources of the collection
+        chunk_size at a time
+        """
+        return ListCursor(self, collection_name, where=where, sort=sort,
+                          chunk_size=chunk_size, **kwargs)
+
+
+class ListCursor(object):
+
+    """Lazily iterate over a collection list, each call to next fetches the
+    next chunk of resources from the node serving the collection.
+
+    Usage::
+
+        cursor = service.list_cursor('collection', chunk_size=100)
+        resources = yield from cursor.next()
+        while resources:
+            ...
+            resources = yield from cursor.next()
+    """
+
+    def __init__(self, service, collection_name, where=None, sort=None,
+                 chunk_size=100, **kwargs):
+        check_limit(chunk_size)
+        self.service = service
+        self.collection_name = collection_name
+        self.where = where
+        self.sort = sort
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+        self.cursor = None
+        self.done = False
+
+    @asyncio.coroutine
+    def next(self):
+        """Return the next chunk of resources, an empty list once every
+        resource has been read
+        """
+        if self.done:
+            return []
+
+        page = yield from self.service.send(
+            self.collection_name, action='list', where=self.where,
+            sort=self.sort, limit=self.chunk_size, after=self.cursor,
+            **self.kwargs)
+
+        self.cursor = page['cursor']
+        self.done = self.cursor is None
+        return page['resources']
+
 
 class ResourceService(BaseResourceService):
 
     def service_info(self):
+        shards = {name: collection.shard_name for name, collection in
+                  self.resources.items() if collection.sharded}
         return {'name': self.name, 'resources': list(self.resources.keys()),
+                'sharded_resources': list(shards), 'shards': shards,
                 'node_type': 'node'}
 
     def on_registration_message_worker(self, node_info):
@@ -78,10 +668,17 @@ class ResourceService(BaseResourceService):
         self.on_peer_join(node_info['node_id'])
 
     @asyncio.coroutine
-    def on_message(self, collection_name, message_type=None, *args, **kwargs):
+    def on_message(self, collection_name, message_type=None, deadline=None,
+                   *args, **kwargs):
         '''Ignore message_type for the moment
         '''
 
+        # The sender gave up waiting for the result
+        if deadline is not None and time.time() > deadline:
+            error_message = 'Deadline expired for %s message' % collection_name
+            self.logger.warning(error_message)
+            return {'success': False, 'data': error_message}
+
         # Get collection
         try:
             collection = self.resources[collection_name]
@@ -94,6 +691,8 @@ class ResourceService(BaseResourceService):
         # Try to get a result
         try:
             result = yield from collection.on_message(*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             self.logger.exception("Error: {0}".format(str(e)))
             return {'success': False, 'data': str(e)}
@@ -110,6 +709,13 @@ class ResourceService(BaseResourceService):
         # Publish to itself
         yield from self.on_event(*args)
 
+    @asyncio.coroutine
+    def publish_many(self, events):
+        yield from super(ResourceService, self).publish_many(events)
+
+        for event in events:
+            yield from self.on_event(*event)
+
     ### Utils
     def register_resource(self, collection):
         assert isinstance(collection, ResourceCollection)
@@ -120,6 +726,10 @@ class ResourceService(BaseResourceService):
         # Resources collections
         self.resources[collection.resource_name] = collection
 
+        if collection.sharded:
+            self.bind_shard(collection.resource_name, collection.shard_name,
+                            self.medium.node_id)
+
     def get_known_worker_nodes(self):
         return {resource_type: list(workers.keys()) for resource_type, workers in
                 self.resources_worker_directory.items()}
@@ -150,11 +760,24 @@ class ResourceCollection(object):
     resource_name = None
     resource_class = None
     service = None
+    # Sharded collections only hold the resources whose id hashes to them,
+    # True for a shard named after the service or the name of the shard
+    sharded = False
 
-    def __init__(self, resource_name):
+    def __init__(self, resource_name, sharded=None):
         self.resource_name = resource_name
+        if sharded is not None:
+            self.sharded = sharded
+        # Leases of the workers processing the resources
+        self.leases = Leases()
         self.logger = logging.getLogger("{0}.{1}".format(resource_name, 'collection'))
 
+    @property
+    def shard_name(self):
+        if isinstance(self.sharded, str):
+            return self.sharded
+        return self.service.name
+
     def on_message(self, action, resource_id=None, **kwargs):
         if resource_id:
             resource = self.instantiate(resource_id=resource_id)
@@ -180,6 +803,15 @@ class ResourceCollection(object):
         topic = '.'.join((self.resource_name, topic))
         yield from self.service.publish(topic, message)
 
+    def publish_many(self, events):
+        """Publish a list of (topic, message) at once, used by bulk actions
+        """
+        for topic, message in events:
+            message.update({'resource_name': self.resource_name})
+        yield from self.service.publish_many(
+            [('.'.join((self.resource_name, topic)), message) for
+             topic, message in events])
+
     @is_callable
     def list(self, where=None):
         pass
@@ -214,6 +846,16 @@ class Resource(object):
     def delete(self):
         pass
 
+    @is_callable
+    def claim(self, owner, ttl):
+        return self.resource_collection.leases.claim(self.resource_id, owner,
+                                                     ttl)
+
+    @is_callable
+    def release(self, owner, token):
+        return self.resource_collection.leases.release(self.resource_id,
+                                                       owner, token)
+
     @abstractmethod
     @is_callable
     def add_link(self, relation, target_id, title):
@@ -227,29 +869,206 @@ class Resource(object):
 
 class ResourceWorker(BaseResourceService):
 
-    def __init__(self, name, medium):
+    def __init__(self, name, medium, routing_policy=None, cache=None,
+                 concurrency=None, max_queue=1000, lease_ttl=None,
+                 process_pool_size=None):
         name = '{:s}-{:s}'.format(name, str(uuid4()))
         self.rules = {}
-        super().__init__(name, medium)
+        # Resource type -> RuleIndex of its rules
+        self.rule_indexes = {}
+        # Resource type -> node polled for its changes
+        self.poll_nodes = {}
+        # Resource types whose collections can't list their changes
+        self.no_changes = set()
+        super().__init__(name, medium, routing_policy, cache)
+
+        # Without concurrency, rules run one after another inside on_event
+        # and poll_check
+        self.executor = None
+        if concurrency is not None:
+            self.executor = RuleExecutor(concurrency, max_queue,
+                                         loop=self.medium.loop,
+                                         logger=self.logger,
+                                         run=self._run_rule)
+
+        # With a lease_ttl, workers compete for the resources: a rule only
+        # runs once the worker holds the lease of the resource, the other
+        # workers skip it until the lease expires
+        self.lease_ttl = lease_ttl
+        self.lease_stats = {'claims': 0, 'conflicts': 0, 'errors': 0}
+
+        # Runs the cpu bound rules, started with the first one, one process
+        # per core by default
+        self.process_pool_size = process_pool_size or os.cpu_count()
+        self.process_pool = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.close()
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
+        return super().close()
+
+    @asyncio.coroutine
+    def call_rule(self, rule, resource_name, resource_data, resource_id,
+                  action):
+        """Call the rule callback, in the process pool for cpu bound rules
+        whose result is then given to their on_result coroutine
+        """
+        if not rule.cpu_bound:
+            return (yield from rule(resource_name, resource_data,
+                                    resource_id, action))
+
+        if self.process_pool is None:
+            self.process_pool = ProcessPoolExecutor(self.process_pool_size)
+        result = yield from self.medium.loop.run_in_executor(
+            self.process_pool, rule.callback, resource_name, resource_data,
+            resource_id, action)
+
+        if rule.on_result is not None:
+            yield from rule.on_result(resource_name, resource_data,
+                                      resource_id, action, result)
+        return result
+
+    @asyncio.coroutine
+    def run_rule(self, rule, resource_name, resource_data, resource_id,
+                 action):
+        if self.executor is None:
+            yield from self._run_rule(rule, resource_name, resource_data,
+                                      resource_id, action)
+        else:
+            yield from self.executor.submit((resource_name, resource_id),
+                                            rule, resource_name,
+                                            resource_data, resource_id,
+                                            action)
 
     @asyncio.coroutine
     def start(self):
         self.medium.periodic_call(self.poll_check, 10)
         yield from super().start()
 
+    @asyncio.coroutine
+    def _run_rule(self, rule, resource_name, resource_data, resource_id,
+                  action):
+        if self.lease_ttl is None:
+            return (yield from self.call_rule(rule, resource_name,
+                                              resource_data, resource_id,
+                                              action))
+
+        token = yield from self.claim(resource_name, resource_id)
+        if token is None:
+            return
+
+        # The lease is kept until it expires so the other workers skip the
+        # same event, unless the rule failed and another one could retry
+        try:
+            yield from self.call_rule(rule, resource_name, resource_data,
+                                      resource_id, action)
+        except Exception:
+            yield from self.release(resource_name, resource_id, token)
+            raise
+
+    @asyncio.coroutine
+    def claim(self, resource_name, resource_id):
+        """Claim the lease of a resource, return its token or None when
+        another worker holds it
+        """
+        try:
+            lease = yield from self.send(collection_name=resource_name,
+                                         action='claim',
+                                         resource_id=resource_id,
+                                         owner=self.name, ttl=self.lease_ttl)
+        except (ResourceException, RequestTimeout, UnknownService) as e:
+            self.logger.warning('Cannot claim %s %s: %s', resource_name,
+                                resource_id, e)
+            self.lease_stats['errors'] += 1
+            return None
+
+        if not lease['claimed']:
+            self.lease_stats['conflicts'] += 1
+            return None
+        self.lease_stats['claims'] += 1
+        return lease['token']
+
+    @asyncio.coroutine
+    def release(self, resource_name, resource_id, token):
+        try:
+            yield from self.send(collection_name=resource_name,
+                                 action='release', resource_id=resource_id,
+                                 owner=self.name, token=token)
+        except (ResourceException, RequestTimeout, UnknownService) as e:
+            # The lease expires anyway
+            self.logger.warning('Cannot release %s %s: %s', resource_name,
+                                resource_id, e)
+
     @asyncio.coroutine
     def poll_check(self):
         # Ask about existing resources matching rule
         self.logger.info('Poll check starting')
         for resource_type, rules in self.rules.items():
             for rule in rules:
-                matching_resources = yield from self.send(collection_name=resource_type,
-                                                          action="list",
-                                                          where=rule.matcher)
+                matching_resources = yield from self.poll_rule(resource_type,
+                                                               rule)
                 self.logger.info('Rule %s, resources %s', rule, matching_resources)
                 for resource in matching_resources:
-                    yield from rule(resource_type, resource['resource_data'],
-                                    resource['resource_id'], 'periodic')
+                    yield from self.run_rule(rule, resource_type,
+                                             resource['resource_data'],
+                                             resource['resource_id'],
+                                             'periodic')
+
+    @asyncio.coroutine
+    def poll_rule(self, resource_type, rule):
+        """Return the resources matching rule changed since its last poll,
+        all of them the first time or when the collection lost track
+        """
+        # Each shard has its own change sequence
+        if resource_type not in self.shard_rings and \
+                resource_type not in self.no_changes:
+            # So does each replica, poll the changes of the same one
+            node_id = self.poll_node(resource_type)
+            epoch, seq = rule.checkpoints.get(node_id) or (None, 0)
+            message = {'collection_name': resource_type, 'action': 'list',
+                       'where': rule.matcher, 'since': seq, 'epoch': epoch}
+            try:
+                if node_id is None:
+                    changes = yield from self.send(**message)
+                else:
+                    result = yield from self.send_to_node(node_id, message)
+                    if result['success'] is False:
+                        raise ResourceException(result.get('data'))
+                    changes = result['data']
+            except ResourceException as e:
+                if changes_unsupported(e):
+                    # The collection doesn't keep track of its changes,
+                    # don't ask again
+                    self.logger.info('No changes list for %s: %s',
+                                     resource_type, e)
+                    self.no_changes.add(resource_type)
+                else:
+                    self.logger.warning('Changes of %s failed, list them '
+                                        'all: %s', resource_type, e)
+            else:
+                if changes['resync'] and node_id in rule.checkpoints:
+                    self.logger.info('Resync rule %s', rule)
+                rule.checkpoints[node_id] = (changes['epoch'], changes['seq'])
+                return changes['resources']
+
+        return (yield from self.send(collection_name=resource_type,
+                                     action="list", where=rule.matcher))
+
+    def poll_node(self, resource_type):
+        """Return the node whose changes of resource_type are polled, the
+        same one as long as it is healthy, None for a local collection
+        """
+        node_ids = self.resources_directory.get(resource_type)
+        if not node_ids or resource_type in self.resources:
+            return None
+        healthy = self.healthy_nodes(node_ids)
+        node_id = self.poll_nodes.get(resource_type)
+        if node_id not in healthy:
+            node_id = self.poll_nodes[resource_type] = healthy[0]
+        return node_id
 
     def service_info(self):
         return {'name': self.name, 'resources': list(self.rules.keys()),
@@ -272,13 +1091,27 @@ class ResourceWorker(BaseResourceService):
             resource_data = resource['resource_data']
 
         # See if one rule match
-        for rule in resource_rules:
+        candidates = self.rule_indexes[resource_name].candidates(
+            resource_data)
+        for rule in candidates:
             if rule.match(resource_data):
-                yield from rule(resource_name, resource_data, resource_id, action)
-
-    def register(self, callback, resource_type, **matcher):
-        rule = Rule(callback, matcher)
+                yield from self.run_rule(rule, resource_name, resource_data,
+                                         resource_id, action)
+
+    def register(self, callback, resource_type, *, concurrency=None,
+                 cpu_bound=False, on_result=None, **matcher):
+        """Call callback for the resources of resource_type matching
+        matcher, at most concurrency callbacks of this rule run at once
+        when the worker has a concurrency.
+
+        A cpu_bound callback is a plain picklable function run in the
+        worker process pool, on_result(resource_name, resource_data,
+        resource_id, action, result) is then called in the loop to act
+        on its result.
+        """
+        rule = Rule(callback, matcher, concurrency, cpu_bound, on_result)
         self.rules.setdefault(resource_type, []).append(rule)
+        self.rule_indexes.setdefault(resource_type, RuleIndex()).add(rule)
 
         # Register to events matching resource_type
         self.medium.subscribe(resource_type)
@@ -302,18 +1135,26 @@ class Rule(object):
             'ResourceID')
     """
 
-    def __init__(self, callback, matcher):
+    def __init__(self, callback, matcher, concurrency=None, cpu_bound=False,
+                 on_result=None):
         self.callback = callback
         self.matcher = matcher
+        self.concurrency = concurrency
+        self.cpu_bound = cpu_bound
+        self.on_result = on_result
+        self._match = compile_query(matcher)
+        # Node id -> (epoch, seq) of its collection changes already polled
+        self.checkpoints = {}
 
     def match(self, resource):
-        return match(self.matcher, resource)
+        return self._match(resource)
 
     def __call__(self, *args, **kwargs):
         return self.callback(*args, **kwargs)
 
     def __repr__(self):
-        return 'Rule({})'.format(self.__dict__)
+        return 'Rule({})'.format({'callback': self.callback,
+                                  'matcher': self.matcher})
 
 
 #### Exceptions
@@ -0,0 +1,126 @@
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+
+
+class RoutingPolicy(object):
+
+    """Choose which node serves a request when several nodes provide the
+    same collection. The policy is told when requests start and finish to
+    keep track of the load and latency of each node.
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def choose(self, collection_name, node_ids):
+        pass
+
+    def request_started(self, node_id):
+        pass
+
+    def request_finished(self, node_id, elapsed):
+        pass
+
+    def forget(self, node_id):
+        pass
+
+
+class RoundRobinPolicy(RoutingPolicy):
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+
+    def choose(self, collection_name, node_ids):
+        index = self.counters[collection_name]
+        self.counters[collection_name] = index + 1
+        return node_ids[index % len(node_ids)]
+
+
+class LeastOutstandingPolicy(RoutingPolicy):
+
+    """Choose the node with the fewest requests in flight, the first one in
+    registration order on ties.
+    """
+
+    def __init__(self):
+        self.outstanding = defaultdict(int)
+
+    def choose(self, collection_name, node_ids):
+        return min(node_ids,
+                   key=lambda node_id: self.outstanding.get(node_id, 0))
+
+    def request_started(self, node_id):
+        self.outstanding[node_id] += 1
+
+    def request_finished(self, node_id, elapsed):
+        self.outstanding[node_id] -= 1
+        if not self.outstanding[node_id]:
+            del self.outstanding[node_id]
+
+    def forget(self, node_id):
+        self.outstanding.pop(node_id, None)
+
+
+class LatencyPolicy(LeastOutstandingPolicy):
+
+    """Choose the node with the lowest expected latency, an exponentially
+    weighted moving average of its response times scaled by the requests
+    it already has in flight.
+
+    Nodes without any measure yet are expected as fast as the fastest node
+    and are tried first on ties, their requests in flight still count.
+    """
+
+    def __init__(self, alpha=0.3, initial_latency=0.01):
+        super(LatencyPolicy, self).__init__()
+        self.alpha = alpha
+        # Prior latency of the nodes while none is measured
+        self.initial_latency = initial_latency
+        self.latencies = {}
+
+    def expected_latency(self, node_id):
+        latency = self.latencies.get(node_id)
+        if latency is None:
+            latency = min(self.latencies.values(),
+                          default=self.initial_latency)
+        return latency * (1 + self.outstanding.get(node_id, 0))
+
+    def choose(self, collection_name, node_ids):
+        return min(node_ids, key=lambda node_id: (
+            self.expected_latency(node_id), node_id in self.latencies))
+
+    def request_finished(self, node_id, elapsed):
+        super(LatencyPolicy, self).request_finished(node_id, elapsed)
+
+        latency = self.latencies.get(node_id)
+        if latency is None:
+            self.latencies[node_id] = elapsed
+        else:
+            self.latencies[node_id] = (self.alpha * elapsed +
+                                       (1 - self.alpha) * latency)
+
+    def forget(self, node_id):
+        super(LatencyPolicy, self).forget(node_id)
+        self.latencies.pop(node_id, None)
+
+
+ROUTING_POLICIES = {
+    'round_robin': RoundRobinPolicy,
+    'least_outstanding': LeastOutstandingPolicy,
+    'latency': LatencyPolicy,
+}
+
+
+def get_routing_policy(policy):
+    """Return a policy instance from a policy, a policy class or its name
+    """
+    if policy is None:
+        return RoundRobinPolicy()
+    if isinstance(policy, str):
+        try:
+            policy = ROUTING_POLICIES[policy]
+        except KeyError:
+            raise ValueError("Unknown routing policy {}".format(policy))
+    if isinstance(policy, type):
+        policy = policy()
+    return policy
@@ -59,6 +59,13 @@ class BaseService(object):
     def on_registration_message_worker(self, node_info):
         pass
 
+    def on_leave_message(self, message):
+        node_info = self.directory.pop(message['node_id'], None)
+        if node_info is None:
+            return
+
+        self.on_peer_leave(node_info)
+
     def save_new_node_info(self, node_info):
         self.directory[node_info['node_id']] = copy(node_info)
 
@@ -78,9 +85,9 @@ class BaseService(object):
     @asyncio.coroutine
     def process_event(self, message_type, event_message):
         if message_type == 'close':
-            return self.service.on_peer_leave(event_message)
+            return self.on_leave_message(event_message)
         elif message_type == 'register':
-            return self.service.on_registration_message(event_message)
+            return self.on_registration_message(event_message)
         else:
             result = yield from self.on_event(message_type, **event_message)
             return result
@@ -95,6 +102,9 @@ class BaseService(object):
     def publish(self, *args, **kwargs):
         return self.medium.publish(*args, **kwargs)
 
+    def publish_many(self, events):
+        return self.medium.publish_many(events)
+
     @coroutine
     def start(self):
         yield from self.medium.start()
@@ -102,5 +112,12 @@ class BaseService(object):
     def get_directory(self):
         return self.directory
 
+    @coroutine
+    def leave(self):
+        """Tell the known peers this node is leaving, then close it
+        """
+        yield from self.medium.send_leave()
+        return self.close()
+
     def close(self):
         return self.medium.close()
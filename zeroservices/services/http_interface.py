@@ -9,6 +9,7 @@ from aiohttp import hdrs
 from base64 import b64decode
 from .realtime import RealtimeHandler
 from ..exceptions import UnknownService
+from ..query import check_limit
 
 
 # class AuthenticationError(HTTPError):
@@ -143,7 +144,30 @@ class CollectionHandler(BaseHandler):
         return getattr(self, request.method.lower())(request)
 
     def get(self, request):
-        return self._process(request, request.match_info['collection'], 'list')
+        return self._process(request, request.match_info['collection'], 'list',
+                             **self._list_arguments(request))
+
+    @staticmethod
+    def _list_arguments(request):
+        """Pagination arguments from the query string, ?limit=100&sort=-size
+        &after=<cursor as JSON>
+        """
+        arguments = {}
+        try:
+            if 'limit' in request.GET:
+                arguments['limit'] = int(request.GET['limit'])
+                check_limit(arguments['limit'])
+            if 'sort' in request.GET:
+                arguments['sort'] = request.GET['sort'].split(',')
+            if 'after' in request.GET:
+                arguments['after'] = json.loads(request.GET['after'])
+                if not isinstance(arguments['after'], list):
+                    raise ValueError("after must be a JSON list")
+        except ValueError as e:
+            err_body = json.dumps({'error': str(e)}).encode('utf-8')
+            raise web.HTTPBadRequest(content_type="application/json",
+                                     body=err_body)
+        return arguments
 
     # def get(self, collection):
     #     args = {key: value[0] for key, value in self.request.arguments.items()}
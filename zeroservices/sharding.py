@@ -0,0 +1,53 @@
+from bisect import bisect, insort
+from hashlib import md5
+
+
+class HashRing(object):
+
+    """Consistent-hash ring mapping keys to nodes.
+
+    Each node is placed `vnodes` times on the ring so keys are evenly spread,
+    adding or removing one of N nodes only moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes=(), vnodes=100):
+        self.vnodes = vnodes
+        self.ring = []
+        self.owners = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    @staticmethod
+    def hash(key):
+        return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.vnodes):
+            point = self.hash('%s-%d' % (node, replica))
+            self.owners[point] = node
+            insort(self.ring, point)
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        for replica in range(self.vnodes):
+            point = self.hash('%s-%d' % (node, replica))
+            del self.owners[point]
+            self.ring.remove(point)
+
+    def get_node(self, key):
+        if not self.ring:
+            raise KeyError('Empty ring')
+        index = bisect(self.ring, self.hash(str(key))) % len(self.ring)
+        return self.owners[self.ring[index]]